@@ -46,6 +46,18 @@ def main(args=None):
 	subp.set_defaults(func=do_stl2scad)
 
 
+	subp = subparsers.add_parser(
+	 "stl_info",
+	 help="Show the geometry of an STL file (bounds, area, volume)",
+	)
+
+	def do_stl_info(args):
+		from .stl_mesh import main
+		return main(rest)
+
+	subp.set_defaults(func=do_stl_info)
+
+
 	subp = subparsers.add_parser(
 	 "meshconv",
 	 help="Run meshconv",
@@ -95,6 +107,90 @@ def main(args=None):
 	subp.set_defaults(func=do_gcode_sender)
 
 
+	subp = subparsers.add_parser(
+	 "gcode_sim",
+	 help="Run simulated gcode controller",
+	)
+
+	def do_gcode_sim(args):
+		from .gcode_sim import main
+		return main(rest)
+
+	subp.set_defaults(func=do_gcode_sim)
+
+
+	subp = subparsers.add_parser(
+	 "gcode_bench",
+	 help="Run gcode sender benchmark",
+	)
+
+	def do_gcode_bench(args):
+		from .gcode_bench import main
+		return main(rest)
+
+	subp.set_defaults(func=do_gcode_bench)
+
+
+	subp = subparsers.add_parser(
+	 "gcode_record",
+	 help="Dump or replay gcode traffic logs",
+	)
+
+	def do_gcode_record(args):
+		from .gcode_record import main
+		return main(rest)
+
+	subp.set_defaults(func=do_gcode_record)
+
+
+	subp = subparsers.add_parser(
+	 "milling_bench",
+	 help="Run G-code writer benchmarks",
+	)
+
+	def do_milling_bench(args):
+		from .milling_xyz.bench import main
+		return main(rest)
+
+	subp.set_defaults(func=do_milling_bench)
+
+
+	subp = subparsers.add_parser(
+	 "postproc",
+	 help="Post-process a G-code file",
+	)
+
+	def do_postproc(args):
+		from .milling_xyz.postproc import main
+		return main(rest)
+
+	subp.set_defaults(func=do_postproc)
+
+
+	subp = subparsers.add_parser(
+	 "estimate",
+	 help="Estimate the execution time of a G-code file",
+	)
+
+	def do_estimate(args):
+		from .milling_xyz.motion import main
+		return main(rest)
+
+	subp.set_defaults(func=do_estimate)
+
+
+	subp = subparsers.add_parser(
+	 "analyze",
+	 help="Analyze a G-code file (bounds, lengths, feed rates, tools)",
+	)
+
+	def do_analyze(args):
+		from .milling_xyz.program import main
+		return main(rest)
+
+	subp.set_defaults(func=do_analyze)
+
+
 	try:
 		import argcomplete
 		argcomplete.autocomplete(parser)
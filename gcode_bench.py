@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# PYTHON_ARGCOMPLETE_OK
+# g-code sender throughput benchmark
+
+"""
+Run the senders of gcode_sender, in their different modes, against
+simulated controllers (gcode_sim) and report throughput figures:
+
+- lines/s and bytes/s;
+- time spent by the controller with an empty planner while the job
+  was running (underrun);
+- acknowledgement latency percentiles.
+"""
+
+import sys, io, os
+import time
+import json
+import math
+import asyncio
+import tempfile
+import subprocess
+import logging
+
+from .gcode_sender import (
+ SenderGrbl,
+ SenderTrinus,
+ SenderMarlin,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+# (name, simulator protocol, sender class, sender keyword arguments)
+CONFIGS = (
+ ("grbl-poll", "grbl", SenderGrbl, dict(mode="poll")),
+ ("grbl-stream", "grbl", SenderGrbl, dict(mode="stream")),
+ ("grbl-0.9-poll", "grbl-0.9", SenderGrbl, dict(mode="poll", version="0.9")),
+ ("grbl-0.9-stream", "grbl-0.9", SenderGrbl, dict(mode="stream", version="0.9")),
+ ("marlin-ack", "marlin", SenderMarlin, dict(mode="ack")),
+ ("marlin-stream", "marlin", SenderMarlin, dict(mode="stream")),
+ ("trinus-1", "trinus", SenderTrinus, dict(window=1)),
+ ("trinus-8", "trinus", SenderTrinus, dict(window=8)),
+)
+
+
+def synthetic_job(nb_lines=2000):
+	"""
+	Short segments along a circle, like a 3D finishing job
+	"""
+	res = list()
+	for i in range(nb_lines):
+		a = 2 * math.pi * i / 500
+		res.append("G1 X%.3f Y%.3f F1500" % (10 * math.cos(a), 10 * math.sin(a)))
+	return res
+
+
+def percentile(values, p):
+	if not values:
+		return float("nan")
+	values = sorted(values)
+	return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def _sim_command(protocol, sim_args, stats):
+	"""
+	Command line running the simulator as a module of this package
+	"""
+	root = os.path.dirname(os.path.abspath(__file__))
+	for x in __package__.split("."):
+		root = os.path.dirname(root)
+	env = dict(os.environ)
+	env["PYTHONPATH"] = os.pathsep.join(x for x in (root, env.get("PYTHONPATH")) if x)
+	cmd = [sys.executable, "-m", __package__ + ".gcode_sim",
+	 "--protocol", protocol, "--stats", stats] + list(sim_args)
+	return cmd, env
+
+
+async def _run(sender, lines):
+	latencies = []
+	sender.on_ack = lambda entry: latencies.append(time.monotonic() - entry.t_sent)
+	async with sender:
+		t0 = time.monotonic()
+		for line in lines:
+			await sender.queue(line)
+		await sender.drain()
+		dt = time.monotonic() - t0
+	return dt, latencies
+
+
+def bench(name, protocol, sender_class, sender_kw, lines, sim_args=()):
+	"""
+	:return: dict of results
+	"""
+	with tempfile.TemporaryDirectory() as tmpdir:
+		stats_fn = os.path.join(tmpdir, "stats.json")
+		cmd, env = _sim_command(protocol, sim_args, stats_fn)
+		proc = subprocess.Popen(cmd,
+		 stdin=subprocess.PIPE,
+		 stdout=subprocess.PIPE,
+		 env=env,
+		)
+		try:
+			sender = sender_class(stdin=proc.stdin, stdout=proc.stdout, **sender_kw)
+			dt, latencies = asyncio.run(_run(sender, lines))
+		finally:
+			proc.stdin.close()
+			proc.wait()
+			proc.stdout.close()
+		with io.open(stats_fn, "r") as f:
+			stats = json.load(f)
+
+	nb_lines = len(lines)
+	return dict(
+	 name=name,
+	 lines=nb_lines,
+	 time=dt,
+	 lines_per_s=nb_lines / dt,
+	 bytes_per_s=stats.get("bytes_in", 0) / dt,
+	 underrun=stats.get("underrun"),
+	 ack_p50=percentile(latencies, 50),
+	 ack_p90=percentile(latencies, 90),
+	 ack_p99=percentile(latencies, 99),
+	 errors=stats.get("errors", 0),
+	 rx_overflow=stats.get("rx_overflow", 0),
+	)
+
+
+def main(args=None):
+
+	if args is None:
+		args = sys.argv[1:]
+
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	 description="g-code sender benchmark, against simulated controllers",
+	)
+
+	parser.add_argument("--log-level",
+	 default="WARNING",
+	 help="Logging level (eg. INFO, see Python logging docs)",
+	)
+
+	parser.add_argument("--config",
+	 help="configuration to run (default: all)",
+	 choices=[x[0] for x in CONFIGS],
+	 action="append",
+	)
+
+	parser.add_argument("--lines",
+	 help="number of lines of the synthetic job",
+	 type=int,
+	 default=2000,
+	)
+
+	parser.add_argument("--file",
+	 help="g-code file to send instead of the synthetic job",
+	)
+
+	parser.add_argument("--json",
+	 help="output results as JSON lines",
+	 action="store_true",
+	)
+
+	parser.add_argument("sim_args",
+	 help="simulator arguments (after --), eg. --baud 115200 --exec-time 0.002",
+	 nargs=argparse.REMAINDER,
+	)
+
+	try:
+		import argcomplete
+		argcomplete.autocomplete(parser)
+	except:
+		pass
+
+	args = parser.parse_args(args)
+
+	logging.basicConfig(
+	 datefmt="%Y%m%dT%H%M%S",
+	 level=getattr(logging, args.log_level),
+	 format="%(asctime)-15s %(name)s %(levelname)s %(message)s"
+	)
+
+	sim_args = [x for x in args.sim_args if x != "--"]
+
+	if args.file is not None:
+		from .gcode_sender import clean_line
+		with io.open(args.file, "r") as f:
+			lines = [x for x in (clean_line(l) for l in f) if x is not None]
+	else:
+		lines = synthetic_job(args.lines)
+
+	if not args.json:
+		print("%-16s %7s %8s %9s %9s %9s %8s %8s %8s %6s" % ("config", "lines", "time/s",
+		 "lines/s", "bytes/s", "underrun", "ack-p50", "ack-p90", "ack-p99", "errors"), flush=True)
+
+	for name, protocol, sender_class, sender_kw in CONFIGS:
+		if args.config and name not in args.config:
+			continue
+		res = bench(name, protocol, sender_class, sender_kw, lines, sim_args)
+		if args.json:
+			print(json.dumps(res), flush=True)
+		else:
+			print("%-16s %7d %8.3f %9.1f %9.1f %9.3f %7.2fms %7.2fms %7.2fms %6d" % (
+			 name, res["lines"], res["time"], res["lines_per_s"], res["bytes_per_s"],
+			 res["underrun"] or 0.0,
+			 res["ack_p50"] * 1e3, res["ack_p90"] * 1e3, res["ack_p99"] * 1e3,
+			 res["errors"],
+			), flush=True)
+
+
+if __name__ == "__main__":
+	ret = main()
+	raise SystemExit(ret)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# g-code job files
+
+"""
+A job file holds the g-code of a file, compiled for a protocol:
+comments are removed, unsupported commands dropped, checksums applied,
+and each line is stored as the bytes to be put on the wire.
+For protocols using line numbers, lines are numbered from 1 in the job.
+
+Layout (little-endian):
+
+- header (64 bytes): magic, version, protocol, line count,
+  offset of the index;
+- wire bytes of all lines, back to back;
+- index: offset of each line in the file (count+1 uint64, the last
+  one being the end of the wire bytes), then its line number
+  in the source file (count uint32).
+
+The file is memory-mapped for sending, so that lines are given out
+as slices of the mapping, and resuming at a source line is a
+binary search in the index.
+"""
+
+import io
+import mmap
+import array
+import bisect
+import struct
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+MAGIC = b"XMCAMJOB"
+VERSION = 1
+_header = struct.Struct("<8sI12sQQ")
+HEADER_SIZE = 64
+
+
+def compile_job(src, dst, protocol, sender_class):
+	"""
+	Compile g-code file src into job file dst
+
+	:param protocol: protocol name, recorded in the job
+	:param sender_class: class whose `encode()` produces the wire bytes
+	:return: number of lines in the job
+	"""
+	from .gcode_sender import clean_line
+
+	offsets = array.array("Q")
+	srclines = array.array("I")
+
+	with io.open(src, "r") as fi, io.open(dst, "wb") as fo:
+		fo.write(b"\0" * HEADER_SIZE)
+		offset = HEADER_SIZE
+		n = 1
+		for idx_line, line in enumerate(fi):
+			line = clean_line(line)
+			if line is None:
+				continue
+			pkt = sender_class.encode(line, n=n)
+			if pkt is None:
+				continue
+			if pkt.startswith(b"N%d " % n):
+				# Not when sent as it is (eg. with its checksum)
+				n += 1
+			offsets.append(offset)
+			srclines.append(idx_line+1)
+			fo.write(pkt)
+			offset += len(pkt)
+		offsets.append(offset)
+
+		pad = -offset % 8
+		fo.write(b"\0" * pad)
+		index_offset = offset + pad
+		offsets.tofile(fo)
+		srclines.tofile(fo)
+
+		fo.seek(0)
+		fo.write(_header.pack(MAGIC, VERSION, protocol.encode(), len(srclines), index_offset))
+
+	return len(srclines)
+
+
+class Job(object):
+	"""
+	Memory-mapped job file
+	"""
+	def __init__(self, path):
+		self._f = io.open(path, "rb")
+		self._mm = mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, protocol, count, index_offset \
+		 = _header.unpack_from(mm)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError("Not a job file: %s" % path)
+		self.protocol = protocol.rstrip(b"\0").decode()
+		self._mv = mv = memoryview(mm)
+		a = index_offset
+		b = a + (count + 1) * 8
+		self._offsets = mv[a:b].cast("Q")
+		self._srclines = mv[b:b+count*4].cast("I")
+
+	@staticmethod
+	def is_job(path):
+		with io.open(path, "rb") as f:
+			return f.read(len(MAGIC)) == MAGIC
+
+	def __len__(self):
+		return len(self._srclines)
+
+	def last_line(self):
+		"""
+		:return: source line number of the last job line
+		"""
+		return self._srclines[-1]
+
+	def source_lines(self):
+		"""
+		:return: source line number of each job line (memoryview)
+		"""
+		return self._srclines
+
+	def wire_bytes(self):
+		"""
+		:return: wire bytes of all the lines, back to back (memoryview)
+		"""
+		return self._mv[self._offsets[0]:self._offsets[-1]]
+
+	def index(self, start_line):
+		"""
+		:return: index of the first job line at or after source line start_line
+		"""
+		return bisect.bisect_left(self._srclines, start_line)
+
+	def packets(self, start_line=1):
+		"""
+		Iterate over (source line number, wire bytes) from start_line;
+		the wire bytes are memoryview slices of the mapping.
+		"""
+		mv = self._mv
+		offsets = self._offsets
+		srclines = self._srclines
+		for idx in range(self.index(start_line), len(srclines)):
+			yield srclines[idx], mv[offsets[idx]:offsets[idx+1]]
+
+	def close(self):
+		self._offsets.release()
+		self._srclines.release()
+		self._mv.release()
+		try:
+			self._mm.close()
+		except BufferError:
+			# Slices are still referenced; the mapping goes with them
+			logger.debug("Job mapping still in use")
+		self._f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
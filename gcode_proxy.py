@@ -6,15 +6,33 @@
 
 """
 This provides a local interface to a remote gcode server.
-Multiple connections to it are allowed (which may be dangerous).
+
+Multiple connections to it are allowed: the first client to send a
+line becomes the controlling client, until it disconnects; lines from
+the other clients (observers) are rejected with an error response.
+Real-time commands (single bytes, eg. grbl `?`, `!`, `~`, 0x18) are
+accepted from any client and sent ahead of buffered lines.
+
+Acknowledgements (`ok`, `error...`) are routed to the client which
+sent the line, in order, other output of the gcode server is sent
+to all clients.
+
+Optionally, grbl status queries (`?`) are coalesced: a query is
+answered from the last status report if it is recent enough,
+otherwise a single query is sent to the gcode server for all the
+clients waiting for a report; the proxy can also poll the status
+periodically, pushing the reports to the clients which queried it.
 """
 
-import socket, select, time, sys, collections, io, os, subprocess
+import socket, time, sys, collections, io, os, subprocess
 import contextlib
+import selectors
+import signal
 import logging
 import shlex
 
 from ..konvini.listen_and_connect import listener_from_url
+from . import gcode_record
 from ..konvini.subprocess import (
  TerminatingPopen,
  fcntl_nonblocking,
@@ -24,6 +42,459 @@ from ..konvini.subprocess import (
 logger = logging.getLogger()
 
 
+class Peer(object):
+	"""
+	Client connection, with a bounded queue of outgoing data
+
+	:param limit: maximum number of bytes queued
+	:param policy: what to do when the queue is full,
+	 "drop" the data or "disconnect" the client
+	"""
+	def __init__(self, sock, name, limit=1<<16, policy="drop", id=0):
+		self.sock = sock
+		self.name = name
+		self.id = id # number in the traffic log
+		self.limit = limit
+		self.policy = policy
+		self.events = 0 # registered selector events
+		self.dropped = 0
+		self.rbuf = bytearray() # incomplete incoming line
+		self.subscribed = False # receives the periodic status reports
+		self._outq = collections.deque()
+		self._queued = 0
+
+	def __str__(self):
+		return self.name
+
+	def pending(self):
+		return self._queued > 0
+
+	def send(self, data):
+		"""
+		Queue data
+
+		:return: False if the client must be disconnected
+		"""
+		if self._queued + len(data) > self.limit:
+			if self.policy == "disconnect":
+				logger.warning("%s is not keeping up, disconnecting", self)
+				return False
+			if self.dropped == 0:
+				logger.warning("%s is not keeping up, dropping data", self)
+			self.dropped += len(data)
+			return True
+		self._outq.append(data)
+		self._queued += len(data)
+		return True
+
+	def flush(self):
+		"""
+		Send as much as the socket takes without blocking
+		"""
+		q = self._outq
+		while q:
+			data = q[0]
+			try:
+				n = self.sock.send(data)
+			except (BlockingIOError, InterruptedError):
+				return
+			self._queued -= n
+			if n < len(data):
+				q[0] = data[n:]
+				return
+			q.popleft()
+		if self.dropped:
+			logger.info("%s has caught up, %d bytes were dropped", self, self.dropped)
+			self.dropped = 0
+
+
+class Upstream(object):
+	"""
+	Non-blocking buffered writer to the gcode server
+	"""
+	def __init__(self, fd, limit=1<<16):
+		self.fd = fd
+		self.limit = limit
+		self._wbuf = bytearray()
+
+	def pending(self):
+		return len(self._wbuf) > 0
+
+	def full(self):
+		return len(self._wbuf) >= self.limit
+
+	def write(self, data):
+		self._wbuf += data
+		self.flush()
+
+	def clear(self):
+		"""
+		Drop what is buffered
+		"""
+		del self._wbuf[:]
+
+	def write_urgent(self, data):
+		"""
+		Write data ahead of what is buffered
+		"""
+		self._wbuf[:0] = data
+		self.flush()
+
+	def flush(self):
+		if not self._wbuf:
+			return
+		try:
+			n = os.write(self.fd, self._wbuf)
+		except (BlockingIOError, InterruptedError):
+			return
+		del self._wbuf[:n]
+
+
+def _echo(name, data, color):
+	name = "[{}]".format(name.center(4*3+3+1+5))
+	try:
+		text = data.decode("utf-8")
+	except UnicodeDecodeError:
+		text = repr(data) + "\n"
+	sys.stdout.write(f"\x1B[{color};1m{name}\x1B[0m {text}")
+	sys.stdout.flush()
+
+
+class Proxy(object):
+	"""
+	Event loop relaying data between the gcode server and the clients.
+
+	Nothing blocks: client output is queued per client (see `Peer`),
+	and gcode server input is buffered (see `Upstream`); when the
+	latter is full, clients are not read until it has drained.
+	"""
+	def __init__(self, server, stdin, stdout,
+	 queue_size=1<<16, overflow="drop", echo=True, realtime=b"",
+	 recorder=None, status_ttl=None, status_poll=None):
+		self.server = server
+		self.recorder = recorder
+		if status_poll and status_ttl is None:
+			status_ttl = 0.0
+		self.status_ttl = status_ttl # None for no coalescing
+		self.status_poll = status_poll
+		self.status_queries = 0 # from clients
+		self.status_requests = 0 # to the gcode server
+		self._status = None # last report
+		self._t_status = 0.0
+		self._t_status_request = None # time of the unanswered query
+		self._status_waiters = []
+		self._t_poll = time.monotonic()
+		self._nb_peers = 0
+		self.queue_size = queue_size
+		self.overflow = overflow
+		self.echo = echo
+		self.realtime = bytes(realtime)
+		self.peers = dict()
+		self.controller = None # controlling client
+		self._owners = collections.deque() # clients of the lines awaiting acknowledgement
+		self._rbuf = bytearray() # incomplete line from the gcode server
+		self._paused = False
+		self._up_events = 0
+		self._done = False
+
+		self.sel = sel = selectors.DefaultSelector()
+		server.setblocking(False)
+		sel.register(server, selectors.EVENT_READ, self._on_accept)
+		self._down_fd = stdout.fileno()
+		sel.register(self._down_fd, selectors.EVENT_READ, self._on_gcode)
+		self.upstream = Upstream(stdin.fileno(), limit=queue_size)
+
+	def run(self):
+		try:
+			while not self._done:
+				timeout = None
+				if self.status_poll:
+					timeout = max(0.0, self._t_poll - time.monotonic())
+				for key, events in self.sel.select(timeout):
+					key.data(key.fileobj, events)
+				if self.status_poll:
+					self._poll()
+		finally:
+			if self.status_ttl is not None:
+				logger.info("Status queries: %d from clients, %d to the gcode server",
+				 self.status_queries, self.status_requests)
+
+	def _on_accept(self, server, events):
+		try:
+			sock, addr = server.accept()
+		except (BlockingIOError, InterruptedError):
+			return
+		sock.setblocking(False)
+		if sock.family in (socket.AF_INET, socket.AF_INET6):
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		try:
+			host, port = sock.getpeername()[:2]
+			name = f"{host}:{port}"
+		except Exception:
+			name = "remote"
+		self._nb_peers += 1
+		peer = Peer(sock, name, limit=self.queue_size, policy=self.overflow, id=self._nb_peers)
+		if self.recorder is not None:
+			self.recorder.record(gcode_record.CONNECT, peer.id, name.encode())
+		logger.info("%s has connected", peer)
+		self.peers[sock] = peer
+		self._update(peer)
+
+	def _on_gcode(self, fd, events):
+		try:
+			data = os.read(fd, 1<<16)
+		except (BlockingIOError, InterruptedError):
+			return
+		if self.recorder is not None:
+			self.recorder.record(gcode_record.FROM_GCODE, 0, data)
+		if self.echo:
+			_echo("gcode", data, 32)
+		if not data:
+			logger.info("gcode server has disconnected")
+			for peer in list(self.peers.values()):
+				self._disconnect(peer)
+			self._done = True
+			return
+		rbuf = self._rbuf
+		rbuf += data
+		end = rbuf.rfind(b"\n") + 1
+		if end == 0:
+			return
+		lines = bytes(rbuf[:end]).splitlines(keepends=True)
+		del rbuf[:end]
+		for line in lines:
+			self._on_gcode_line(line)
+
+	def _on_gcode_line(self, line):
+		if self.status_ttl is not None and line.startswith(b"<"):
+			self._on_status(line)
+			return
+		if line.startswith((b"ok", b"error")):
+			owner = self._owners.popleft() if self._owners else None
+			if owner is None:
+				logger.debug("Unclaimed acknowledgement: %s", line)
+			elif owner.sock in self.peers:
+				self._send(owner, line)
+			return
+		self._broadcast(line)
+
+	def _broadcast(self, line):
+		for peer in list(self.peers.values()):
+			self._send(peer, line)
+
+	def _on_peer(self, sock, events):
+		peer = self.peers[sock]
+		if events & selectors.EVENT_WRITE:
+			try:
+				peer.flush()
+			except OSError as e:
+				logger.info("%s has disconnected (%s)", peer, e)
+				self._disconnect(peer)
+				return
+			self._update(peer)
+		if events & selectors.EVENT_READ:
+			try:
+				data = sock.recv(1<<16)
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError:
+				data = b""
+			if self.echo:
+				_echo(peer.name, data, 33)
+			if not data:
+				logger.info("%s has disconnected", peer)
+				self._disconnect(peer)
+				return
+			self._on_peer_data(peer, data)
+
+	def _on_peer_data(self, peer, data):
+		recorder = self.recorder
+		if recorder is not None:
+			recorder.record(gcode_record.FROM_PEER, peer.id, data)
+		if self.realtime:
+			cmds, data = self._split_realtime(data, peer.rbuf[-1:] in (b"", b"\r"))
+			if cmds:
+				if 0x18 in cmds:
+					# Reset: what was not acknowledged will not be,
+					# nor what was not sent yet
+					self._owners.clear()
+					self._status = None
+					self.upstream.clear()
+				if self.status_ttl is not None and b"?" in cmds:
+					self._status_query(peer)
+					cmds = cmds.replace(b"?", b"")
+				if cmds:
+					if recorder is not None:
+						recorder.record(gcode_record.TO_GCODE, peer.id, cmds)
+					self.upstream.write_urgent(cmds)
+					self._update_upstream()
+
+		rbuf = peer.rbuf
+		rbuf += data
+		end = rbuf.rfind(b"\n") + 1
+		if end == 0:
+			return
+		lines = bytes(rbuf[:end]).splitlines(keepends=True)
+		del rbuf[:end]
+
+		if self.controller is None:
+			self.controller = peer
+			logger.info("%s is now the controlling client", peer)
+		elif self.controller is not peer:
+			logger.warning("%s is not the controlling client, ignoring %d lines", peer, len(lines))
+			self._send(peer, b"error:not the controlling client\n")
+			return
+
+		out = bytearray()
+		for line in lines:
+			if not line.strip():
+				# Controllers differ on whether these are acknowledged
+				continue
+			out += line
+			self._owners.append(peer)
+		if out:
+			if recorder is not None:
+				recorder.record(gcode_record.TO_GCODE, peer.id, out)
+			self._write_upstream(out)
+
+	def _split_realtime(self, data, line_start):
+		"""
+		Separate the real-time command bytes from client data: those
+		outside of lines, as within a line they are part of its content
+
+		:param line_start: whether data starts a line
+		:return: commands, and the rest of data
+		"""
+		realtime = self.realtime
+		if len(data.translate(None, realtime)) == len(data):
+			return b"", data
+		cmds = bytearray()
+		rest = bytearray()
+		for c in data:
+			if line_start and c in realtime:
+				cmds.append(c)
+				continue
+			rest.append(c)
+			line_start = c in (0x0a, 0x0d)
+		return bytes(cmds), bytes(rest)
+
+	def _status_query(self, peer):
+		"""
+		Answer a status query from the cache, or with the next report
+		"""
+		self.status_queries += 1
+		if self.status_poll:
+			peer.subscribed = True
+		now = time.monotonic()
+		if self._status is not None and now - self._t_status <= self.status_ttl:
+			self._send(peer, self._status)
+			return
+		if peer not in self._status_waiters:
+			self._status_waiters.append(peer)
+		self._request_status(now)
+
+	def _request_status(self, now, timeout=1.0):
+		if self._t_status_request is not None and now - self._t_status_request < timeout:
+			# Already asked
+			return
+		self._t_status_request = now
+		self.status_requests += 1
+		if self.recorder is not None:
+			self.recorder.record(gcode_record.TO_GCODE, 0, b"?")
+		self.upstream.write_urgent(b"?")
+		self._update_upstream()
+
+	def _on_status(self, line):
+		self._status = line
+		self._t_status = time.monotonic()
+		self._t_status_request = None
+		waiters = self._status_waiters
+		self._status_waiters = []
+		for peer in waiters:
+			if peer.sock in self.peers:
+				self._send(peer, line)
+		for peer in list(self.peers.values()):
+			if peer.subscribed and peer not in waiters:
+				self._send(peer, line)
+
+	def _poll(self):
+		now = time.monotonic()
+		if now < self._t_poll:
+			return
+		self._t_poll = now + self.status_poll
+		if any(peer.subscribed for peer in self.peers.values()):
+			self._request_status(now)
+
+	def _on_upstream(self, fd, events):
+		self.upstream.flush()
+		self._update_upstream()
+
+	def _send(self, peer, data):
+		if not peer.send(data):
+			self._disconnect(peer)
+			return
+		try:
+			peer.flush()
+		except OSError as e:
+			logger.info("%s has disconnected (%s)", peer, e)
+			self._disconnect(peer)
+			return
+		self._update(peer)
+
+	def _write_upstream(self, data):
+		self.upstream.write(data)
+		self._update_upstream()
+
+	def _update_upstream(self):
+		"""
+		Watch for writability of the gcode server while data is buffered,
+		and stop reading clients while the buffer is full
+		"""
+		upstream = self.upstream
+		events = selectors.EVENT_WRITE if upstream.pending() else 0
+		if events != self._up_events:
+			if events:
+				self.sel.register(upstream.fd, events, self._on_upstream)
+			else:
+				self.sel.unregister(upstream.fd)
+			self._up_events = events
+
+		paused = upstream.full()
+		if paused != self._paused:
+			self._paused = paused
+			logger.debug("Client reads %s", "paused" if paused else "resumed")
+			for peer in self.peers.values():
+				self._update(peer)
+
+	def _update(self, peer):
+		events = 0
+		if not self._paused:
+			events |= selectors.EVENT_READ
+		if peer.pending():
+			events |= selectors.EVENT_WRITE
+		if events == peer.events:
+			return
+		if peer.events == 0:
+			self.sel.register(peer.sock, events, self._on_peer)
+		elif events == 0:
+			self.sel.unregister(peer.sock)
+		else:
+			self.sel.modify(peer.sock, events, self._on_peer)
+		peer.events = events
+
+	def _disconnect(self, peer):
+		if self.recorder is not None:
+			self.recorder.record(gcode_record.DISCONNECT, peer.id, b"")
+		if self.controller is peer:
+			self.controller = None
+			logger.info("%s was the controlling client", peer)
+		if peer.events:
+			self.sel.unregister(peer.sock)
+			peer.events = 0
+		peer.sock.close()
+		del self.peers[peer.sock]
+
+
 def main(argv=None):
 	import argparse
 
@@ -46,6 +517,43 @@ def main(argv=None):
 	 help="Listen address specification",
 	)
 
+	parser.add_argument("--queue-size",
+	 help="maximum number of bytes queued for a client, and for the gcode server",
+	 type=int,
+	 default=1<<16,
+	)
+
+	parser.add_argument("--overflow",
+	 help="what to do with a client which does not keep up with the gcode server output",
+	 choices=("drop", "disconnect"),
+	 default="drop",
+	)
+
+	parser.add_argument("--realtime",
+	 help="real-time command bytes, accepted from any client outside of lines" \
+	  " (as a Python bytes literal, eg. '?!~\\x18' for grbl, the default with" \
+	  " --status-ttl or --status-poll, else none)",
+	)
+
+	parser.add_argument("--quiet",
+	 help="do not echo the traffic on stdout",
+	 action="store_true",
+	)
+
+	parser.add_argument("--status-ttl",
+	 help="coalesce grbl status queries: answer them with the last report if not older than this (s)",
+	 type=float,
+	)
+
+	parser.add_argument("--status-poll",
+	 help="period (s) at which the proxy queries the grbl status, for the clients which query it",
+	 type=float,
+	)
+
+	parser.add_argument("--record",
+	 help="file where the traffic is logged (see gcode_record)",
+	)
+
 
 	try:
 		import argcomplete
@@ -80,8 +588,6 @@ def main(argv=None):
 		for fd in (stdin, stdout):
 			fcntl_nonblocking(fd)
 
-		channel = []
-
 		class Server:
 			def __init__(self, endpoint, handler, bind_and_activate=None):
 				self.socket = endpoint
@@ -90,57 +596,32 @@ def main(argv=None):
 
 		server = server_.socket
 
-		timeout = 1
+		recorder = None
+		if args.record is not None:
+			recorder = stack.enter_context(gcode_record.Recorder(args.record))
+
+		realtime = args.realtime
+		if realtime is None:
+			grbl = args.status_ttl is not None or args.status_poll is not None
+			realtime = r"?!~\x18" if grbl else ""
+
+		proxy = Proxy(server, stdin, stdout,
+		 queue_size=args.queue_size,
+		 overflow=args.overflow,
+		 echo=not args.quiet,
+		 realtime=realtime.encode("latin-1").decode("unicode_escape").encode("latin-1"),
+		 recorder=recorder,
+		 status_ttl=args.status_ttl,
+		 status_poll=args.status_poll,
+		)
+
+		def terminate(signum, frame):
+			raise SystemExit(0)
+
+		signal.signal(signal.SIGTERM, terminate)
 
 		try:
-			while True:
-				rs = [server, stdout] + channel
-				ws = []
-				xs = []
-				rs, ws, xs = select.select(rs, ws, xs, timeout)
-				logger.debug("rs=%s ws=%s xs=%s", rs, ws, xs)
-				for r in rs:
-					if r is server:
-						clientsock, clientaddr = r.accept()
-						channel.append(clientsock)
-						break
-
-					elif r is stdout:
-						data = r.read(4096)
-						name = "[{}]".format("gcode".center(4*3+3+1+5))
-
-						try:
-							text = data.decode("utf-8")
-						except:
-							text = repr(data) + "\n"
-
-						sys.stdout.write(f"\x1B[32;1m{name}\x1B[0m {text}")
-						sys.stdout.flush()
-						if not data:
-							logger.info("gcode server has disconnected")
-							for peer in channel:
-								peer.close()
-							return
-						for peer in channel:
-							peer.send(data)
-
-					elif r in channel:
-						data = r.recv(4096)
-						try:
-							host, port = r.getpeername()
-							endpoint = f"{host}:{port}"
-						except:
-							endpoint = "remote"
-						name = "[{}]".format(endpoint.center(4*3+3+1+5))
-						sys.stdout.write(f"\x1B[33;1m{name}\x1B[0m {data.decode('utf-8')}")
-						sys.stdout.flush()
-						if data:
-							stdin.write(data)
-							stdin.flush()
-						else:
-							logger.info("%s has disconnected", endpoint)
-							r.close()
-							channel.remove(r)
+			proxy.run()
 		except KeyboardInterrupt:
 			logger.info("Bye")
 
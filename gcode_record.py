@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# PYTHON_ARGCOMPLETE_OK
+# g-code traffic recording and replay
+
+"""
+Binary log of the traffic going through gcode_proxy, and tools to
+dump it and to replay it.
+
+Layout (little-endian): magic and version, then records made of
+a header (kind, peer, monotonic timestamp in ns, length) followed by
+the bytes. Peer 0 is the gcode server; clients are numbered from 1
+in order of connection, and their address is recorded on connection.
+
+The replay writes the bytes of one direction on stdout with their
+original timing (possibly sped up), so that eg. a recorded gcode
+server can be used as the stdio command of gcode_proxy or gcode_sender.
+"""
+
+import sys, io, os
+import time
+import struct
+import selectors
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+MAGIC = b"XMCAMREC"
+VERSION = 1
+_header = struct.Struct("<8sI")
+_record = struct.Struct("<BHqI")
+
+# record kinds
+FROM_GCODE = 0 # read from the gcode server
+TO_GCODE = 1 # written to the gcode server, on behalf of peer
+FROM_PEER = 2 # read from a client
+CONNECT = 3 # client connection, the bytes are its address
+DISCONNECT = 4 # client disconnection
+
+KIND_NAMES = {
+ FROM_GCODE: "from-gcode",
+ TO_GCODE: "to-gcode",
+ FROM_PEER: "from-peer",
+ CONNECT: "connect",
+ DISCONNECT: "disconnect",
+}
+
+
+class Recorder(object):
+	"""
+	Writer of a traffic log
+
+	:param flush_interval: maximum time (s) records stay in the buffer
+	"""
+	def __init__(self, path, bufsize=1<<20, flush_interval=1.0):
+		self._f = io.open(path, "wb", buffering=bufsize)
+		self._f.write(_header.pack(MAGIC, VERSION))
+		self._flush_interval = int(flush_interval * 1e9)
+		self._t_flush = time.monotonic_ns() + self._flush_interval
+
+	def record(self, kind, peer, data):
+		f = self._f
+		t = time.monotonic_ns()
+		f.write(_record.pack(kind, peer, t, len(data)))
+		f.write(data)
+		if t >= self._t_flush:
+			f.flush()
+			self._t_flush = t + self._flush_interval
+
+	def close(self):
+		self._f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
+
+
+def records(path):
+	"""
+	Iterate over (kind, peer, timestamp (ns), bytes) of a traffic log
+	"""
+	with io.open(path, "rb") as f:
+		hdr = f.read(_header.size)
+		if len(hdr) < _header.size:
+			raise ValueError("Not a traffic log: %s" % path)
+		magic, version = _header.unpack(hdr)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError("Not a traffic log: %s" % path)
+		size = _record.size
+		while True:
+			hdr = f.read(size)
+			if len(hdr) < size:
+				# A truncated record can be left by a crash
+				return
+			kind, peer, t, length = _record.unpack(hdr)
+			data = f.read(length)
+			if len(data) < length:
+				return
+			yield kind, peer, t, data
+
+
+def dump(path, out=sys.stdout):
+	t0 = None
+	names = {0: "gcode"}
+	for kind, peer, t, data in records(path):
+		if t0 is None:
+			t0 = t
+		if kind == CONNECT:
+			names[peer] = data.decode("utf-8", "replace")
+		out.write("%12.6f %-10s %-21s %r\n" % ((t - t0) * 1e-9,
+		 KIND_NAMES.get(kind, kind), names.get(peer, peer), data))
+
+
+def replay(path, kinds=(FROM_GCODE,), speed=1.0, fd_out=1, fd_in=0):
+	"""
+	Write the bytes of the records of some kinds to fd_out, in order
+
+	:param speed: time scale factor, 0 for no waiting
+	:param fd_in: file descriptor read (and discarded) meanwhile,
+	 so that the other end is not blocked
+	:return: number of bytes written
+	"""
+	os.set_blocking(fd_out, False)
+	sel = selectors.DefaultSelector()
+	if fd_in is not None:
+		os.set_blocking(fd_in, False)
+		try:
+			sel.register(fd_in, selectors.EVENT_READ)
+		except PermissionError:
+			# Regular file (eg. /dev/null), nothing will block
+			pass
+
+	def wait(deadline):
+		while True:
+			timeout = deadline - time.monotonic()
+			if timeout <= 0:
+				return
+			if not sel.get_map():
+				time.sleep(timeout)
+				return
+			for key, events in sel.select(timeout):
+				try:
+					data = os.read(key.fd, 1<<16)
+				except BlockingIOError:
+					continue
+				if not data:
+					sel.unregister(key.fd)
+
+	nb = 0
+	t_rec0 = None
+	t0 = time.monotonic()
+	for kind, peer, t, data in records(path):
+		if kind not in kinds:
+			continue
+		if t_rec0 is None:
+			t_rec0 = t
+		if speed:
+			wait(t0 + (t - t_rec0) * 1e-9 / speed)
+		view = memoryview(data)
+		while view:
+			try:
+				n = os.write(fd_out, view)
+			except BlockingIOError:
+				n = 0
+			if n < len(view):
+				# Output is full, keep reading meanwhile
+				wait(time.monotonic() + 1e-3)
+			view = view[n:]
+		nb += len(data)
+	sel.close()
+	return nb
+
+
+def main(args=None):
+
+	if args is None:
+		args = sys.argv[1:]
+
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	 description="g-code traffic log tools",
+	)
+
+	parser.add_argument("--log-level",
+	 default="WARNING",
+	 help="Logging level (eg. INFO, see Python logging docs)",
+	)
+
+	subparsers = parser.add_subparsers(
+	 help='the command; type "%s COMMAND -h" for command-specific help' % sys.argv[0],
+	 dest='command',
+	)
+
+	parser_dump = subparsers.add_parser(
+	 'dump',
+	 help="print the records of a traffic log",
+	)
+
+	parser_dump.add_argument("filename",
+	)
+
+	parser_replay = subparsers.add_parser(
+	 'replay',
+	 help="write the recorded bytes of a direction on stdout, with their timing",
+	)
+
+	parser_replay.add_argument("--direction",
+	 help="what to replay: gcode server output, or what was written to the gcode server",
+	 choices=("from-gcode", "to-gcode"),
+	 default="from-gcode",
+	)
+
+	parser_replay.add_argument("--speed",
+	 help="time scale factor (eg. 10 for 10 times faster), 0 for as fast as possible",
+	 type=float,
+	 default=1.0,
+	)
+
+	parser_replay.add_argument("filename",
+	)
+
+	try:
+		import argcomplete
+		argcomplete.autocomplete(parser)
+	except:
+		pass
+
+	args = parser.parse_args(args)
+
+	logging.basicConfig(
+	 datefmt="%Y%m%dT%H%M%S",
+	 level=getattr(logging, args.log_level),
+	 format="%(asctime)-15s %(name)s %(levelname)s %(message)s"
+	)
+
+	if args.command == "dump":
+		dump(args.filename)
+	elif args.command == "replay":
+		kind = FROM_GCODE if args.direction == "from-gcode" else TO_GCODE
+		t0 = time.monotonic()
+		nb = replay(args.filename, kinds=(kind,), speed=args.speed)
+		logger.info("Replayed %d bytes in %.3f s", nb, time.monotonic() - t0)
+	else:
+		parser.print_help()
+		return 1
+
+
+if __name__ == "__main__":
+	ret = main()
+	raise SystemExit(ret)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# g-code resume index
+
+"""
+A resume index holds snapshots of the modal state of a g-code file
+(position, units, modes, work offsets, feed rate, spindle, coolant...)
+every K lines, so that the state before any line is obtained by
+replaying at most K lines from the previous snapshot.
+
+It is built once per file, and cached next to it (with .xmresume
+suffix, as a numpy .npz archive), keyed by the hash of its content.
+
+Resuming at a line then consists in sending a preamble which restores
+the state (units, modes, work offsets, spindle and coolant), with a
+rapid at a safe height to above the resume point, and a plunge to it.
+"""
+
+import io, os
+import mmap
+import hashlib
+import logging
+
+import numpy as np
+
+from .milling_xyz.program import Program
+
+
+logger = logging.getLogger(__name__)
+
+
+VERSION = 2
+SUFFIX = ".xmresume"
+_fields = ("motion", "absolute", "inch", "plane", "feed", "inverse_time",
+ "e_absolute", "e", "speed", "tool", "wcs", "spindle", "coolant", "extruder")
+
+
+def content_hash(data):
+	"""
+	:return: hex digest of bytes-like data
+	"""
+	h = hashlib.blake2b(digest_size=16)
+	mv = memoryview(data)
+	for a in range(0, len(mv), 1 << 24):
+		h.update(mv[a:a + (1 << 24)])
+	mv.release()
+	return h.hexdigest()
+
+
+def build_index(data, every=10000, chunk_size=1<<22):
+	"""
+	Snapshot the modal state every `every` lines
+
+	:param data: bytes-like g-code
+	:return: dict of arrays over the snapshots: `line` (number of lines
+	 before it), `offset` (byte offset of that line), `z_max` (highest
+	 known Z before it, NaN if none), `pos` (n, 3), and the state fields
+	"""
+	snapshots = [(0, 0, np.nan, Program(b"").state)]
+	state = snapshots[0][3]
+	z_max = np.nan
+	nb_lines = 0
+	n = len(data)
+	a = 0
+	while a < n:
+		b = min(a + chunk_size, n)
+		if b < n:
+			end = data.rfind(b"\n", a, b)
+			if end < 0:
+				end = data.find(b"\n", b)
+			b = n if end < 0 else end + 1
+		chunk = np.frombuffer(data, dtype=np.uint8, count=b-a, offset=a)
+		ends = np.flatnonzero(chunk == 10) + 1
+		if len(ends) == 0 or ends[-1] != b - a:
+			ends = np.append(ends, b - a)
+		# Lines of the chunk before each snapshot in it, and at its end
+		cuts = np.arange(every - nb_lines % every, len(ends) + 1, every).tolist()
+		if not cuts or cuts[-1] != len(ends):
+			cuts.append(len(ends))
+		prev = 0
+		for cut in cuts:
+			block = Program(bytes(data[a + prev:a + ends[cut-1]]), state=state, chunk_size=n)
+			state = block.state
+			z_max = np.fmax(z_max, np.fmax.reduce(block.z, initial=np.nan))
+			if (nb_lines + cut) % every == 0:
+				snapshots.append((nb_lines + cut, a + ends[cut-1], z_max, dict(state)))
+			prev = ends[cut-1]
+		nb_lines += len(ends)
+		a = b
+
+	res = dict(
+	 line=np.array([s[0] for s in snapshots], dtype=np.int64),
+	 offset=np.array([s[1] for s in snapshots], dtype=np.int64),
+	 z_max=np.array([s[2] for s in snapshots]),
+	 pos=np.array([s[3]["pos"] for s in snapshots], dtype=np.float64).reshape(-1, 3),
+	)
+	for name in _fields:
+		res[name] = np.array([s[3][name] for s in snapshots])
+	return res
+
+
+def _number(v):
+	s = ("%.4f" % v).rstrip("0").rstrip(".")
+	return "0" if s == "-0" else s
+
+
+class ResumeIndex(object):
+	"""
+	Modal state checkpoints of a g-code file
+
+	:param path: g-code file
+	:param every: number of lines between snapshots
+	:param cache: whether to use (and write) the cache next to the file
+	"""
+	def __init__(self, path, every=10000, cache=True):
+		with io.open(path, "rb") as f:
+			if f.seek(0, io.SEEK_END) == 0:
+				self._data = b""
+			else:
+				self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.hash = content_hash(self._data)
+		self.every = every
+		cache_path = path + SUFFIX
+
+		self._index = None
+		if cache and os.path.exists(cache_path):
+			self._index = self._load(cache_path)
+		if self._index is None:
+			logger.info("Building resume index of %s", path)
+			self._index = build_index(self._data, every=every)
+			if cache:
+				try:
+					self._save(cache_path)
+				except OSError as e:
+					logger.warning("Could not cache resume index in %s: %s", cache_path, e)
+
+	def _load(self, path):
+		try:
+			with np.load(path) as f:
+				if int(f["version"]) != VERSION or str(f["hash"]) != self.hash \
+				 or int(f["every"]) != self.every:
+					logger.info("Resume index %s is outdated", path)
+					return None
+				return dict((k, f[k]) for k in f.files if k not in ("version", "hash", "every"))
+		except (OSError, ValueError, KeyError) as e:
+			logger.warning("Could not read resume index %s: %s", path, e)
+			return None
+
+	def _save(self, path):
+		tmp = path + ".tmp"
+		with io.open(tmp, "wb") as f:
+			np.savez(f, version=VERSION, hash=self.hash, every=self.every, **self._index)
+		os.replace(tmp, path)
+
+	def __len__(self):
+		"""
+		:return: number of snapshots
+		"""
+		return len(self._index["line"])
+
+	def state(self, line):
+		"""
+		:param line: line number (from 1)
+		:return: modal state before the line (as `Program.state`),
+		 and the highest known Z before it (NaN if none)
+		"""
+		index = self._index
+		before = line - 1
+		if before < 0:
+			raise ValueError("Invalid line number %d" % line)
+		c = int(np.searchsorted(index["line"], before, side="right")) - 1
+		state = dict((name, index[name][c].item()) for name in _fields)
+		state["pos"] = index["pos"][c].tolist()
+
+		data = self._data
+		a = b = int(index["offset"][c])
+		for _ in range(before - int(index["line"][c])):
+			b = data.find(b"\n", b) + 1
+			if b == 0:
+				raise ValueError("Line %d is past the end of the file" % line)
+		replay = Program(bytes(data[a:b]), state=state)
+		z_max = np.fmax(index["z_max"][c], np.fmax.reduce(replay.z, initial=np.nan))
+		return replay.state, float(z_max)
+
+	def preamble(self, line, safe_z=None, plunge_feed=None, dwell=0.0, extruder=True):
+		"""
+		Lines restoring the state before a line, and going to the
+		position where it starts
+
+		:param line: line number (from 1)
+		:param safe_z: height (mm, program coordinates) of the rapid
+		 to above the resume point, by default the highest Z before it
+		:param plunge_feed: feed rate (mm/min) of the plunge to the resume
+		 point, by default the one in effect
+		:param dwell: delay (s) for the spindle to get to speed
+		:param extruder: whether the extruder state (M82/M83, G92 E) is to
+		 be restored, if the program uses it (controllers without
+		 extruder reject these)
+		:return: list of g-code lines
+		"""
+		state, z_max = self.state(line)
+		x, y, z = state["pos"]
+		if np.isnan(state["pos"]).any():
+			raise ValueError("Position before line %d is unknown" % line)
+		if state["motion"] > 3:
+			raise ValueError("Line %d is in a canned cycle" % line)
+		if safe_z is None:
+			safe_z = z_max
+		safe_z = float(np.fmax(safe_z, z))
+		if plunge_feed is None:
+			if state["inverse_time"] or np.isnan(state["feed"]):
+				raise ValueError("No feed rate (mm/min) in effect before line %d" \
+				 ", a plunge feed rate is needed" % line)
+			plunge_feed = state["feed"]
+
+		# Power-on modes are not repeated, as not all firmwares know them
+		modes = ["G21", "G90"]
+		if state["plane"] != 0:
+			modes.append("G%d" % (17 + state["plane"]))
+		if state["inverse_time"]:
+			modes.append("G94")
+		if state["wcs"] != 540:
+			modes.append("G%s" % _number(state["wcs"] / 10))
+		res = [" ".join(modes), "G0 Z%s" % _number(safe_z)]
+		if state["spindle"] != 5:
+			if np.isnan(state["speed"]):
+				res.append("M%d" % state["spindle"])
+			else:
+				res.append("M%d S%s" % (state["spindle"], _number(state["speed"])))
+		if state["coolant"] & 1:
+			res.append("M7")
+		if state["coolant"] & 2:
+			res.append("M8")
+		if dwell and state["spindle"] != 5:
+			res.append("G4 P%s" % _number(dwell))
+		res.append("G0 X%s Y%s" % (_number(x), _number(y)))
+		res.append("G1 Z%s F%s" % (_number(z), _number(plunge_feed)))
+
+		# Modes of the program
+		if extruder and state["extruder"] and (not state["e_absolute"] or state["e"] != 0):
+			res.append("M%d" % (82 if state["e_absolute"] else 83))
+			res.append("G92 E%s" % _number(state["e"]))
+		modes = list()
+		if state["inch"]:
+			modes.append("G20")
+		if not state["absolute"]:
+			modes.append("G91")
+		if state["inverse_time"]:
+			modes.append("G93")
+		if state["motion"] in (0, 1):
+			modes.append("G%d" % state["motion"])
+		elif state["motion"] >= 0:
+			logger.warning("Line %d relies on the G%d mode, which is not restored",
+			 line, state["motion"])
+		feed = state["feed"]
+		if not np.isnan(feed):
+			if state["inch"] and not state["inverse_time"]:
+				feed /= 25.4
+			modes.append("F%s" % _number(feed))
+		if modes:
+			res.append(" ".join(modes))
+		return res
+
+	def close(self):
+		if isinstance(self._data, mmap.mmap):
+			self._data.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
@@ -11,9 +11,14 @@ import collections
 import logging
 import contextlib
 import shlex
+import selectors
+import asyncio
+import functools
+import operator
 
 from ..konvini.subprocess import (
  TerminatingPopen,
+ fcntl_nonblocking,
 )
 
 logger = logging.getLogger(__name__)
@@ -22,339 +27,1017 @@ class Pipe(object):
 	"""
 	TCP connector
 	"""
-	def __init__(self, stdin=None, stdout=None, endline=b"\n"):
+	def __init__(self, stdin=None, stdout=None, endline=b"\n", readsize=65536):
 		self.stdin = stdin
 		self.stdout = stdout
 		self.verbose = True
 		self._endline = endline
 		logger.debug("endline: “%s”", endline)
+		self._chunk = bytearray(readsize)
+		self._rbuf = bytearray()
+		self._lines = collections.deque()
+		self._selector = None
+		if stdout is not None:
+			fcntl_nonblocking(stdout)
+			self._selector = selectors.DefaultSelector()
+			self._selector.register(stdout, selectors.EVENT_READ)
+
+	def _read(self):
+		"""
+		Read whatever is available and split out the complete lines
+		"""
+		try:
+			n = os.readv(self.stdout.fileno(), [self._chunk])
+		except BlockingIOError:
+			return
+		if n == 0:
+			raise EOFError("gcode server has disconnected")
+
+		buf = self._rbuf
+		endline = self._endline
+		# Only look for an end of line in the new data (and its seam)
+		pos = max(0, len(buf) - len(endline) + 1)
+		buf += memoryview(self._chunk)[:n]
+		start = 0
+		while True:
+			idx = buf.find(endline, pos)
+			if idx < 0:
+				break
+			self._lines.append(buf[start:idx].decode("utf-8"))
+			start = pos = idx + len(endline)
+		if start:
+			del buf[:start]
 
 	def readline(self, timeout=None):
 		"""
+		Return the next line, without its end of line,
+		or None if none was received within timeout (in seconds).
 		"""
+		if timeout is not None:
+			deadline = time.monotonic() + timeout
 
-		buf = io.BytesIO()
-		while not buf.getvalue().endswith(self._endline):
-			data = self.stdout.read(1)
-			buf.write(data)
-		return buf.getvalue()[:-len(self._endline)].decode("utf-8")
+		while not self._lines:
+			if timeout is None:
+				remaining = None
+			else:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return None
+			if self._selector.select(remaining):
+				self._read()
 
-	def sendline(self, l):
-		pkt = l.encode() + self._endline
+		return self._lines.popleft()
+
+	def read_lines(self):
+		"""
+		Return the complete lines that can be obtained without blocking
+		"""
+		self._read()
+		lines = self._lines
+		self._lines = collections.deque()
+		return lines
+
+	def write(self, pkt):
 		x = self.stdin.write(pkt)
 		self.stdin.flush()
-		return x # len(pkt)
+		return x
 
+	def sendline(self, l):
+		pkt = l.encode() + self._endline
+		return self.write(pkt) # len(pkt)
 
-class SenderGrbl(object):
+	def close(self):
+		if self._selector is not None:
+			self._selector.close()
+			self._selector = None
+
+
+def _checksum(data):
 	"""
+	RepRap-style checksum (XOR of the bytes)
 	"""
-	queue_full_retry = 0.3
+	return functools.reduce(operator.xor, data, 0) & 0xff
 
-	def __init__(self, pipe=None, stdin=None, stdout=None, version="1.1"):
-		if pipe is None:
-			self.pipe = pipe = Pipe(stdin=stdin, stdout=stdout, endline=b"\r\n")
-		# Initialize
-		self.verbose = verbose = True
-		self._version = version
-		self._bufsize = 128 - 30 # keep room for values entered manually out of band
-		self._bufavail = self._bufsize
 
-	def open(self, initial=True):
-		p = self.pipe
-		if initial:
-			logger.info("Initializing grbl...")
-			p.sendline("")
-			p.sendline("")
-			while True:
-				res = p.readline()
-				if res is None:
-					break
-				logger.info("\x1B[32m%s\x1B[0m", res)
+def _shorten_reprap(line):
+	"""
+	Prepare a line for RepRap-style firmwares
 
+	:return: the line with its checksum, or None if it is not to be sent
+	"""
+	line = _strip_reprap(line)
+	if line is None:
+		return
 
-	def queue(self, line):
-		p = self.pipe
+	if line.startswith("M117"):
+		return line
 
-		if line != "?":
-			if self._version == "0.9":
-				can_send = lambda x: x["cmdbuf"] < 10 and x["rxbuf"] < 100
-			elif self._version == "1.1":
-				can_send = lambda x: x["cmdbuf"] > 2 and x["rxbuf"] > (5 + len(line))
-			self.wait_status(condition=can_send, poll_delay=self.queue_full_retry)
+	if "*" in line:
+		return line
 
-		logger.info("\x1B[33mNow sending %s\x1B[0m", line)
-		p.sendline(line)
+	return "%s *%d" % (line, _checksum(("%s " % line).encode("utf-8")))
 
 
-		while True:
-			res = p.readline()
-			#if res == "":
-			#	print("\x1B[31mEmpty line?\x1B[0m")
-			#	continue
-			if res is None:
-				time.sleep(0.1)
-				continue
-			if re.match(r"\[.*\]", res):
-				self.last_notice = res
-				logger.info("\x1B[32m%s\x1B[0m", res)
-				continue
-			if re.match(r"<.*>", res):
-				self.last_status = res
-				logger.info("\x1B[32m%s\x1B[0m", res)
-				continue
-			break
-
-		logger.info("\x1B[32m%s\x1B[0m", res)
-		assert res == "ok", res
-
-		if line == "M2":
-			"""
-			grbl outputs extra info when M2 is said
-			"""
-			logger.info("\x1B[31mM2\x1B[0m")
-			x = p.readline()
-			logger.info("\x1B[32m%s\x1B[0m", x)
-			x = p.readline()
-			logger.info("\x1B[32m%s\x1B[0m", x)
-			x = p.readline()
-			logger.info("\x1B[32m%s\x1B[0m", x)
-			x = p.readline()
-			logger.info("\x1B[32m%s\x1B[0m", x)
-
-		return res
-
-	def wait_status(self, condition=None, poll_delay=1.0):
-		if condition is None:
-			condition = lambda x: x["cmdbuf"] == 0
+def _strip_reprap(line):
+	"""
+	:return: the line without comment, or None if it is not supported
+	"""
+	line = line.split(";")[0].rstrip()
 
-		while True:
-			status = self.status()
-			if condition(status):
-				break
-			time.sleep(poll_delay)
+	if line in (
+	 "G21",
+	 "G90",
+	 "M82",
+	 "M600", # Filament change
+	 ):
+		# Unsupported commands
+		return
+	return line
 
-	def status(self):
-		p = self.pipe
-		self.last_status = None
-		res = self.queue("?")
-		while self.last_status is None:
-			res = p.readline()
-			if res is None:
-				time.sleep(0.1)
-				continue
-			if re.match(r"\[.*\]", res):
-				self.last_notice = res
-				logger.info("\x1B[32m%s\x1B[0m", res)
-				continue
-			if re.match(r"<.*>", res):
-				self.last_status = res
-				logger.info("\x1B[32m%s\x1B[0m", res)
-				continue
 
-		if self._version == "1.1":
-			m = re.match(r"<(?P<state>[A-Za-z:0-9]+)(\|((MPos:(?P<mpos>[-\d.,]+))|(WPos:(?P<wpos>[-\d.,]+))|(WCO:[-\d.,]+)|(Bf:(?P<cmdbuf>\d+),(?P<rxbuf>\d+))|(Ln:(?P<ln>\d+))|(F:(?P<feed1>\d+))|(FS:(?P<feed2>\d+),(?P<sfeed>\d+))|(Pn:(?P<pins>\S+))|(Ov:(?P<ovf>\S+),(?P<ovr>\S+),(?P<ovs>\S+))|(\|A:\S+)))+>", self.last_status)
-		elif self._version == "0.9":
-			m = re.match(r"<(?P<state>\S+),MPos:(?P<mpos>\S+),WPos:(?P<wpos>\S+),Buf:(?P<cmdbuf>\S+),RX:(?P<rxbuf>\S+),Ln:(?P<ln>\S+),F:(?P<feed>\S+)\.>", self.last_status)
+_re_checksummed = re.compile(r".*\*\d+")
+_re_line_number = re.compile(rb"N(\d+)")
+
+def clean_line(line):
+	"""
+	Prepare a line of a g-code file for sending
+
+	:return: the line without comments, or None if there is nothing to send
+	"""
+	line = line.rstrip()
+	if _re_checksummed.match(line):
+		""" Don't touch """
+		return line
+	if line.startswith("%"):
+		return
+	if line.startswith("("):
+		return
+	line = line.split(";")[0].strip()
+	if line == "":
+		return
+	return line
+
+
+class _Line(object):
+	"""
+	Line queued to or in flight on the controller
+	"""
+	__slots__ = ("pkt", "line", "ln", "n", "gen", "t_sent", "resend", "serial")
 
-		assert m is not None
+	def __init__(self, pkt, line=None, n=None, ln=None):
+		self.pkt = pkt # bytes (or memoryview) including end of line
+		self.line = line
+		self.ln = ln # line number in the source file
+		self.n = n # line number, for protocols using them
+		self.gen = 0
+		self.t_sent = None
+		self.resend = False
+		self.serial = False # to be sent with nothing else in flight
 
-		#print(m.groups())
+	def __str__(self):
+		if self.line is not None:
+			return self.line
+		return bytes(self.pkt).rstrip().decode()
 
-		res = dict(
-		 state=m.group("state"),
-		 cmdbuf=int(m.group("cmdbuf")),
-		 rxbuf=int(m.group("rxbuf")),
-		)
 
-		return res
+class Sender(object):
+	"""
+	asyncio sender engine, which the protocols subclass.
+
+	A reader task parses every incoming line and dispatches it to
+	`_on_line()`; a writer task feeds the queued lines to the controller
+	as soon as the protocol flow control (`_can_send()`) allows.
 
+	Lines sent and not yet acknowledged are kept in `_pending`; lines
+	to be sent again (as requested by the controller) are put in
+	`_replay`, which has priority over the queued lines.
+	Waits are done on an event pulsed whenever something is received,
+	so that no fixed delay is involved.
 
-class SenderTrinus(object):
+	Use as an asynchronous context manager, to run the tasks.
 
-	def __init__(self, pipe=None, stdin=None, stdout=None):
+	If a `Telemetry` is given, it is updated as lines are sent
+	and acknowledged.
+
+	If `_ack_timeout` is set (s), a watchdog calls `_on_ack_timeout()`
+	when the oldest line in flight has had no acknowledgement within
+	that time of the previous one (`_t_ack`).
+	"""
+	endline = b"\n"
+	open_timeout = 1.0
+	queue_depth = 64 # lines buffered ahead of the writer
+
+	def __init__(self, pipe=None, stdin=None, stdout=None, telemetry=None):
 		if pipe is None:
-			self.pipe = pipe = Pipe(stdin=stdin, stdout=stdout, endline=b"\n")
+			pipe = Pipe(stdin=stdin, stdout=stdout, endline=self.endline)
+		self.pipe = pipe
+		self.telemetry = telemetry
 		# Initialize
 		self.verbose = verbose = True
-		self._last_notices = collections.deque()
+		self._pending = collections.deque()
+		self._replay = collections.deque()
+		self._lines = collections.deque()
+		self._error = None
+		self._tasks = []
+		self._changed = None
+		self._ack_timeout = None
+		self._t_ack = None
+		self.on_ack = None # called with each line entry as it is acknowledged
+
+	@classmethod
+	def encode(cls, line, n=None):
+		"""
+		:param n: line number, for protocols using them
+		:return: bytes to send for line, or None if it is not to be sent
+		"""
+		return line.encode() + cls.endline
+
+	async def __aenter__(self):
+		self._changed = asyncio.Event()
+		self._tasks = [
+		 asyncio.create_task(self._read_loop()),
+		 asyncio.create_task(self._write_loop()),
+		]
+		if self._ack_timeout:
+			self._tasks.append(asyncio.create_task(self._ack_watchdog()))
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, tb):
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._tasks = []
+
+	def _notify(self):
+		"""
+		Wake up everything waiting for a state change
+		"""
+		ev, self._changed = self._changed, asyncio.Event()
+		ev.set()
 
-	def open(self, initial=True):
+	async def _ack_watchdog(self):
+		try:
+			while True:
+				if not self._pending:
+					await self._wait_for(lambda: self._pending)
+					continue
+				entry = self._pending[0]
+				deadline = max(entry.t_sent, self._t_ack or 0) + self._ack_timeout
+				now = time.monotonic()
+				if now >= deadline:
+					self._on_ack_timeout(entry)
+					self._notify()
+					continue
+				await asyncio.sleep(deadline - now)
+		except Exception as e:
+			self._fail(e)
+
+	def _on_ack_timeout(self, entry):
+		"""
+		The oldest line in flight was not acknowledged in time
+		"""
+		raise RuntimeError("No acknowledgement of %s in %s s" % (entry, self._ack_timeout))
+
+	def _fail(self, exc):
+		if self._error is None:
+			self._error = exc
+			if self.telemetry is not None:
+				self.telemetry.error(str(exc))
+		self._notify()
+
+	async def _wait_for(self, predicate, timeout=None):
+		"""
+		Wait until predicate() is true
+
+		:return: False on timeout
+		"""
+		while True:
+			if self._error is not None:
+				raise self._error
+			if predicate():
+				return True
+			if timeout is None:
+				await self._changed.wait()
+				continue
+			try:
+				await asyncio.wait_for(self._changed.wait(), timeout)
+			except asyncio.TimeoutError:
+				return False
+
+	async def _read_loop(self):
+		loop = asyncio.get_running_loop()
+		p = self.pipe
+		fd = p.stdout.fileno()
+		readable = asyncio.Event()
+		loop.add_reader(fd, readable.set)
+		try:
+			while True:
+				await readable.wait()
+				readable.clear()
+				for res in p.read_lines():
+					self._on_line(res)
+				self._notify()
+		except Exception as e:
+			self._fail(e)
+		finally:
+			loop.remove_reader(fd)
+
+	def _next(self):
+		"""
+		:return: the next line to send, if any
+		"""
+		if self._replay:
+			return self._replay[0]
+		if self._lines:
+			return self._lines[0]
+
+	async def _write_loop(self):
+		telemetry = self.telemetry
+		try:
+			while True:
+				await self._wait_for(lambda: self._next() is not None)
+				if not self._can_send(self._next()):
+					t0 = time.monotonic()
+					await self._wait_for(lambda: self._next() is not None and self._can_send(self._next()))
+					if telemetry is not None:
+						telemetry.stalled(time.monotonic() - t0)
+				entry = self._next()
+				await self._before_send(entry)
+				if self._replay and self._replay[0] is entry:
+					self._replay.popleft()
+				else:
+					self._lines.popleft()
+				self._send(entry)
+				self._notify()
+		except Exception as e:
+			self._fail(e)
+
+	def _can_send(self, entry):
+		"""
+		Flow control; by default, one line at a time
+		"""
+		return not self._pending
+
+	async def _before_send(self, entry):
+		pass
+
+	def _fill(self):
+		"""
+		:return: how much of the controller buffer is in use
+		"""
+		return len(self._pending)
+
+	def _send(self, entry):
+		logger.debug("\x1B[33mNow sending %s\x1B[0m", entry)
+		self.pipe.write(entry.pkt)
+		entry.t_sent = time.monotonic()
+		self._pending.append(entry)
+		if self.telemetry is not None:
+			self.telemetry.sent(entry, self._fill())
+
+	def _ack(self):
+		"""
+		Retire the oldest line in flight
+
+		:return: the line entry, or None if nothing was in flight
+		"""
+		if not self._pending:
+			logger.debug("Acknowledgement with nothing in flight")
+			return
+		entry = self._pending.popleft()
+		if self.telemetry is not None:
+			self.telemetry.acked(entry, time.monotonic())
+		if self.on_ack is not None:
+			self.on_ack(entry)
+		return entry
+
+	def _on_line(self, res):
+		raise NotImplementedError()
+
+	async def open(self, initial=True):
 		p = self.pipe
 		if initial:
-			logger.info("Initializing TODO...")
+			logger.info("Initializing...")
 			p.sendline("")
 			p.sendline("")
+			# Responses are logged by the reader; wait until it's quiet
 			while True:
-				res = p.readline()
-				if res is None:
+				ev = self._changed
+				try:
+					await asyncio.wait_for(ev.wait(), self.open_timeout)
+				except asyncio.TimeoutError:
 					break
-				logger.info("\x1B[32m%s\x1B[0m", res)
 
-	def queue(self, line):
-		p = self.pipe
+	async def queue(self, line, ln=None):
+		"""
+		Queue a line for sending; returns as soon as it is queued
+
+		:param ln: line number in the source file
+		"""
+		if self._error is not None:
+			raise self._error
+		pkt = self.encode(line)
+		if pkt is None:
+			return
+		await self._put(_Line(pkt, line, ln=ln))
 
-		def shorten(line):
-			line = line.split(";")[0].rstrip()
+	async def queue_packet(self, pkt, ln=None):
+		"""
+		Queue bytes already prepared with `encode()` (eg. from a job file)
+		"""
+		await self._put(_Line(pkt, ln=ln))
 
-			if line in (
-			 "G21",
-			 "G90",
-			 "M82",
-			 "M600", # Filament change
-			 ):
-				# Unsupported commands
-				return
-			if line.startswith("M117"):
-				return line
+	async def _put(self, entry):
+		await self._wait_for(lambda: len(self._lines) < self.queue_depth)
+		self._lines.append(entry)
+		self._notify()
 
-			if not "*" in line:
-				# Apply checksum
-				s = ("%s " % line).encode("utf-8")
-				cs = 0
-				for v in bytearray(s):
-					cs = cs ^ v
-				cs = cs & 0xff
-				return "%s *%d" % (line, cs)
+	async def drain(self):
+		"""
+		Wait for all queued lines to be sent and acknowledged
+		"""
+		await self._wait_for(lambda: not self._lines and not self._replay and not self._pending)
 
-		out = shorten(line)
 
-		if out is None:
+class GrblStatus(object):
+	"""
+	grbl status report
+
+	Positions are tuples of floats, and fields not in the report are None;
+	`t` is the (monotonic) time of reception.
+	Items can be accessed as in a dict, eg. `status["state"]`.
+	"""
+	__slots__ = (
+	 "state", "mpos", "wpos", "wco", "cmdbuf", "rxbuf", "ln",
+	 "feed", "speed", "pins", "ov", "accessories", "t",
+	)
+
+	def __init__(self):
+		for k in self.__slots__:
+			setattr(self, k, None)
+
+	def __getitem__(self, key):
+		return getattr(self, key)
+
+	def __repr__(self):
+		return "GrblStatus(%s)" % ", ".join("%s=%r" % (k, getattr(self, k)) \
+		 for k in self.__slots__ if getattr(self, k) is not None)
+
+
+_re_status_09 = re.compile(
+ r"<(?P<state>\w+)"
+ r"(?:,MPos:(?P<mpos>[-\d.]+,[-\d.]+,[-\d.]+))?"
+ r"(?:,WPos:(?P<wpos>[-\d.]+,[-\d.]+,[-\d.]+))?"
+ r"(?:,Buf:(?P<cmdbuf>\d+))?"
+ r"(?:,RX:(?P<rxbuf>\d+))?"
+ r"(?:,Ln:(?P<ln>\d+))?"
+ r"(?:,F:(?P<feed>[\d.]+?)\.?)?"
+ r">"
+)
+
+def _floats(s):
+	x, y, z = s.split(",", 2)
+	return float(x), float(y), float(z)
+
+def parse_status(report, version="1.1", wco=None):
+	"""
+	Parse a grbl status report
+
+	:param wco: last known work coordinate offset; grbl 1.1 only reports
+	 it from time to time, and the missing one of MPos/WPos is computed
+	 from it
+	:return: GrblStatus, or None if the report can't be parsed
+	"""
+	st = GrblStatus()
+
+	if version == "0.9":
+		m = _re_status_09.match(report)
+		if m is None:
 			return
+		st.state, mpos, wpos, cmdbuf, rxbuf, ln, feed = m.groups()
+		st.mpos = mpos and _floats(mpos)
+		st.wpos = wpos and _floats(wpos)
+		st.cmdbuf = cmdbuf and int(cmdbuf)
+		st.rxbuf = rxbuf and int(rxbuf)
+		st.ln = ln and int(ln)
+		st.feed = feed and float(feed)
+		return st
+
+	fields = report[1:-1].split("|")
+	st.state = fields[0]
+	try:
+		for field in fields[1:]:
+			key, _, value = field.partition(":")
+			if key == "MPos":
+				st.mpos = _floats(value)
+			elif key == "WPos":
+				st.wpos = _floats(value)
+			elif key == "Bf":
+				a, b = value.split(",")
+				st.cmdbuf = int(a)
+				st.rxbuf = int(b)
+			elif key == "FS":
+				a, b = value.split(",")
+				st.feed = float(a)
+				st.speed = float(b)
+			elif key == "F":
+				st.feed = float(value)
+			elif key == "Ln":
+				st.ln = int(value)
+			elif key == "WCO":
+				wco = _floats(value)
+			elif key == "Pn":
+				st.pins = value
+			elif key == "Ov":
+				a, b, c = value.split(",")
+				st.ov = int(a), int(b), int(c)
+			elif key == "A":
+				st.accessories = value
+	except ValueError:
+		return
+
+	st.wco = wco
+	if wco is not None:
+		if st.wpos is None and st.mpos is not None:
+			st.wpos = tuple(m - o for m, o in zip(st.mpos, wco))
+		elif st.mpos is None and st.wpos is not None:
+			st.mpos = tuple(w + o for w, o in zip(st.wpos, wco))
+	return st
+
+
+class SenderGrbl(Sender):
+	"""
+	Two sending modes are available:
 
-		while True:
-			logger.info("\x1B[33m> %s\x1B[0m", out)
-			p.sendline(out)
+	- "poll": a status report is requested before each line, to check
+	  that there is room in the buffers, then the line is sent and its
+	  acknowledgement awaited;
+
+	- "stream": character-counting; the size of every unacknowledged
+	  line is tracked against the RX buffer, which is kept full, and
+	  lines are retired as their acknowledgement arrives.
 
-			resend = False
+	Status reports are requested with the real-time `?` command, which
+	doesn't go through the line stream; with `status_interval` (in s),
+	they're requested periodically, and `latest_status()` gives
+	the last one.
+	"""
+	endline = b"\r\n"
+	queue_full_retry = 0.3
+
+	def __init__(self, pipe=None, stdin=None, stdout=None, version="1.1", mode="poll", status_interval=None, telemetry=None):
+		super().__init__(pipe=pipe, stdin=stdin, stdout=stdout, telemetry=telemetry)
+		self._version = version
+		self._mode = mode
+		self._bufsize = 128 - 30 # keep room for values entered manually out of band
+		self._bufavail = self._bufsize
+		self._status_interval = status_interval
+		self._status = None
+		self._reports = 0 # number of status reports received
+		self.last_status = None
+		self.last_notice = None
+
+	async def __aenter__(self):
+		await super().__aenter__()
+		if self._status_interval is not None:
+			self._tasks.append(asyncio.create_task(self._poll_loop()))
+		return self
+
+	async def _poll_loop(self):
+		loop = asyncio.get_running_loop()
+		interval = self._status_interval
+		t = loop.time()
+		try:
 			while True:
-				res = p.readline()
-				if res is None:
-					time.sleep(0.1)
-					continue
-				elif res == "[ERROR] invalid checksum":
-					logger.info("\x1B[31;1m< %s\x1B[0m", res)
-					resend = True
-					continue
-				elif res == "[ERROR] invalid gcode":
-					logger.info("\x1B[31;1m< %s\x1B[0m -> assuming it was a corruption", res)
-					resend = True
-					continue
-				elif res == "[ERROR] too long extrusion prevented":
-					logger.info("\x1B[31;1m< %s\x1B[0m -> assuming it was a corruption", res)
-					resend = True
-					continue
-				elif res == "[ERROR] unknown command":
-					logger.info("\x1B[31;1m< %s\x1B[0m -> assuming it was a corruption", res)
-					resend = True
-					continue
-				elif re.match(r"\[ERROR\] gcode char invalid: '.' \([0-9A-F]{2}\)", res):
-					logger.info("\x1B[31;1m< %s\x1B[0m", res)
-					resend = True
-					continue
-				elif re.match(r"\[(ERROR)\].*", res):
-					self._last_notices.append(res)
-					logger.info("\x1B[31;1m< %s\x1B[0m", res)
-					raise RuntimeError(res)
-					continue
-				elif re.match(r"\[(ECHO|VALUE)\].*", res):
-					self._last_notices.append(res)
-					logger.info("\x1B[32m< %s\x1B[0m", res)
-					continue
-				elif res == "ok":
-					logger.info("\x1B[32m< %s\x1B[0m", res)
-					break
-				else:
-					logger.info("\x1B[35;1m< %s\x1B[0m", res)
-					continue
+				self.pipe.write(b"?")
+				t += interval
+				await asyncio.sleep(max(0, t - loop.time()))
+		except Exception as e:
+			self._fail(e)
+
+	async def queue(self, line, ln=None):
+		if self._mode == "stream" and len(line) + len(self.endline) > self._bufsize:
+			raise ValueError("Line too long for grbl RX buffer: %s" % line)
+		await super().queue(line, ln=ln)
+
+	async def queue_packet(self, pkt, ln=None):
+		if self._mode == "stream" and len(pkt) > self._bufsize:
+			raise ValueError("Line too long for grbl RX buffer: %s" % bytes(pkt))
+		await super().queue_packet(pkt, ln=ln)
+
+	def _can_send(self, entry):
+		if self._mode == "stream":
+			return len(entry.pkt) <= self._bufavail
+		return not self._pending
+
+	async def _before_send(self, entry):
+		if self._mode == "poll":
+			size = len(entry.pkt) - len(self.endline)
+			if self._version == "0.9":
+				can_send = lambda x: x["cmdbuf"] < 10 and x["rxbuf"] < 100
+			elif self._version == "1.1":
+				can_send = lambda x: x["cmdbuf"] > 2 and x["rxbuf"] > (5 + size)
+			await self.wait_status(condition=can_send, poll_delay=self.queue_full_retry)
+
+	def _fill(self):
+		return self._bufsize - self._bufavail
+
+	def _send(self, entry):
+		self._bufavail -= len(entry.pkt)
+		super()._send(entry)
+
+	def _on_status(self, res):
+		self.last_status = res
+		wco = self._status.wco if self._status is not None else None
+		status = parse_status(res, version=self._version, wco=wco)
+		if status is None:
+			logger.warning("Unparsable status report: %s", res)
+			return
+		status.t = time.monotonic()
+		self._status = status
+		self._reports += 1
+
+	def _on_line(self, res):
+		if res.startswith("<") and res.endswith(">"):
+			logger.debug("\x1B[32m%s\x1B[0m", res)
+			self._on_status(res)
+		elif res.startswith("[") and res.endswith("]"):
+			self.last_notice = res
+			logger.info("\x1B[32m%s\x1B[0m", res)
+		elif res == "ok" or res.startswith("error"):
+			logger.debug("\x1B[32m%s\x1B[0m", res)
+			entry = self._ack()
+			if entry is not None:
+				self._bufavail += len(entry.pkt)
+			if res != "ok":
+				self._fail(RuntimeError(res))
+		else:
+			logger.info("\x1B[35;1m%s\x1B[0m", res)
+
+	def latest_status(self):
+		"""
+		:return: the last status report received (GrblStatus), or None
+		"""
+		return self._status
+
+	async def wait_status(self, condition=None, poll_delay=1.0):
+		if condition is None:
+			condition = lambda x: x["cmdbuf"] == 0
 
-			if not resend:
+		while True:
+			status = await self.status()
+			if condition(status):
 				break
+			await asyncio.sleep(poll_delay)
 
-		return res
+	async def status(self):
+		"""
+		Request a fresh status report
 
+		:return: GrblStatus
+		"""
+		count = self._reports
+		self.pipe.write(b"?")
+		await self._wait_for(lambda: self._reports > count)
+		return self._status
+
+
+_trinus_corruptions = (
+ ("checksum", re.compile(r"\[ERROR\] invalid checksum$")),
+ ("gcode", re.compile(r"\[ERROR\] invalid gcode$")),
+ ("extrusion", re.compile(r"\[ERROR\] too long extrusion prevented$")),
+ ("command", re.compile(r"\[ERROR\] unknown command$")),
+ ("char", re.compile(r"\[ERROR\] gcode char invalid: '.' \([0-9A-F]{2}\)$")),
+)
 
-class SenderMarlin(object):
+_re_trinus_mode = re.compile(r"([GM])\s*0*(90|91|82|83)(?!\d)")
 
-	def __init__(self, pipe=None, stdin=None, stdout=None):
-		if pipe is None:
-			self.pipe = pipe = Pipe(stdin=stdin, stdout=stdout, endline=b"\n")
-		# Initialize
-		self.verbose = verbose = True
+class SenderTrinus(Sender):
+	"""
+	Lines are checksummed, and those rejected as corrupted are sent again.
+
+	Up to `window` lines are kept in flight, acknowledgements being
+	matched to lines in order, as long as their size fits in the RX
+	buffer (`rx_size` bytes), as in character-counting.
+	When a line is rejected as corrupted, the lines sent after it were
+	executed without it; so sending stops until the window is
+	acknowledged, then the line is sent again, followed by the rest
+	of the window.
+	As lines in relative mode (G91, M83) can't be executed twice,
+	they are sent with nothing else in flight.
+
+	If a line isn't acknowledged within `ack_timeout` (s) of the
+	previous acknowledgement, sending fails rather than waiting forever.
+
+	`resends` counts the resends triggered by each class of error.
+	"""
+	endline = b"\n"
+
+	def __init__(self, pipe=None, stdin=None, stdout=None, window=1, rx_size=128, ack_timeout=60.0, telemetry=None):
+		super().__init__(pipe=pipe, stdin=stdin, stdout=stdout, telemetry=telemetry)
 		self._last_notices = collections.deque()
+		self._window = window
+		self._bufsize = rx_size
+		self._bufavail = rx_size
+		self._ack_timeout = ack_timeout
+		self._relative = dict(G=False, M=False) # G91, M83 in effect
+		self._recovery = None # lines to send again once the window is acknowledged
+		self.resends = collections.Counter()
+
+	@classmethod
+	def encode(cls, line, n=None):
+		out = _shorten_reprap(line)
+		if out is None:
+			return
+		return out.encode() + cls.endline
 
-	def open(self, initial=True):
-		p = self.pipe
-		if initial:
-			logger.info("Initializing TODO...")
-			p.sendline("")
-			p.sendline("")
-			while True:
-				res = p.readline()
-				if res is None:
+	def _mark(self, entry, text):
+		"""
+		Follow the distance modes, to send lines in relative mode serially
+		"""
+		for letter, code in _re_trinus_mode.findall(text.upper()):
+			self._relative[letter] = code in ("91", "83")
+		entry.serial = self._relative["G"] or self._relative["M"]
+
+	async def queue(self, line, ln=None):
+		if self._error is not None:
+			raise self._error
+		pkt = self.encode(line)
+		if pkt is None:
+			return
+		if len(pkt) > self._bufsize:
+			raise ValueError("Line too long for trinus RX buffer: %s" % line)
+		entry = _Line(pkt, line, ln=ln)
+		self._mark(entry, line)
+		await self._put(entry)
+
+	async def queue_packet(self, pkt, ln=None):
+		if len(pkt) > self._bufsize:
+			raise ValueError("Line too long for trinus RX buffer: %s" % bytes(pkt))
+		entry = _Line(pkt, ln=ln)
+		self._mark(entry, bytes(pkt).decode("latin-1"))
+		await self._put(entry)
+
+	def _can_send(self, entry):
+		if self._recovery is not None:
+			return False
+		if entry.serial and self._pending:
+			return False
+		return len(self._pending) < self._window and len(entry.pkt) <= self._bufavail
+
+	def _fill(self):
+		return self._bufsize - self._bufavail
+
+	def _send(self, entry):
+		self._bufavail -= len(entry.pkt)
+		super()._send(entry)
+
+	def _corrupted(self, res, kind):
+		logger.info("\x1B[31;1m< %s\x1B[0m -> assuming it was a corruption", res)
+		if self._pending:
+			entry = self._pending[0]
+			entry.resend = True
+			self.resends[kind] += 1
+			if self.telemetry is not None:
+				self.telemetry.resend(kind, entry.ln)
+
+	def _on_ok(self):
+		self._t_ack = time.monotonic()
+		entry = self._ack()
+		if entry is None:
+			return
+		self._bufavail += len(entry.pkt)
+
+		if entry.resend:
+			entry.resend = False
+			if self._recovery is None:
+				self._recovery = collections.deque()
+
+		if self._recovery is not None:
+			self._recovery.append(entry)
+			if not self._pending:
+				self._replay.extend(self._recovery)
+				self._recovery = None
+
+	def _on_line(self, res):
+		if res.startswith("[ERROR]"):
+			for kind, regex in _trinus_corruptions:
+				if regex.match(res):
+					self._corrupted(res, kind)
 					break
-				logger.info("\x1B[32m%s\x1B[0m", res)
+			else:
+				self._last_notices.append(res)
+				logger.info("\x1B[31;1m< %s\x1B[0m", res)
+				self._fail(RuntimeError(res))
+		elif re.match(r"\[(ECHO|VALUE)\].*", res):
+			self._last_notices.append(res)
+			logger.info("\x1B[32m< %s\x1B[0m", res)
+		elif res == "ok":
+			logger.debug("\x1B[32m< %s\x1B[0m", res)
+			self._on_ok()
+		else:
+			logger.info("\x1B[35;1m< %s\x1B[0m", res)
+
+
+_re_resend = re.compile(r"(?:Resend|rs):?\s*N?(\d+)")
+_re_advanced_ok = re.compile(r"ok\b.*\bB(\d+)")
+
+class SenderMarlin(Sender):
+	"""
+	Lines are numbered and checksummed, so that the firmware can
+	ask for lines to be sent again (`Resend: N`); the last sent lines
+	are kept in a ring for that purpose.
+
+	Two sending modes are available:
+
+	- "ack": a line is sent once the previous one is acknowledged;
+
+	- "stream": up to `window` lines are kept in flight; the firmware
+	  command buffer depth (BUFSIZE) is a good value.
+	  If the firmware reports its free buffer slots (ADVANCED_OK),
+	  the number of lines in flight is further limited to that.
+	  Their size must also fit in the RX buffer (`rx_size` bytes),
+	  as in character-counting.
+
+	If a line isn't acknowledged within `ack_timeout` (s) of the
+	previous response, its acknowledgement or itself is assumed lost:
+	the lines in flight are sent again from it, the firmware rejecting
+	those it already has (and asking for the next one) by their number.
+	Sending fails after `retries` such timeouts in a row.
+	"""
+	endline = b"\n"
+
+	def __init__(self, pipe=None, stdin=None, stdout=None, mode="ack", window=4, ring=64,
+	 rx_size=128, ack_timeout=60.0, retries=3, telemetry=None):
+		super().__init__(pipe=pipe, stdin=stdin, stdout=stdout, telemetry=telemetry)
+		self._last_notices = collections.deque()
+		self._mode = mode
+		self._window = window
+		self._window_max = window
+		self._bufsize = rx_size
+		self._bufavail = rx_size
+		self._ack_timeout = ack_timeout
+		self._retries = retries
+		self._timeouts = 0 # in a row
+		self._ring = collections.deque(maxlen=ring) # last numbered lines sent
+		self._next_n = None # number expected by the firmware for the next line
+		self._gen = 0 # incremented on each replay
+		self._resend_n = None # line number of the last replay
 
 	def close(self):
 		p = self.pipe
 		p.close()
 
-	def queue(self, line):
-		p = self.pipe
+	@classmethod
+	def encode(cls, line, n=None):
+		"""
+		:param n: line number, if None the line is not numbered,
+		 nor when it already has a checksum
+		"""
+		if n is None:
+			out = _shorten_reprap(line)
+		else:
+			out = _strip_reprap(line)
+			# Firmwares take the checksum after the last "*"
+			if out is not None and not _re_checksummed.fullmatch(out):
+				out = "N%d %s" % (n, out)
+				out = "%s *%d" % (out, _checksum(("%s " % out).encode("utf-8")))
+		if out is None:
+			return
+		return out.encode() + cls.endline
 
-		def shorten(line):
-			line = line.split(";")[0].rstrip()
+	@staticmethod
+	def _number(pkt):
+		"""
+		:return: line number of the wire bytes, or None
+		"""
+		m = _re_line_number.match(bytes(pkt[:16]))
+		if m is None:
+			return
+		return int(m.group(1))
 
-			if line in (
-			 "G21",
-			 "G90",
-			 "M82",
-			 "M600", # Filament change
-			 ):
-				# Unsupported commands
+	async def _renumber(self, n):
+		"""
+		Make sure the firmware expects line number n next
+		"""
+		if self._next_n != n:
+			await self._put(_Line(self.encode("M110 N%d" % (n-1)), "M110 N%d" % (n-1)))
+		self._next_n = n + 1
+
+	async def queue(self, line, ln=None):
+		if self._error is not None:
+			raise self._error
+		if self._next_n is None:
+			await self._renumber(1)
+		else:
+			self._next_n += 1
+		n = self._next_n - 1
+		pkt = self.encode(line, n)
+		if pkt is not None and self._mode == "stream" and len(pkt) > self._bufsize:
+			raise ValueError("Line too long for marlin RX buffer: %s" % line)
+		if pkt is None or self._number(pkt) != n:
+			# Not sent, or sent as it is (with its checksum): its number
+			# is not used
+			self._next_n -= 1
+			if pkt is None:
 				return
-			if line.startswith("M117"):
-				return line
-
-			if not "*" in line:
-				# Apply checksum
-				s = ("%s " % line).encode("utf-8")
-				cs = 0
-				for v in bytearray(s):
-					cs = cs ^ v
-				cs = cs & 0xff
-				return "%s *%d" % (line, cs)
+			n = self._number(pkt)
+			if n is not None:
+				await self._renumber(n)
+		await self._put(_Line(pkt, line, n, ln=ln))
+
+	async def queue_packet(self, pkt, ln=None):
+		if self._mode == "stream" and len(pkt) > self._bufsize:
+			raise ValueError("Line too long for marlin RX buffer: %s" % bytes(pkt))
+		n = self._number(pkt)
+		if n is not None:
+			await self._renumber(n)
+		await self._put(_Line(pkt, n=n, ln=ln))
+
+	def _can_send(self, entry):
+		if self._mode == "stream":
+			return len(self._pending) < self._window and len(entry.pkt) <= self._bufavail
+		return not self._pending
+
+	def _send(self, entry):
+		self._bufavail -= len(entry.pkt)
+		super()._send(entry)
+		entry.gen = self._gen
+		if entry.n is not None and not entry.resend:
+			self._ring.append(entry)
+
+	def _on_ack_timeout(self, entry):
+		if entry.n is None or self._timeouts >= self._retries:
+			super()._on_ack_timeout(entry)
+		self._timeouts += 1
+		logger.warning("No acknowledgement of line %d in %s s, sending again", entry.n, self._ack_timeout)
+		# The lines in flight won't be acknowledged (but the resent ones)
+		self._pending.clear()
+		self._bufavail = self._bufsize
+		self._resend(entry.n, force=True)
 
-		out = shorten(line)
+	def _resend(self, n, force=False):
+		"""
+		Replay the lines from number n
 
-		if out is None:
+		:param force: even if a replay from n is in progress
+		"""
+		head = self._pending[0] if self._pending else None
+		if not force and head is not None and head.gen < self._gen and n == self._resend_n:
+			# Also caused by the lines sent after the one which was rejected
+			logger.debug("Resend %d already in progress", n)
 			return
 
-		while True:
-			logger.info("\x1B[33mNow sending %s (%s)\x1B[0m", out, line)
-			p.sendline(out)
-
-			resend = False
-			while True:
-				res = p.readline()
-				if res is None:
-					time.sleep(0.1)
-					continue
-				elif res.startswith("echo:"):
-					self._last_notices.append(res)
-					logger.info("\x1B[32m%s\x1B[0m", res)
-					continue
-				elif res == "ok":
-					logger.info("\x1B[32m%s\x1B[0m", res)
-					break
-				else:
-					logger.info("\x1B[35;1m“%s”\x1B[0m", res)
-					continue
-
-			if not resend:
+		ring = self._ring
+		for idx, entry in enumerate(ring):
+			if entry.n == n:
 				break
+		else:
+			if ring and n == ring[-1].n + 1:
+				# After a timeout: the firmware had all the lines
+				logger.info("Line %d is the next one, nothing to resend", n)
+				self._replay.clear()
+				return
+			self._fail(RuntimeError("Cannot resend line %d, not in the last %d lines" % (n, len(ring))))
+			return
 
-		return res
+		logger.info("\x1B[31;1mResending from line %d\x1B[0m", n)
+		if self.telemetry is not None:
+			self.telemetry.resend("marlin", entry.ln)
+		self._gen += 1
+		self._resend_n = n
+		self._replay.clear()
+		for i in range(idx, len(ring)):
+			entry = ring[i]
+			copy = _Line(entry.pkt, entry.line, entry.n, entry.ln)
+			copy.resend = True
+			self._replay.append(copy)
+
+	def _on_line(self, res):
+		# Anything (eg. "busy: processing") shows that the firmware is alive
+		self._t_ack = time.monotonic()
+		if res.startswith("echo:"):
+			self._last_notices.append(res)
+			logger.info("\x1B[32m%s\x1B[0m", res)
+		elif res.startswith("ok"):
+			logger.debug("\x1B[32m%s\x1B[0m", res)
+			entry = self._ack()
+			if entry is not None:
+				self._bufavail += len(entry.pkt)
+				self._timeouts = 0
+			m = _re_advanced_ok.match(res)
+			if m is not None:
+				self._window = max(1, min(self._window_max, int(m.group(1))))
+		elif res.startswith("Resend") or res.startswith("rs"):
+			logger.info("\x1B[31;1m%s\x1B[0m", res)
+			m = _re_resend.match(res)
+			if m is not None:
+				self._resend(int(m.group(1)))
+		elif res.startswith("Error") or res.startswith("!!"):
+			self._last_notices.append(res)
+			logger.info("\x1B[31;1m%s\x1B[0m", res)
+		else:
+			logger.info("\x1B[35;1m“%s”\x1B[0m", res)
 
 
 
@@ -384,6 +1067,59 @@ def main(args=None):
 	 default="grbl",
 	)
 
+	parser.add_argument("--grbl-mode",
+	 help="grbl sending mode: status poll before each line, or character-counting streaming",
+	 choices=("poll", "stream"),
+	 default="poll",
+	)
+
+	parser.add_argument("--grbl-status-interval",
+	 help="grbl: period (s) of status queries done in the background",
+	 type=float,
+	)
+
+	parser.add_argument("--trinus-window",
+	 help="trinus: maximum number of lines in flight",
+	 type=int,
+	 default=1,
+	)
+
+	parser.add_argument("--trinus-rx-buffer",
+	 help="trinus: RX buffer size (bytes), which the lines in flight must fit in",
+	 type=int,
+	 default=128,
+	)
+
+	parser.add_argument("--trinus-ack-timeout",
+	 help="trinus: time (s) without acknowledgement after which sending fails, 0 to disable",
+	 type=float,
+	 default=60.0,
+	)
+
+	parser.add_argument("--marlin-mode",
+	 help="marlin sending mode: wait for each acknowledgement, or keep several lines in flight",
+	 choices=("ack", "stream"),
+	 default="ack",
+	)
+
+	parser.add_argument("--marlin-window",
+	 help="marlin stream mode: maximum number of lines in flight",
+	 type=int,
+	 default=4,
+	)
+
+	parser.add_argument("--marlin-rx-buffer",
+	 help="marlin stream mode: RX buffer size (bytes), which the lines in flight must fit in",
+	 type=int,
+	 default=128,
+	)
+
+	parser.add_argument("--marlin-ack-timeout",
+	 help="marlin: time (s) without response after which the lines in flight are sent again, 0 to disable",
+	 type=float,
+	 default=60.0,
+	)
+
 	subparsers = parser.add_subparsers(
 	 help='the command; type "%s COMMAND -h" for command-specific help' % sys.argv[0],
 	 dest='command',
@@ -400,8 +1136,66 @@ def main(args=None):
 	 default=1,
 	)
 
+	parser_send.add_argument("--no-resume-preamble",
+	 action="store_true",
+	 help="with --start-line, do not restore the modal state (units, modes, spindle, position) before it",
+	)
+
+	parser_send.add_argument("--resume-safe-z",
+	 help="height (mm) of the rapid to the resume point (default: highest Z before it)",
+	 type=float,
+	)
+
+	parser_send.add_argument("--resume-plunge-feed",
+	 help="feed rate (mm/min) of the plunge to the resume point (default: the one in effect)",
+	 type=float,
+	)
+
+	parser_send.add_argument("--resume-dwell",
+	 help="delay (s) for the spindle to get to speed, when resuming",
+	 type=float,
+	 default=0.0,
+	)
+
+	parser_send.add_argument("--progress-interval",
+	 help="period (s) of the progress summary, 0 to disable",
+	 type=float,
+	 default=5.0,
+	)
+
+	parser_send.add_argument("--telemetry",
+	 help="file where telemetry snapshots are written, as JSON lines",
+	)
+
+	parser_send.add_argument("--eta-model",
+	 action="store_true",
+	 help="compute the ETA with a motion planner model (default machine limits) of the g-code file",
+	)
+
 	parser_send.add_argument("filename",
-	 help="file to send",
+	 help="file to send (g-code, or job file made by the compile command)",
+	)
+
+	parser_index = subparsers.add_parser(
+	 'index',
+	 help="build the resume index of a g-code file, for instant --start-line",
+	)
+
+	parser_index.add_argument("filename",
+	 help="g-code file",
+	)
+
+	parser_compile = subparsers.add_parser(
+	 'compile',
+	 help="compile a g-code file into a job file, for the protocol",
+	)
+
+	parser_compile.add_argument("--output",
+	 help="job file (default: next to the g-code file, with .xmjob suffix)",
+	)
+
+	parser_compile.add_argument("filename",
+	 help="g-code file",
 	)
 
 	try:
@@ -418,7 +1212,37 @@ def main(args=None):
 	 format="%(asctime)-15s %(name)s %(levelname)s %(message)s"
 	)
 
+	senders = dict(
+	 grbl=SenderGrbl,
+	 trinus=SenderTrinus,
+	 marlin=SenderMarlin,
+	)
+
+	if args.command == "compile":
+		from .gcode_job import compile_job
+		output = args.output or (args.filename + ".xmjob")
+		n = compile_job(args.filename, output, args.protocol, senders[args.protocol])
+		logger.info("Compiled %d lines into %s", n, output)
+		return
+
+	if args.command == "index":
+		from .gcode_resume import ResumeIndex
+		with ResumeIndex(args.filename) as index:
+			logger.info("Resume index of %s: %d checkpoints", args.filename, len(index))
+		return
+
 	with contextlib.ExitStack() as stack:
+		telemetry = None
+		if args.command == "send":
+			from .gcode_telemetry import Telemetry
+			export = None
+			if args.telemetry is not None:
+				export = stack.enter_context(io.open(args.telemetry, "w"))
+			telemetry = Telemetry(
+			 progress_interval=args.progress_interval or None,
+			 export=export,
+			)
+
 		if args.stdio_command is not None:
 			cmd = shlex.split(args.stdio_command)
 			proc = TerminatingPopen(cmd,
@@ -439,58 +1263,153 @@ def main(args=None):
 			sender = SenderTrinus(
 			 stdin=stdin,
 			 stdout=stdout,
+			 window=args.trinus_window,
+			 rx_size=args.trinus_rx_buffer,
+			 ack_timeout=args.trinus_ack_timeout,
+			 telemetry=telemetry,
 			)
 		elif args.protocol == "grbl":
 			sender = SenderGrbl(
 			 stdin=stdin,
 			 stdout=stdout,
+			 mode=args.grbl_mode,
+			 status_interval=args.grbl_status_interval,
+			 telemetry=telemetry,
 			)
 		elif args.protocol == "marlin":
 			sender = SenderMarlin(
 			 stdin=stdin,
 			 stdout=stdout,
+			 mode=args.marlin_mode,
+			 window=args.marlin_window,
+			 rx_size=args.marlin_rx_buffer,
+			 ack_timeout=args.marlin_ack_timeout,
+			 telemetry=telemetry,
 			)
 
 		if 0:
 			pass
 
 		elif args.command == "send":
-			sender.open(initial=False)
-			logger.info("Sending %s", args.filename)
+			return asyncio.run(send(sender, args))
 
-			idx_line = 1
-			try:
+
+def _count_lines(path):
+	with io.open(path, "rb") as f:
+		return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+
+
+def _job_timestamps(job):
+	"""
+	:return: estimated time at the end of each source line of a job
+	"""
+	import numpy as np
+	from .milling_xyz.motion import Planner
+	from .milling_xyz.program import Program
+
+	t = Planner().timestamps(Program(bytes(job.wire_bytes())))
+	res = np.zeros(job.last_line())
+	# Source lines without job lines (comments...) take no time
+	res[np.frombuffer(job.source_lines(), dtype=np.uint32).astype(np.int64) - 1] = t
+	return np.maximum.accumulate(res)
+
+
+def _dump_telemetry(telemetry):
+	if telemetry is not None:
+		logger.error("Last events:")
+		telemetry.dump(level=logging.ERROR)
+
+
+async def send(sender, args):
+	from .gcode_job import Job
+
+	telemetry = sender.telemetry
+
+	async with sender, contextlib.AsyncExitStack() as stack:
+		await sender.open(initial=False)
+		logger.info("Sending %s", args.filename)
+
+		last_line = None
+		nb_lines = 0
+		t0 = time.monotonic()
+		try:
+			if Job.is_job(args.filename):
+				# The job is closed after drain() as packets refer to it
+				job = stack.enter_context(Job(args.filename))
+				if job.protocol != args.protocol:
+					raise ValueError("Job %s was compiled for %s" % (args.filename, job.protocol))
+				if telemetry is not None and len(job):
+					telemetry.total_lines = job.last_line()
+					if args.eta_model:
+						telemetry.timestamps = _job_timestamps(job)
+				if args.start_line > 1 and not args.no_resume_preamble:
+					logger.warning("The modal state is not restored when resuming a job file")
+				for last_line, pkt in job.packets(args.start_line):
+					await sender.queue_packet(pkt, ln=last_line)
+					nb_lines += 1
+			else:
+				if telemetry is not None:
+					telemetry.total_lines = _count_lines(args.filename)
+					if args.eta_model:
+						from .milling_xyz.motion import Planner
+						from .milling_xyz.program import Program
+						telemetry.timestamps = Planner().timestamps(Program.load(args.filename))
+				if args.start_line > 1 and not args.no_resume_preamble:
+					from .gcode_resume import ResumeIndex
+					with ResumeIndex(args.filename) as index:
+						preamble = index.preamble(args.start_line,
+						 safe_z=args.resume_safe_z,
+						 plunge_feed=args.resume_plunge_feed,
+						 dwell=args.resume_dwell,
+						 extruder=args.protocol != "grbl",
+						)
+						tool = index.state(args.start_line)[0]["tool"]
+					if tool >= 0:
+						logger.info("Resuming with tool T%d, which is expected to be loaded", tool)
+					for line in preamble:
+						logger.info("Resume preamble: %s", line)
+						await sender.queue(line)
 				with io.open(args.filename, "r") as f:
 					for idx_line, line in enumerate(f):
 						if idx_line+1 < args.start_line:
 							continue
-						line = line.rstrip()
-						logger.info("Processing line % 4d (%s)", idx_line+1, line)
-						if re.match(r".*\*\d+", line):
-							""" Don't touch """
-						else:
-							if line.startswith("%"):
-								continue
-							if line.startswith("("):
-								continue
-							if line == "":
-								continue
-							line = line.split(";")[0].strip()
-							if line == "":
-								continue
-							logger.info("Queueing line % 4d (%s)", idx_line+1, line)
-						sender.queue(line)
-
-			except KeyboardInterrupt:
-				pass
-
-			logger.info("Last line sent is %d", idx_line+1)
-
-			if args.protocol == "grbl":
-				idle_p = lambda x: x["state"] == "Idle"
-				sender.wait_status(condition=idle_p)
-			else:
-				logger.info("\x1B[33mCaution, wait for remaining commands to be purged!\x1B[0m")
+						logger.debug("Processing line % 4d (%s)", idx_line+1, line.rstrip())
+						line = clean_line(line)
+						if line is None:
+							continue
+						logger.debug("Queueing line % 4d (%s)", idx_line+1, line)
+						await sender.queue(line, ln=idx_line+1)
+						last_line = idx_line+1
+						nb_lines += 1
+
+		except asyncio.CancelledError:
+			# Interrupted (^C): stop queueing, let what's queued go through
+			asyncio.current_task().uncancel()
+		except Exception:
+			_dump_telemetry(telemetry)
+			raise
+
+		logger.info("Last line queued is %s", last_line)
+
+		try:
+			await sender.drain()
+		except Exception:
+			_dump_telemetry(telemetry)
+			raise
+		dt = time.monotonic() - t0
+		logger.info("Sent %d lines in %.3f s (%.1f lines/s)",
+		 nb_lines, dt, nb_lines / dt if dt > 0 else float("inf"))
+		if telemetry is not None:
+			telemetry.progress()
+
+		if isinstance(sender, SenderTrinus):
+			logger.info("Resends: %s", ", ".join("%s=%d" % x for x in sorted(sender.resends.items())) or "none")
+
+		if isinstance(sender, SenderGrbl):
+			idle_p = lambda x: x["state"] == "Idle"
+			await sender.wait_status(condition=idle_p)
+		else:
+			logger.info("\x1B[33mCaution, wait for remaining commands to be purged!\x1B[0m")
 
 
 if __name__ == "__main__":
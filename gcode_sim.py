@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# PYTHON_ARGCOMPLETE_OK
+# Simulated g-code controllers
+
+"""
+Local simulation of the controllers gcode_sender talks to
+(grbl 0.9/1.1, Marlin, Trinus), served on stdio or on a pty,
+to exercise the senders without a machine.
+
+The serial link is simulated at a given baud rate (10 bits per byte),
+in both directions; received bytes go to an RX buffer of limited size
+(overflowing bytes are lost), and complete lines are moved to the
+command buffer / planner when there is room, at which point they are
+acknowledged; each planner block then takes a fixed time to execute.
+
+Lines can be corrupted (a byte is altered) with a given probability,
+to exercise the error recovery of the senders.
+
+Statistics (lines, bytes, errors, time spent with an empty planner
+while the job is running) can be written as JSON on exit.
+"""
+
+import sys, io, os
+import re
+import time
+import json
+import random
+import signal
+import selectors
+import functools
+import operator
+import collections
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Controller(object):
+	"""
+	Base of simulated controllers
+
+	Subclasses implement `_on_line()`, which is called when a complete line
+	can be taken from the RX buffer, and returns False to leave it there.
+	"""
+	endline = b"\n"
+
+	def __init__(self, rx_size=128, planner_size=16, exec_time=0.001, corrupt=0.0, seed=None):
+		self.rx = bytearray()
+		self.rx_size = rx_size
+		self.planner = collections.deque()
+		self.planner_size = planner_size
+		self.exec_time = exec_time
+		self.corrupt = corrupt
+		self.out = bytearray()
+		self.stats = collections.Counter()
+		self._random = random.Random(seed)
+		self._t_block = None # start of execution of the first planner block
+		self._t_empty = None # time the planner got empty
+		self._hold = False
+		self.underrun = 0.0
+		self.t_first = None
+		self.t_last = None
+
+	def emit(self, s):
+		self.out += s.encode() + self.endline
+
+	def _realtime(self, c, now):
+		"""
+		:return: True if the byte was a real-time command
+		"""
+		return False
+
+	def receive(self, c, now):
+		"""
+		A byte arrives from the wire
+		"""
+		self.stats["bytes_in"] += 1
+		if self._realtime(c, now):
+			return
+		if len(self.rx) >= self.rx_size:
+			self.stats["rx_overflow"] += 1
+			return
+		self.rx.append(c)
+
+	def _corrupt(self, line):
+		if self.corrupt and line and self._random.random() < self.corrupt:
+			idx = self._random.randrange(len(line))
+			line = line[:idx] + b"#" + line[idx+1:]
+			self.stats["corrupted"] += 1
+		return line
+
+	def _plan(self, cmd, now):
+		"""
+		Add a block to the planner
+		"""
+		if not self.planner:
+			self._t_block = now
+			if self._t_empty is not None:
+				self.underrun += now - self._t_empty
+		if self.t_first is None:
+			self.t_first = now
+		self.planner.append(cmd)
+		self.stats["blocks"] += 1
+
+	def _executed(self, cmd):
+		pass
+
+	def process(self, now):
+		"""
+		Advance the simulation to now
+
+		:return: time of the next planner event, or None
+		"""
+		while True:
+			progress = False
+
+			while self.planner and not self._hold and now >= self._t_block + self.exec_time:
+				self._t_block += self.exec_time
+				self._executed(self.planner.popleft())
+				if not self.planner:
+					self._t_empty = self.t_last = self._t_block
+				progress = True
+
+			idx = self.rx.find(b"\n")
+			if idx >= 0:
+				line = bytes(self.rx[:idx]).rstrip(b"\r")
+				if self._on_line(line, now) is not False:
+					del self.rx[:idx+1]
+					self.stats["lines"] += 1
+					progress = True
+
+			if not progress:
+				break
+
+		if self.planner and not self._hold:
+			return self._t_block + self.exec_time
+
+	def _on_line(self, line, now):
+		raise NotImplementedError()
+
+
+_re_word = re.compile(rb"([XYZ])\s*(-?[\d.]+)")
+
+class Grbl(Controller):
+	"""
+	grbl: lines are acknowledged when they enter the planner;
+	`?` (status), `!` (hold), `~` (resume) and 0x18 (reset)
+	are handled on reception.
+	"""
+	endline = b"\r\n"
+
+	def __init__(self, version="1.1", planner_size=15, **kw):
+		super().__init__(planner_size=planner_size, **kw)
+		self.version = version
+		self.pos = [0.0, 0.0, 0.0]
+		self.emit(self.banner())
+
+	def banner(self):
+		return "\r\nGrbl %s ['$' for help]" % ("1.1h" if self.version == "1.1" else "0.9j")
+
+	def state(self):
+		if self._hold:
+			return "Hold:0" if self.version == "1.1" else "Hold"
+		return "Run" if self.planner else "Idle"
+
+	def report(self):
+		pos = ",".join("%.3f" % x for x in self.pos)
+		if self.version == "0.9":
+			return "<%s,MPos:%s,WPos:%s,Buf:%d,RX:%d>" \
+			 % (self.state(), pos, pos, len(self.planner), len(self.rx))
+		return "<%s|MPos:%s|Bf:%d,%d|FS:0,0>" \
+		 % (self.state(), pos, self.planner_size - len(self.planner), self.rx_size - len(self.rx))
+
+	def _realtime(self, c, now):
+		if c == ord("?"):
+			self.stats["status"] += 1
+			self.emit(self.report())
+		elif c == ord("!"):
+			self._hold = True
+		elif c == ord("~"):
+			if self._hold and self.planner:
+				self._t_block = now
+			self._hold = False
+		elif c == 0x18:
+			self.rx.clear()
+			self.planner.clear()
+			self._hold = False
+			self._t_empty = None
+			self.emit(self.banner())
+		else:
+			return False
+		return True
+
+	def _on_line(self, line, now):
+		if line == b"" or line.startswith(b"$"):
+			self.emit("ok")
+			return
+		if len(self.planner) >= self.planner_size:
+			return False
+		line = self._corrupt(line)
+		if b"#" in line:
+			self.stats["errors"] += 1
+			self.emit("error:20")
+			return
+		self._plan(line, now)
+		self.emit("ok")
+
+	def _executed(self, cmd):
+		for axis, value in _re_word.findall(cmd):
+			self.pos[b"XYZ".index(axis)] = float(value)
+
+
+def _checksum_ok(line):
+	"""
+	:return: line without checksum, or None if there is a bad checksum
+	"""
+	if not b"*" in line:
+		return line
+	body, cs = line.rsplit(b"*", 1)
+	try:
+		cs = int(cs)
+	except ValueError:
+		return
+	if functools.reduce(operator.xor, body, 0) != cs:
+		return
+	return body.rstrip()
+
+
+class Marlin(Controller):
+	"""
+	Marlin: lines are checked (checksum, line number) as they enter the
+	command buffer, and acknowledged as they go from there to the planner.
+	"""
+	banner = "start"
+
+	def __init__(self, cmd_size=4, advanced_ok=False, **kw):
+		super().__init__(**kw)
+		self.cmd = collections.deque()
+		self.cmd_size = cmd_size
+		self.advanced_ok = advanced_ok
+		self.last_n = 0
+		if self.banner is not None:
+			self.emit(self.banner)
+
+	def _resend(self, error):
+		self.stats["errors"] += 1
+		self.stats["resends"] += 1
+		self.emit("Error:%s, Last Line: %d" % (error, self.last_n))
+		self.emit("Resend: %d" % (self.last_n + 1))
+		self.emit("ok")
+
+	def _on_line(self, line, now):
+		if len(self.cmd) >= self.cmd_size:
+			return False
+		line = self._corrupt(line)
+		body = _checksum_ok(line)
+		if body is None:
+			self._resend("checksum mismatch")
+			return
+		if body.startswith(b"N"):
+			n, _, body = body.partition(b" ")
+			try:
+				n = int(n[1:])
+			except ValueError:
+				self._resend("Line Number is not Last Line Number+1")
+				return
+			if body.startswith(b"M110"):
+				self.last_n = n
+			elif n != self.last_n + 1:
+				self._resend("Line Number is not Last Line Number+1")
+				return
+			else:
+				self.last_n = n
+		if body.startswith(b"M110"):
+			m = re.search(rb"N(\d+)", body)
+			if m is not None:
+				self.last_n = int(m.group(1))
+		self.cmd.append(body)
+
+	def process(self, now):
+		while True:
+			t_next = super().process(now)
+			if not self.cmd or len(self.planner) >= self.planner_size:
+				return t_next
+			self._plan(self.cmd.popleft(), now)
+			if self.advanced_ok:
+				self.emit("ok N%d P%d B%d" % (self.last_n,
+				 self.planner_size - len(self.planner), self.cmd_size - len(self.cmd)))
+			else:
+				self.emit("ok")
+
+
+class Trinus(Marlin):
+	"""
+	Trinus: lines are checksummed but not numbered; rejected lines
+	get an error, then are acknowledged.
+	"""
+	banner = None
+
+	def _on_line(self, line, now):
+		if len(self.cmd) >= self.cmd_size:
+			return False
+		line = self._corrupt(line)
+		body = _checksum_ok(line)
+		if body is None:
+			self.stats["errors"] += 1
+			self.stats["resends"] += 1
+			self.emit("[ERROR] invalid checksum")
+			self.emit("ok")
+			return
+		self.cmd.append(body)
+
+
+def serve(ctrl, fd_in, fd_out, baud=115200):
+	"""
+	Run the controller on file descriptors, until end of input
+	"""
+	byte_time = 10.0 / baud if baud else 0.0
+	wire_in = bytearray()
+	t_in = None # start of transmission of the first byte on the wire
+	t_out = None
+
+	os.set_blocking(fd_in, False)
+	sel = selectors.DefaultSelector()
+	sel.register(fd_in, selectors.EVENT_READ)
+
+	while True:
+		now = time.monotonic()
+
+		if wire_in:
+			if byte_time:
+				k = min(len(wire_in), int((now - t_in) / byte_time))
+			else:
+				k = len(wire_in)
+			for c in wire_in[:k]:
+				ctrl.receive(c, now)
+				if c == 0x0a:
+					# Lines are taken from the RX buffer as they complete,
+					# not after a late wake-up has overflowed it
+					ctrl.process(now)
+			del wire_in[:k]
+			t_in += k * byte_time
+
+		t_next = ctrl.process(now)
+
+		out = ctrl.out
+		if out:
+			if t_out is None:
+				t_out = now
+			if byte_time:
+				k = min(len(out), int((now - t_out) / byte_time))
+			else:
+				k = len(out)
+			if k:
+				k = os.write(fd_out, out[:k])
+				del out[:k]
+				t_out += k * byte_time
+			if not out:
+				t_out = None
+
+		deadlines = []
+		if t_next is not None:
+			deadlines.append(t_next)
+		if wire_in:
+			deadlines.append(t_in + byte_time)
+		if out:
+			deadlines.append(t_out + byte_time)
+		timeout = max(0, min(deadlines) - now) if deadlines else None
+
+		if sel.select(timeout):
+			try:
+				data = os.read(fd_in, 65536)
+			except BlockingIOError:
+				continue
+			if not data:
+				break
+			if not wire_in:
+				t_in = time.monotonic()
+			wire_in += data
+
+
+def main(args=None):
+
+	if args is None:
+		args = sys.argv[1:]
+
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	 description="Simulated g-code controller, on stdio",
+	)
+
+	parser.add_argument("--log-level",
+	 default="INFO",
+	 help="Logging level (eg. INFO, see Python logging docs)",
+	)
+
+	parser.add_argument("--protocol",
+	 help="controller type",
+	 choices=("grbl", "grbl-0.9", "marlin", "trinus"),
+	 default="grbl",
+	)
+
+	parser.add_argument("--baud",
+	 help="serial link speed (0 for no throttling)",
+	 type=int,
+	 default=115200,
+	)
+
+	parser.add_argument("--rx-buffer",
+	 help="RX buffer size (bytes)",
+	 type=int,
+	 default=128,
+	)
+
+	parser.add_argument("--planner",
+	 help="planner size (blocks)",
+	 type=int,
+	)
+
+	parser.add_argument("--cmd-buffer",
+	 help="marlin/trinus: command buffer size (lines)",
+	 type=int,
+	 default=4,
+	)
+
+	parser.add_argument("--advanced-ok",
+	 help="marlin: report line number and free slots in acknowledgements",
+	 action="store_true",
+	)
+
+	parser.add_argument("--exec-time",
+	 help="execution time of each command (s)",
+	 type=float,
+	 default=0.001,
+	)
+
+	parser.add_argument("--corrupt",
+	 help="probability for a line to be corrupted",
+	 type=float,
+	 default=0.0,
+	)
+
+	parser.add_argument("--seed",
+	 help="random seed",
+	 type=int,
+	)
+
+	parser.add_argument("--pty",
+	 help="serve on a pseudo-terminal (its name is printed) instead of stdio",
+	 action="store_true",
+	)
+
+	parser.add_argument("--stats",
+	 help="file where statistics are written (JSON) on exit",
+	)
+
+	try:
+		import argcomplete
+		argcomplete.autocomplete(parser)
+	except:
+		pass
+
+	args = parser.parse_args(args)
+
+	logging.basicConfig(
+	 datefmt="%Y%m%dT%H%M%S",
+	 level=getattr(logging, args.log_level),
+	 format="%(asctime)-15s %(name)s %(levelname)s %(message)s"
+	)
+
+	kw = dict(
+	 rx_size=args.rx_buffer,
+	 exec_time=args.exec_time,
+	 corrupt=args.corrupt,
+	 seed=args.seed,
+	)
+	if args.planner is not None:
+		kw["planner_size"] = args.planner
+
+	if args.protocol == "grbl":
+		ctrl = Grbl(version="1.1", **kw)
+	elif args.protocol == "grbl-0.9":
+		ctrl = Grbl(version="0.9", **kw)
+	elif args.protocol == "marlin":
+		ctrl = Marlin(cmd_size=args.cmd_buffer, advanced_ok=args.advanced_ok, **kw)
+	elif args.protocol == "trinus":
+		ctrl = Trinus(cmd_size=args.cmd_buffer, **kw)
+
+	if args.pty:
+		import tty
+		master, slave = os.openpty()
+		tty.setraw(slave)
+		print(os.ttyname(slave), flush=True)
+		fd_in = fd_out = master
+	else:
+		fd_in = sys.stdin.buffer.fileno()
+		fd_out = sys.stdout.buffer.fileno()
+
+	def terminate(signum, frame):
+		raise SystemExit(0)
+
+	signal.signal(signal.SIGTERM, terminate)
+
+	t0 = time.monotonic()
+	try:
+		serve(ctrl, fd_in, fd_out, baud=args.baud)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if args.stats is not None:
+			stats = dict(ctrl.stats)
+			stats.update(
+			 elapsed=time.monotonic() - t0,
+			 underrun=ctrl.underrun,
+			 job_time=(ctrl.t_last - ctrl.t_first) if ctrl.t_last is not None else None,
+			)
+			with io.open(args.stats, "w") as f:
+				json.dump(stats, f)
+
+
+if __name__ == "__main__":
+	ret = main()
+	raise SystemExit(ret)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# g-code sender telemetry
+
+"""
+Counters, histograms and recent events of a sender, cheap enough
+to be updated on every line:
+
+- counters (lines and bytes sent, acknowledgements, resends,
+  flow control stalls, errors);
+- histograms (acknowledgement round-trip time, buffer fill,
+  stall duration), with fixed logarithmic buckets;
+- a ring of the last per-line events, which can be dumped on error;
+- a periodic one-line progress summary (rate, ETA, current line),
+  and snapshots as JSON lines.
+"""
+
+import time
+import json
+import bisect
+import collections
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+	"""
+	Histogram with buckets growing by a factor 2 from `lo`
+	"""
+	__slots__ = ("bounds", "counts", "count", "total", "max")
+
+	def __init__(self, lo=1e-4, nb=24):
+		self.bounds = [lo * (1 << i) for i in range(nb)]
+		self.counts = [0] * (nb + 1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.total += value
+		if value > self.max:
+			self.max = value
+
+	def percentile(self, p):
+		"""
+		:return: upper bound of the bucket holding the p-th percentile
+		"""
+		if self.count == 0:
+			return None
+		target = p / 100 * self.count
+		acc = 0
+		for idx, count in enumerate(self.counts):
+			acc += count
+			if acc >= target and count:
+				if idx < len(self.bounds):
+					return min(self.bounds[idx], self.max)
+				return self.max
+		return self.max
+
+	def as_dict(self):
+		return dict(
+		 count=self.count,
+		 mean=self.total / self.count if self.count else None,
+		 p50=self.percentile(50),
+		 p90=self.percentile(90),
+		 p99=self.percentile(99),
+		 max=self.max,
+		)
+
+
+class Telemetry(object):
+	"""
+	Sender telemetry
+
+	:param ring: number of per-line events kept
+	:param progress_interval: period (s) of the progress summary, None to disable
+	:param export: text file where snapshots are written as JSON lines
+	"""
+	def __init__(self, ring=1024, progress_interval=5.0, export=None):
+		self.counters = collections.Counter()
+		self.rtt = Histogram(lo=1e-4)
+		self.fill = Histogram(lo=1, nb=16)
+		self.stall = Histogram(lo=1e-4)
+		self._ring = [None] * ring
+		self._ring_idx = 0
+		self._progress_interval = progress_interval
+		self._export = export
+		self.total_lines = None # source lines, for the ETA
+		self.timestamps = None # estimated time at the end of each source line, for the ETA
+		self.current_line = None # last acknowledged source line
+		self._first_line = None
+		self.t0 = time.monotonic()
+		self._t_progress = self.t0 + (progress_interval or 0)
+
+	def event(self, kind, ln=None, value=None):
+		"""
+		Record an event in the ring
+		"""
+		idx = self._ring_idx
+		self._ring[idx % len(self._ring)] = (time.monotonic(), kind, ln, value)
+		self._ring_idx = idx + 1
+
+	def events(self):
+		"""
+		:return: the events in the ring, oldest first
+		"""
+		idx = self._ring_idx
+		n = len(self._ring)
+		if idx <= n:
+			return self._ring[:idx]
+		idx %= n
+		return self._ring[idx:] + self._ring[:idx]
+
+	def sent(self, entry, fill):
+		"""
+		:param fill: how much of the controller buffer is in use
+		"""
+		c = self.counters
+		c["lines_sent"] += 1
+		c["bytes_sent"] += len(entry.pkt)
+		self.fill.add(fill)
+		self.event("sent", entry.ln, len(entry.pkt))
+
+	def acked(self, entry, now):
+		rtt = now - entry.t_sent
+		self.counters["acks"] += 1
+		self.rtt.add(rtt)
+		self.event("ack", entry.ln, rtt)
+		if entry.ln is not None:
+			if self._first_line is None:
+				self._first_line = entry.ln
+			self.current_line = entry.ln
+		if self._progress_interval is not None and now >= self._t_progress:
+			self._t_progress = now + self._progress_interval
+			self.progress(now)
+
+	def resend(self, kind, ln=None):
+		self.counters["resends"] += 1
+		self.counters["resends_%s" % kind] += 1
+		self.event("resend", ln, kind)
+
+	def stalled(self, duration):
+		"""
+		Flow control kept the next line from being sent for duration
+		"""
+		self.counters["stalls"] += 1
+		self.stall.add(duration)
+
+	def error(self, msg):
+		self.counters["errors"] += 1
+		self.event("error", None, msg)
+
+	def rate(self, now=None):
+		"""
+		:return: acknowledged lines per second
+		"""
+		dt = (now or time.monotonic()) - self.t0
+		return self.counters["acks"] / dt if dt > 0 else 0.0
+
+	def snapshot(self, now=None):
+		now = now or time.monotonic()
+		return dict(
+		 t=now - self.t0,
+		 line=self.current_line,
+		 total_lines=self.total_lines,
+		 rate=self.rate(now),
+		 counters=dict(self.counters),
+		 rtt=self.rtt.as_dict(),
+		 fill=self.fill.as_dict(),
+		 stall=self.stall.as_dict(),
+		)
+
+	def progress(self, now=None):
+		"""
+		Log a one-line summary, and export a snapshot
+		"""
+		now = now or time.monotonic()
+		rate = self.rate(now)
+		line = self.current_line
+		eta = "?"
+		remaining = None
+		if self.timestamps is not None and line is not None and 0 < line <= len(self.timestamps):
+			remaining = float(self.timestamps[-1] - self.timestamps[line - 1])
+		elif self.total_lines and line is not None and self._first_line is not None:
+			done = line - self._first_line + 1
+			dt = now - self.t0
+			if done > 0:
+				remaining = (self.total_lines - line) * dt / done
+		if remaining is not None:
+			eta = "%d:%02d:%02d" % (remaining // 3600, remaining // 60 % 60, remaining % 60)
+		rtt = self.rtt.percentile(50)
+		logger.info("line %s/%s, %.1f lines/s, ETA %s, rtt p50 %s, resends %d, stalls %d",
+		 line, self.total_lines or "?", rate, eta,
+		 "%.1fms" % (rtt * 1e3) if rtt is not None else "?",
+		 self.counters["resends"], self.counters["stalls"])
+		if self._export is not None:
+			self._export.write(json.dumps(self.snapshot(now)) + "\n")
+			self._export.flush()
+
+	def dump(self, log=logger, level=logging.INFO):
+		"""
+		Log the events in the ring, at the given level
+		"""
+		t0 = self.t0
+		for t, kind, ln, value in self.events():
+			log.log(level, "%10.6f %-6s %s %s", t - t0, kind, ln, value)
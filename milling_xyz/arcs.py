@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# Arc fitting
+# Legal: see LICENSE file.
+
+"""
+Replacement of runs of points of a polyline by circular arcs
+in the XY plane, when they are within a tolerance of an arc.
+
+A run fits an arc when:
+
+- its points are at most `tolerance` away from the circle
+  through its first, middle and last point;
+- the polyline segments do not deviate from the arc by more than
+  `tolerance` (sagitta of each chord);
+- it turns in a single direction, less than a full turn;
+- its Z does not change by more than `tolerance`.
+
+Runs are grown greedily from each point (doubling, then bisection),
+and the candidate starting points are screened for all points at once.
+"""
+
+import logging
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+logger = logging.getLogger(__name__)
+
+
+def _circles(a, b, c):
+	"""
+	:return: centers (n, 2) and radii (n,) of the circles through
+	 XY points a, b, c (n, 2); NaN for collinear points
+	"""
+	bx, by = b[:,0] - a[:,0], b[:,1] - a[:,1]
+	cx, cy = c[:,0] - a[:,0], c[:,1] - a[:,1]
+	d = 2 * (bx * cy - by * cx)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		b2 = bx * bx + by * by
+		c2 = cx * cx + cy * cy
+		ux = (cy * b2 - by * c2) / d
+		uy = (bx * c2 - cx * b2) / d
+	center = np.stack((ux + a[:,0], uy + a[:,1]), axis=1)
+	return center, np.hypot(ux, uy)
+
+
+def _fits(xy, z, center, r, tolerance, max_radius):
+	"""
+	Check runs (m runs of k points) against their circles
+
+	:param xy: (m, k, 2)
+	:param z: (m, k)
+	:param center: (m, 2)
+	:param r: (m,)
+	:return: mask (m,) of the runs fitting, and whether they turn clockwise
+	"""
+	ok = np.isfinite(r) & (r <= max_radius)
+	ok &= np.ptp(z, axis=1) <= tolerance
+	v = xy - center[:,None,:]
+	with np.errstate(invalid="ignore"):
+		ok &= np.max(np.abs(np.hypot(v[...,0], v[...,1]) - r[:,None]), axis=1) <= tolerance
+	cross = v[:,:-1,0] * v[:,1:,1] - v[:,:-1,1] * v[:,1:,0]
+	dot = v[:,:-1,0] * v[:,1:,0] + v[:,:-1,1] * v[:,1:,1]
+	step = np.arctan2(cross, dot)
+	ok &= np.all(step > 0, axis=1) | np.all(step < 0, axis=1)
+	ok &= np.abs(step.sum(axis=1)) < 2 * np.pi - 1e-3
+	chord = np.hypot(*np.moveaxis(np.diff(xy, axis=1), -1, 0))
+	with np.errstate(invalid="ignore"):
+		sagitta = r[:,None] - np.sqrt(np.maximum(r[:,None]**2 - (chord / 2)**2, 0))
+	ok &= np.max(sagitta, axis=1) <= tolerance
+	return ok, step[:,0] < 0
+
+
+class ArcFitter(object):
+	"""
+	Streaming arc fitter
+
+	Points are given with `push()`, moves are obtained as they are
+	decided, as ("lines", (n, 3) end points) or
+	("arc", end point, center (XY), radius, clockwise).
+
+	:param tolerance: maximum deviation from the polyline
+	:param min_points: minimum number of points of an arc (including its start)
+	:param max_points: maximum number of points of an arc, which is also
+	 the lookahead of the stage
+	:param max_radius: larger arcs are left as lines
+	"""
+	def __init__(self, tolerance=0.01, min_points=4, max_points=1024, max_radius=1000.0):
+		if min_points < 3:
+			raise ValueError("Arcs need at least 3 points")
+		self.tolerance = tolerance
+		self.min_points = min_points
+		self.max_points = max(max_points, min_points)
+		self.max_radius = max_radius
+		self._buf = np.empty((0, 3))
+		self.nb_points = 0
+		self.nb_lines = 0
+		self.nb_arcs = 0
+
+	def push(self, points):
+		"""
+		Add points to the polyline; the first point ever given is its start
+
+		:return: list of the moves decided
+		"""
+		points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+		self.nb_points += len(points)
+		self._buf = np.concatenate((self._buf, points))
+		return self._process(final=False)
+
+	def flush(self):
+		"""
+		:return: list of the remaining moves
+		"""
+		return self._process(final=True)
+
+	def _check(self, p, i, j):
+		"""
+		Check the run of points i..j of p
+		"""
+		run = p[i:j+1]
+		k = (i + j) // 2 - i
+		center, r = _circles(run[None,0,:2], run[None,k,:2], run[None,-1,:2])
+		ok, cw = _fits(run[None,:,:2], run[None,:,2], center, r, self.tolerance, self.max_radius)
+		return ok[0], center[0], r[0], cw[0]
+
+	def _process(self, final):
+		p = self._buf
+		n = len(p)
+		m = self.min_points
+		# Decisions need max_points of lookahead, unless at the end
+		limit = n - 1 if final else n - self.max_points
+		if limit <= 0 or n < 2:
+			return []
+
+		# Screen the starting points: runs of min_points points
+		if n >= m:
+			w = sliding_window_view(p, (m, 3))[:,0]
+			center, r = _circles(w[:,0,:2], w[:,(m-1)//2,:2], w[:,-1,:2])
+			candidate, _ = _fits(w[:,:,:2], w[:,:,2], center, r, self.tolerance, self.max_radius)
+			starts = np.flatnonzero(candidate)
+		else:
+			starts = np.empty(0, dtype=np.int64)
+
+		moves = list()
+		i = 0
+		idx_start = 0
+		while i < limit:
+			idx_start += np.searchsorted(starts[idx_start:], i)
+			if idx_start >= len(starts) or starts[idx_start] >= limit:
+				moves.append(("lines", p[i+1:limit+1]))
+				self.nb_lines += limit - i
+				i = limit
+				break
+			s = int(starts[idx_start])
+			if s > i:
+				moves.append(("lines", p[i+1:s+1]))
+				self.nb_lines += s - i
+				i = s
+
+			good = i + m - 1
+			ok, center, r, cw = self._check(p, i, good)
+			bad = None
+			end = min(n - 1, i + self.max_points - 1)
+			while good < end:
+				k = min(end, i + 2 * (good - i))
+				res = self._check(p, i, k)
+				if not res[0]:
+					bad = k
+					break
+				good = k
+				ok, center, r, cw = res
+			if bad is not None:
+				while bad - good > 1:
+					k = (good + bad) // 2
+					res = self._check(p, i, k)
+					if res[0]:
+						good = k
+						ok, center, r, cw = res
+					else:
+						bad = k
+			moves.append(("arc", p[good], center, float(r), bool(cw)))
+			self.nb_arcs += 1
+			i = good
+
+		self._buf = p[i:]
+		return moves
+
+	def report(self):
+		"""
+		Log the reduction of the number of moves
+		"""
+		nb_in = max(self.nb_points - 1, 0)
+		nb_out = self.nb_lines + self.nb_arcs
+		logger.info("Arc fitting: %d segments -> %d lines + %d arcs (%.1f%% fewer moves)",
+		 nb_in, self.nb_lines, self.nb_arcs, 100 * (1 - nb_out / nb_in) if nb_in else 0.0)
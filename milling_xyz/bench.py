@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# PYTHON_ARGCOMPLETE_OK
+# Benchmarks of the G-code writer
+# Legal: see LICENSE file.
+
+import sys, io
+import time
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+def raster(nb_points, step=0.1, width=100.0):
+	"""
+	Zig-zag raster finish over a wavy surface
+	"""
+	nx = int(width / step)
+	idx = np.arange(nb_points)
+	row, col = np.divmod(idx, nx)
+	col = np.where(row % 2 == 0, col, nx - 1 - col)
+	x = col * step
+	y = row * step
+	z = -1 + 0.5 * np.sin(x / 7) * np.cos(y / 11)
+	return np.column_stack((x, y, z))
+
+
+def bench_polyline(points, feed=None):
+	"""
+	Compare line_to() calls with polyline_to()
+
+	:return: dict of results
+	"""
+	from .gcode import CodeGen
+
+	cg = CodeGen()
+	t0 = time.perf_counter()
+	res = list()
+	for x, y, z in points.tolist():
+		res += cg.line_to(x=x, y=y, z=z, feed=feed)
+	text_ref = "".join(x + "\n" for x in res)
+	dt_ref = time.perf_counter() - t0
+
+	cg = CodeGen()
+	t0 = time.perf_counter()
+	f = io.StringIO()
+	cg.polyline_to(points, feed=feed, out=f)
+	text = f.getvalue()
+	dt = time.perf_counter() - t0
+
+	return dict(
+	 points=len(points),
+	 lines=len(res),
+	 line_to=dt_ref,
+	 polyline_to=dt,
+	 speedup=dt_ref / dt,
+	 identical=text == text_ref,
+	)
+
+
+def main(args=None):
+
+	if args is None:
+		args = sys.argv[1:]
+
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	 description="G-code writer benchmarks",
+	)
+
+	parser.add_argument("--log-level",
+	 default="WARNING",
+	 help="Logging level (eg. INFO, see Python logging docs)",
+	)
+
+	parser.add_argument("--points",
+	 help="number of points of the synthetic toolpath",
+	 type=int,
+	 default=200000,
+	)
+
+	try:
+		import argcomplete
+		argcomplete.autocomplete(parser)
+	except:
+		pass
+
+	args = parser.parse_args(args)
+
+	logging.basicConfig(
+	 datefmt="%Y%m%dT%H%M%S",
+	 level=getattr(logging, args.log_level),
+	 format="%(asctime)-15s %(name)s %(levelname)s %(message)s"
+	)
+
+	res = bench_polyline(raster(args.points))
+	print("polyline_to: %(points)d points, %(lines)d lines," \
+	 " line_to %(line_to).3f s, polyline_to %(polyline_to).3f s," \
+	 " speedup %(speedup).1f, identical: %(identical)s" % res)
+	if not res["identical"]:
+		return 1
+
+
+if __name__ == "__main__":
+	ret = main()
+	raise SystemExit(ret)
@@ -3,23 +3,123 @@
 # G-code writer
 # Legal: see LICENSE file.
 
-import sys, re, io, json, warnings
+import sys, re, io, json, math, warnings
 import logging
 
 import numpy as np
 
 
 from .feeds_and_speeds import compute_feed_basic
+from .toolpath import Toolpath
+from .arcs import ArcFitter
 
 logger = logging.getLogger(__name__)
 
 
+def _scaled(values, digits):
+	"""
+	:return: integers q such that q / 10**digits is round(value, digits)
+	"""
+	s = values * 10.0**digits
+	q = np.rint(s)
+	# The product is inexact; close to ties, do it the exact way
+	doubt = np.flatnonzero(np.abs(s - np.floor(s) - 0.5) < np.abs(s) * 1e-15 + 1e-9)
+	for idx in doubt.tolist():
+		q[idx] = round(round(float(values[idx]), digits) * 10**digits)
+	return q.astype(np.int64)
+
+
+def _ascii_number(q, digits):
+	"""
+	Format q / 10**digits as CodeGen.round() would, vectorized
+
+	:return: (n, w) uint8 array of ASCII, padded with NULs
+	"""
+	neg = q < 0
+	ip, fp = np.divmod(np.abs(q), 10**digits)
+	nint = len(str(int(ip.max()))) if len(ip) else 1
+	cols = [np.where(neg, ord("-"), 0)]
+	for k in range(nint-1, -1, -1):
+		w = 10**k
+		cols.append(np.where((ip >= w) | (k == 0), 48 + (ip // w) % 10, 0))
+	if digits:
+		cols.append(np.where(fp != 0, ord("."), 0))
+		for k in range(digits):
+			w = 10**(digits - 1 - k)
+			cols.append(np.where(fp % (w * 10) != 0, 48 + (fp // w) % 10, 0))
+	return np.stack(cols, axis=1).astype(np.uint8)
+
+
+def _write_lines(out, lines):
+	"""
+	Write G-code lines to a text or binary file
+
+	:return: number of lines
+	"""
+	text = "".join(x + "\n" for x in lines)
+	if isinstance(out, io.TextIOBase):
+		out.write(text)
+	else:
+		out.write(text.encode("utf-8", "surrogateescape"))
+	return len(lines)
+
+
+def _ascii_const(s, mask):
+	"""
+	:return: (n, len(s)) uint8 array of ASCII s where mask is set, NULs elsewhere
+	"""
+	return np.frombuffer(s.encode("ascii"), dtype=np.uint8)[None,:] * mask[:,None].astype(np.uint8)
+
+
+def _column(col):
+	"""
+	:return: float values of an object array of number strings,
+	 NaN where empty, and where they are given
+	"""
+	present = col != ""
+	res = np.full(len(col), np.nan)
+	res[present] = col[present].astype(np.float64)
+	return res, present
+
+
+def _split_comment(line):
+	"""
+	:return: code and comment (starting with ";" or "(") parts of a line
+	"""
+	m = _re_comment.search(line)
+	if m is None:
+		return line, ""
+	return line[:m.start()], line[m.start():]
+
+
+def _shorten_number(m):
+	ws, sign, ip, fp = m.groups()
+	if fp:
+		return ws + sign + ip + "." + fp
+	if ip.strip("0") == "":
+		return ws + "0"
+	return ws + sign + ip
+
+
+def _strip_trailing_zeros(line):
+	"""
+	:return: line with the trailing zeros of the decimals of its words removed,
+	 eg. "G1 X1.500 Y2.000" -> "G1 X1.5 Y2"
+	"""
+	code, comment = _split_comment(line)
+	return _re_decimal.sub(_shorten_number, code) + comment
+
+
+_re_comment = re.compile(r"[;(]")
+_re_decimal = re.compile(r"(?<=[A-Za-z])([ \t]*)([-+]?)(\d*)\.(\d*?)0*(?!\d)")
+
+
 class PostprocFormatter(object):
 	"""
 	post-processor that only does simple line-based formatting operations.
 	"""
 
-	STRIP_TRAILING_ZEROS = 1<<2
+	STRIP_TRAILING_ZEROS = 1<<1
 	STRIP_SPACES = 1<<0
 	STRIP_COMMENTS = 1<<2
 	STRIP_CHECKSUMS = 1<<3
@@ -41,7 +141,7 @@ class PostprocFormatter(object):
 		for arg in args:
 
 			if self._donttouch(arg):
-				arg = arg.encode("ascii")
+				arg = arg.encode("utf-8", "surrogateescape")
 				self._println(arg)
 				continue
 
@@ -66,7 +166,7 @@ class PostprocFormatter(object):
 					raise ValueError(arg)
 
 			if (flags & PostprocFormatter.STRIP_TRAILING_ZEROS) != 0:
-				pass
+				arg = _strip_trailing_zeros(arg)
 
 			if (flags & PostprocFormatter.STRIP_SPACES) != 0:
 				arg = arg.replace(" ", "")
@@ -91,7 +191,7 @@ class PostprocFormatter(object):
 					last_char = char
 				arg = "".join(arg_out)
 
-			arg = arg.encode("ascii")
+			arg = arg.encode("utf-8", "surrogateescape")
 
 			if (flags & PostprocFormatter.ADD_CHECKSUM) != 0 and not b"*" in arg:
 				cs = 0
@@ -108,39 +208,625 @@ class PostprocFormatterStateful(object):
 	"""
 	Post-processor that doesn't change the meaning of the commands,
 	but can perform some operations because it has an internal state.
+
+	Lines (strings) are given to `emit()`, the compacted lines (strings,
+	so the stage can be followed by a PostprocFormatter) are given to
+	`println`; lines which end up doing nothing are dropped.
+
+	Lines that can't be understood (or carrying a checksum) are passed
+	as-is, and make the stage forget what it knew.
 	"""
 	STRIP_REDUNDANT_WORDS = 1<<0 # eg. G91 Z1; G91 Z1 -> G91 Z1; Z1
 	STRIP_REDUNDANT_COORDS = 1<<1 # eg. G90; G1 X1 Z1; G1 X1 Z2 -> G90; G1 X1 Z1; G1 Z2
-
-	def __init__(self, println):
+	STRIP_TRAILING_ZEROS = 1<<2 # eg. G1 X1.500 -> G1 X1.5
+	STRIP_REDUNDANT_MOTION = 1<<3 # eg. G1 X1; G1 X2 -> G1 X1; X2 (needs modal motion, not Marlin)
+
+	MODAL_GROUPS = {
+	 "0": "motion", "1": "motion", "2": "motion", "3": "motion", "80": "motion",
+	 "38.2": "motion", "38.3": "motion", "38.4": "motion", "38.5": "motion",
+	 "17": "plane", "18": "plane", "19": "plane",
+	 "90": "distance", "91": "distance",
+	 "90.1": "arc_distance", "91.1": "arc_distance",
+	 "93": "feed_mode", "94": "feed_mode", "95": "feed_mode",
+	 "20": "units", "21": "units",
+	 "40": "cutter_comp", "41": "cutter_comp", "42": "cutter_comp",
+	 "43": "tool_length", "43.1": "tool_length", "49": "tool_length",
+	 "54": "coords", "55": "coords", "56": "coords", "57": "coords", "58": "coords", "59": "coords",
+	 "61": "path", "61.1": "path", "64": "path",
+	}
+
+	# Changing these makes the current position (in program coordinates) unknown
+	POSITION_GROUPS = ("units", "coords", "tool_length")
+	# These take their value from other words (not coordinates), so are never redundant
+	VALUED = ("43", "43.1")
+
+	AXES = "XYZABCUVW"
+
+	_re_word = re.compile(r"\s*([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+	_re_line = re.compile(r"(?:\s*[A-Za-z]\s*[-+]?(?:\d+\.?\d*|\.\d+))*\s*")
+	_re_comment = re.compile(r"(?:\([^)]*\)\s*)*(?:;.*|\([^)]*)?")
+
+	def __init__(self, println, flags=STRIP_REDUNDANT_WORDS|STRIP_REDUNDANT_COORDS):
 		self._println = println
-		self._last_x = None
-		self._last_y = None
-		self._last_z = None
+		self._flags = flags
+		self._donttouch = lambda x: x.startswith("M117")
+		self._modal = dict()
+		self._pos = dict()
 		self._last_f = None
-		self._last_e = None
-		self._last_absrel = None
+		self.lines_in = 0
+		self.lines_out = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+
+	def reset(self):
+		"""
+		Forget the modal state and position
+		"""
+		self._modal.clear()
+		self._pos.clear()
+		self._last_f = None
+
+	def get_state(self):
+		"""
+		:return: copy of the modal state, position and feed
+		"""
+		return dict(self._modal), dict(self._pos), self._last_f
+
+	def set_state(self, state):
+		modal, pos, self._last_f = state
+		self._modal = dict(modal)
+		self._pos = dict(pos)
 
 	def emit(self, *args):
-		pass
+		if len(args) == 1 and (isinstance(args[0], list) or isinstance(args[0], tuple)):
+			args = args[0]
+
+		for arg in args:
+			self.lines_in += 1
+			self.bytes_in += len(arg) + 1
+			arg = self.compact(arg)
+			if arg is None:
+				continue
+			self.lines_out += 1
+			self.bytes_out += len(arg) + 1
+			self._println(arg)
+
+	def compact(self, line):
+		"""
+		Update the state with a line
 
+		:return: the compacted line, or None if it does nothing
+		"""
+		if self._donttouch(line):
+			return line
+
+		code, comment = _split_comment(line)
+		if comment and self._re_comment.fullmatch(comment) is None:
+			# Words after a parenthesis comment
+			logger.debug("Not understood, passing: %s", line)
+			self.reset()
+			return line
+
+		if not code.strip():
+			return line
+
+		if self._re_line.fullmatch(code) is None:
+			logger.debug("Not understood, passing: %s", line)
+			self.reset()
+			return line
+
+		words = [(m, m.group(1).upper(), m.group(2)) for m in self._re_word.finditer(code)]
+		keep = self._process(words)
+
+		if "*" in line:
+			# The checksum would become invalid
+			return line
+
+		if all(keep) and (self._flags & PostprocFormatterStateful.STRIP_TRAILING_ZEROS) == 0:
+			return line
+
+		code_out = "".join(m.group(0) for (m, letter, value), k in zip(words, keep) if k).lstrip()
+		if not code_out and not comment:
+			return None
+		if (self._flags & PostprocFormatterStateful.STRIP_TRAILING_ZEROS) != 0:
+			code_out = _re_decimal.sub(_shorten_number, code_out)
+		if comment:
+			if code_out:
+				code_out += code[words[-1][0].end():]
+			return code_out + comment
+		return code_out
+
+	def _process(self, words):
+		"""
+		Update the state with the words of a line
 
-class PostprocLevel(object):
+		:return: list of whether each word is kept
+		"""
+		cls = PostprocFormatterStateful
+		flags = self._flags
+		modal = self._modal
+		pos = self._pos
+		keep = [True] * len(words)
+
+		# G-words first, as they apply to the whole line
+		nonmodal = False
+		redundant_motion = []
+		has_m = False
+		forget = False
+		for idx, (m, letter, value) in enumerate(words):
+			if letter == "M":
+				has_m = True
+				if float(value) == 6:
+					forget = True
+			if letter != "G":
+				continue
+			g = "%g" % float(value)
+			group = cls.MODAL_GROUPS.get(g)
+			if group is None:
+				if g != "4":
+					nonmodal = True
+				continue
+			if modal.get(group) == g and g not in cls.VALUED:
+				if group == "motion":
+					redundant_motion.append(idx)
+					keep[idx] = (flags & cls.STRIP_REDUNDANT_MOTION) == 0
+				else:
+					keep[idx] = (flags & cls.STRIP_REDUNDANT_WORDS) == 0
+				continue
+			if group in cls.POSITION_GROUPS:
+				# Changed, or unknown before: so is the position now
+				forget = True
+			if g in cls.VALUED:
+				nonmodal = True
+			modal[group] = g
+
+		if nonmodal or has_m:
+			# Axis words aren't coordinates of a move; any motion words must stay
+			for idx, (m, letter, value) in enumerate(words):
+				if letter == "G":
+					keep[idx] = True
+				elif letter == "F":
+					self._last_f = None
+			if nonmodal or forget:
+				pos.clear()
+			return keep
+
+		if forget:
+			pos.clear()
+
+		motion = modal.get("motion")
+		distance = modal.get("distance")
+		inverse_time = modal.get("feed_mode") == "93"
+		strip_coords = (flags & cls.STRIP_REDUNDANT_COORDS) != 0 and motion in ("0", "1")
+
+		nb_axes = 0
+		moved = False
+		for idx, (m, letter, value) in enumerate(words):
+			if letter == "F":
+				f = float(value)
+				if (flags & cls.STRIP_REDUNDANT_WORDS) != 0 and not inverse_time \
+				 and f == self._last_f:
+					keep[idx] = False
+				self._last_f = None if inverse_time else f
+			elif letter in cls.AXES:
+				nb_axes += 1
+				v = float(value)
+				if motion is None or motion == "80" or motion.startswith("38"):
+					pos.pop(letter, None)
+					continue
+				if distance == "90":
+					if strip_coords and pos.get(letter) == v:
+						keep[idx] = False
+					else:
+						moved = True
+					pos[letter] = v
+				elif distance == "91":
+					if strip_coords and v == 0:
+						keep[idx] = False
+					else:
+						moved = True
+					if letter in pos:
+						pos[letter] += v
+				else:
+					pos.pop(letter, None)
+					moved = True
+
+		if nb_axes and not moved and motion in ("0", "1"):
+			# Null move, a repeated motion word is only needed to carry other words
+			if not any(k for idx, k in enumerate(keep) if idx not in redundant_motion):
+				for idx in redundant_motion:
+					keep[idx] = False
+
+		return keep
+
+	def report(self):
+		"""
+		Log the size reduction
+		"""
+		logger.info("Compaction: %d lines -> %d, %d bytes -> %d (%.1f%% saved)",
+		 self.lines_in, self.lines_out, self.bytes_in, self.bytes_out,
+		 100 * (1 - self.bytes_out / self.bytes_in) if self.bytes_in else 0.0)
+
+
+class _PostprocMoves(object):
 	"""
-	G-code post-processor that will change XYZ
+	Base of the G-code post-processors rewriting G1 moves
+
+	Lines are processed by batches. The state is followed over them,
+	and the G1 moves under G90 and G94, with only XYZ and F words,
+	are handed to `_rewrite()` as arrays; runs of plain lines (G0/G1 X Y Z F)
+	are parsed as arrays too. Lines not understood make the position
+	unknown, and the moves aren't rewritten until it is known again.
+
+	:param println: called with each output line (string)
+	:param batch: number of lines processed at once
 	"""
-	def __init__(self):
-		pass
+	_num = r"[ \t]*([-+]?(?:\d+\.?\d*|\.\d+))[ \t]*"
+	# Lines with only G0/G1 X Y Z F words (in this order), or anything else (last group)
+	_re_plain = re.compile(r"^(?:[ \t]*(?:G0*([01])(?:\.0*)?(?![\d.])[ \t]*)?"
+	 r"(?:X" + _num + r")?(?:Y" + _num + r")?(?:Z" + _num + r")?(?:F" + _num + r")?\r?|(.*))$",
+	 re.MULTILINE | re.IGNORECASE)
+
+	def __init__(self, println, batch=1<<16):
+		self._println = println
+		self.batch = batch
+		self._lines = list()
+		self._motion = None
+		self._absolute = None
+		self._inverse_time = False
+		self._feed = float("NaN")
+		self._pos = [float("NaN")] * 3
+		self.lines_in = 0
+		self.lines_out = 0
+
+	def emit(self, *args):
+		if len(args) == 1 and (isinstance(args[0], list) or isinstance(args[0], tuple)):
+			args = args[0]
+
+		self._lines.extend(args)
+		if len(self._lines) >= self.batch:
+			self.flush()
+
+	def flush(self):
+		"""
+		Process the lines given so far
+		"""
+		lines = self._lines
+		self._lines = list()
+		self.lines_in += len(lines)
+
+		out = list(lines)
+		moves = list() # (idx, start, end, feed, rate, comment) of other lines
+		runs = list() # (idx, start, end, feed, rate) arrays of plain moves
+		ends = list() # (idx, end, code without Z, comment) of the other moves
+
+		cols = self._re_plain.findall("\n".join(lines)) if lines else []
+		if len(cols) != len(lines):
+			cols = [("",) * 5 + (line,) for line in lines]
+		a = 0
+		for i in [i for i, c in enumerate(cols) if c[5]] + [len(lines)]:
+			if i > a:
+				self._parse_run(lines, cols, a, i, moves, runs, ends)
+			if i < len(lines):
+				self._parse_line(i, lines[i], moves, ends)
+			a = i + 1
+
+		if moves:
+			runs.append((
+			 np.array([x[0] for x in moves], dtype=np.int64),
+			 np.array([x[1] for x in moves]),
+			 np.array([x[2] for x in moves]),
+			 np.array([np.nan if x[3] is None else x[3] for x in moves]),
+			 np.array([x[4] for x in moves]),
+			))
+		if runs:
+			idx, start, end, feed, rate = (np.concatenate(x) for x in zip(*runs))
+			order = np.argsort(idx, kind="stable")
+			comments = dict((x[0], x[5]) for x in moves if x[5])
+			self._rewrite(out, (idx[order], start[order], end[order], feed[order], rate[order], comments), ends)
+		elif ends:
+			self._rewrite(out, None, ends)
+
+		for res in out:
+			if isinstance(res, str):
+				self.lines_out += 1
+				self._println(res)
+			else:
+				self.lines_out += len(res)
+				for line in res:
+					self._println(line)
+
+	def _rewrite(self, out, moves, ends):
+		"""
+		Replace lines of out by lists of lines
+
+		:param moves: idx, start, end, feed (F word, or NaN), rate (feed rate
+		 in effect, or NaN) arrays of the G1 moves, and dict of their comments
+		:param ends: list of (idx, end, code without Z, comment) of the other moves
+		"""
+		raise NotImplementedError()
 
+	def _parse_run(self, lines, cols, a, b, moves, runs, ends):
+		"""
+		Follow the state over plain lines a to b (`_re_plain` groups),
+		and collect the moves, as arrays when the state allows it
+		"""
+		while a < b and not (self._absolute and self._motion in ("0", "1") and not self._inverse_time):
+			self._parse_line(a, lines[a], moves, ends)
+			a += 1
+		if b - a < 64:
+			# Not worth the arrays
+			for i in range(a, b):
+				self._parse_line(i, lines[i], moves, ends)
+			return
+
+		n = b - a
+		rank = np.arange(n)
+		g, x, y, z, f = (np.array(c, dtype=object) for c in tuple(zip(*cols[a:b]))[:5])
+
+		def filled(present, values, first):
+			# Last given value, on each line
+			last = np.maximum.accumulate(np.where(present, rank, -1))
+			return np.where(last >= 0, values[last], first)
+
+		motion = filled(g != "", np.where(g == "1", 1, 0), int(self._motion))
+		feed, present = _column(f)
+		rate = filled(present, feed, self._feed)
+		end = np.empty((n, 3))
+		axes = np.zeros(n, dtype=bool)
+		for k, col in enumerate((x, y, z)):
+			values, present = _column(col)
+			end[:,k] = filled(present, values, self._pos[k])
+			axes |= present
+		start = np.empty((n, 3))
+		start[0] = self._pos
+		start[1:] = end[:-1]
+		self._pos = end[-1].tolist()
+		self._motion = str(motion[-1])
+		self._feed = float(rate[-1])
+
+		known = np.isfinite(end).all(axis=1) & axes
+		split = known & np.isfinite(start).all(axis=1) & (motion == 1)
+		sel = np.flatnonzero(split)
+		runs.append((sel + a, start[sel], end[sel], feed[sel], rate[sel]))
+
+		for i in np.flatnonzero(known & ~split).tolist():
+			code = " ".join(letter + v for letter, v in zip("GXYF", (g[i], x[i], y[i], f[i])) if v)
+			ends.append((a + i, end[i].tolist(), code, ""))
+
+	def _parse_line(self, idx, line, moves, ends):
+		"""
+		Follow the state over a line, and collect its move
+		"""
+		S = PostprocFormatterStateful
+		nan = float("NaN")
+		code, comment = _split_comment(line)
+		if not code.strip():
+			return
+		if (comment and S._re_comment.fullmatch(comment) is None) \
+		 or S._re_line.fullmatch(code) is None:
+			self._pos = [nan] * 3
+			return
+
+		words = [(m, m.group(1).upper(), float(m.group(2))) for m in S._re_word.finditer(code)]
+		other = False # words making the line not rewritable
+		nonmodal = False
+		axes = dict()
+		feed = None
+		for m, letter, value in words:
+			if letter == "G":
+				g = "%g" % value
+				if g in ("0", "1", "2", "3"):
+					self._motion = g
+				elif g in ("90", "91"):
+					self._absolute = g == "90"
+					other = True
+				elif g in ("93", "94"):
+					if self._inverse_time != (g == "93"):
+						self._feed = nan
+					self._inverse_time = g == "93"
+					other = True
+				elif S.MODAL_GROUPS.get(g) in ("plane", "cutter_comp", "path", "arc_distance"):
+					other = True
+				else:
+					nonmodal = True
+			elif letter in "XYZ":
+				axes["XYZ".index(letter)] = value
+			elif letter == "F":
+				feed = value
+			else:
+				other = True
+
+		if feed is not None and not self._inverse_time:
+			self._feed = feed
+		if nonmodal:
+			self._pos = [nan] * 3
+			return
+		if not axes:
+			return
+
+		start = self._pos
+		if self._absolute is None or self._motion not in ("0", "1", "2", "3"):
+			self._pos = [nan] * 3
+			return
+		if not self._absolute:
+			self._pos = [v + axes.get(i, 0) for i, v in enumerate(start)]
+			return
+
+		end = [axes.get(i, v) for i, v in enumerate(start)]
+		self._pos = end
+		if not all(v == v for v in end):
+			return
+
+		if self._motion == "1" and not other and not self._inverse_time \
+		 and all(v == v for v in start):
+			moves.append((idx, start, end, feed, self._feed, comment.strip()))
+		else:
+			kept = "".join(m.group(0) for m, letter, value in words if letter != "Z")
+			ends.append((idx, end, kept.strip(), comment.strip()))
 
 
-class SegmentInserter(object):
+def _segment_lines(points, seg, prev, feed, digits):
 	"""
-	Insert intermediate points at a certain time frequency.
+	Format segments replacing moves, as CodeGen does: G1 and the axes
+	which change, and the feed on the first segment of each move
+
+	:param points: (m, 3) end points of the segments
+	:param seg: (m,) sorted indices of the moves they belong to
+	:param prev: (n, 3) positions before the moves, NaN to always write an axis
+	:param feed: (n,) feeds of the moves, NaN for none
+	:return: lines, and bounds of the lines of each move in them
 	"""
+	m = len(seg)
+	q = np.stack([_scaled(points[:,k], digits) for k in range(3)], axis=1)
+	first = np.ones(m, dtype=bool)
+	first[1:] = seg[1:] != seg[:-1]
+	p = prev[seg[first]]
+	known = np.isfinite(p)
+	qp = np.stack([_scaled(np.where(known[:,k], p[:,k], 0), digits) for k in range(3)], axis=1)
+	show = np.ones((m, 3), dtype=bool)
+	show[1:] = q[1:] != q[:-1]
+	show[first] = ~known | (q[first] != qp)
+	show[~show.any(axis=1)] = True
+
+	f = feed[seg]
+	show_f = first & ~np.isnan(f)
+	ones = np.ones(m, dtype=bool)
+	blocks = [_ascii_const("G1", ones)]
+	for k, name in enumerate("XYZ"):
+		blocks.append(_ascii_const(" " + name, show[:,k]))
+		blocks.append(_ascii_number(q[:,k], digits) * show[:,k,None].astype(np.uint8))
+	blocks.append(_ascii_const(" F", show_f))
+	blocks.append(_ascii_number(_scaled(np.nan_to_num(f), 3), 3) * show_f[:,None].astype(np.uint8))
+	blocks.append(_ascii_const("\n", ones))
+	text = np.concatenate(blocks, axis=1)
+	lines = text[text != 0].tobytes().decode("ascii").split("\n")
+	return lines, np.flatnonzero(first).tolist() + [m]
+
+
+class PostprocLevel(_PostprocMoves):
+	"""
+	G-code post-processor that will change XYZ
 
+	Adds the offsets of a `HeightMap` to the Z of the moves under G90,
+	splitting G1 moves on the cells of the height map.
+	G0 moves, arcs, and moves with other words (eg. E) only get their
+	end point leveled.
+
+	:param println: called with each output line (string)
+	:param heightmap: `HeightMap`
+	:param batch: number of lines processed at once
+	:param accuracy: digits of the output coordinates (as `CodeGen`)
+	"""
+	def __init__(self, println, heightmap, batch=1<<16, accuracy=4):
+		super().__init__(println, batch=batch)
+		self.heightmap = heightmap
+		self.accuracy = accuracy
+		self.nb_split = 0
+		self.nb_leveled = 0
+
+	def _rewrite(self, out, moves, ends):
+		hm = self.heightmap
+		acc = self.accuracy
+
+		if moves is not None:
+			idx, start, end, feed, rate, comments = moves
+			points, seg = hm.subdivide(start, end)
+			points[:,2] += hm.offsets(points[:,0], points[:,1])
+			prev = start.copy()
+			prev[:,2] = np.nan
+			res, bounds = _segment_lines(points, seg, prev, feed, acc)
+			for i, a, b in zip(idx.tolist(), bounds[:-1], bounds[1:]):
+				out[i] = res[a:b]
+			for i, comment in comments.items():
+				out[i][-1] += " " + comment
+			self.nb_split += len(seg) - len(idx)
+			self.nb_leveled += len(idx)
+
+		if ends:
+			end = np.array([x[1] for x in ends])
+			z = end[:,2] + hm.offsets(end[:,0], end[:,1])
+			text = np.concatenate((_ascii_number(_scaled(z, acc), acc),
+			 _ascii_const("\n", np.ones(len(z), dtype=bool))), axis=1)
+			res = text[text != 0].tobytes().decode("ascii").split("\n")
+			for (i, _, code, comment), sz in zip(ends, res):
+				# Only the end point, with a new Z word at the end
+				out[i] = code + " Z" + sz + (" " + comment if comment else "")
+			self.nb_leveled += len(ends)
+
+	def report(self):
+		"""
+		Log what was done
+		"""
+		logger.info("Leveling: %d moves leveled, %d lines added by splitting, %d lines -> %d",
+		 self.nb_leveled, self.nb_split, self.lines_in, self.lines_out)
 
 
+class SegmentInserter(_PostprocMoves):
+	"""
+	Insert intermediate points at a certain time frequency.
+
+	G1 moves under G90 are split in equal segments, lasting at most
+	max_time at the feed rate in effect, and at most max_length long.
+	Moves with other words (eg. E), arcs, and G93 moves are left as they are,
+	as are moves whose feed rate is unknown, for the time.
+
+	:param println: called with each output line (string)
+	:param max_time: maximum duration of the segments (s), or None
+	:param max_length: maximum length of the segments, or None
+	:param batch: number of lines processed at once
+	:param accuracy: digits of the output coordinates (as `CodeGen`)
+	"""
+	def __init__(self, println, max_time=None, max_length=None, batch=1<<16, accuracy=4):
+		if not max_time and not max_length:
+			raise ValueError("A maximum segment time or length is needed")
+		super().__init__(println, batch=batch)
+		self.max_time = max_time
+		self.max_length = max_length
+		self.accuracy = accuracy
+		self.nb_split = 0
+		self.nb_added = 0
+
+	def _rewrite(self, out, moves, ends):
+		if moves is None:
+			return
+		idx, start, end, feed, rate, comments = moves
+		length = np.sqrt(((end - start)**2).sum(axis=1))
+		count = np.ones(len(idx))
+		if self.max_length:
+			count = np.maximum(count, np.ceil(length / self.max_length))
+		if self.max_time:
+			with np.errstate(divide="ignore", invalid="ignore"):
+				steps = np.ceil(length / (rate / 60) / self.max_time)
+			count = np.where(np.isfinite(steps), np.maximum(count, steps), count)
+		sel = np.flatnonzero(count > 1)
+		if len(sel) == 0:
+			return
+
+		n = count[sel].astype(np.int64)
+		total = int(n.sum())
+		seg = np.repeat(np.arange(len(sel)), n)
+		offset = np.cumsum(n) - n
+		t = (np.arange(total) - offset[seg] + 1) / n[seg]
+		a, b = start[sel], end[sel]
+		points = a[seg] + t[:,None] * (b - a)[seg]
+		points[offset + n - 1] = b
+		res, bounds = _segment_lines(points, seg, a, feed[sel], self.accuracy)
+		for i, lo, hi in zip(idx[sel].tolist(), bounds[:-1], bounds[1:]):
+			out[i] = res[lo:hi]
+		for i, comment in comments.items():
+			if not isinstance(out[i], str):
+				out[i][-1] += " " + comment
+		self.nb_split += len(sel)
+		self.nb_added += total - len(sel)
+
+	def report(self):
+		"""
+		Log the number of lines added
+		"""
+		logger.info("Segment insertion: %d moves split, %d lines added, %d lines -> %d",
+		 self.nb_split, self.nb_added, self.lines_in, self.lines_out)
+
 
 class CodeGen(object):
 	"""
@@ -171,7 +857,7 @@ class CodeGen(object):
 		self.curz = float("NaN")
 		self.curf = float("NaN")
 		self.cure = float("NaN")
-		self.duration = 0 # seconds
+		self.duration = 0 # seconds, at the nominal feeds (see motion.Planner for a realistic estimate)
 		self.G0_speed = 5000
 		self.accuracy = 4 # digits
 		self.use_G0 = True
@@ -184,6 +870,7 @@ class CodeGen(object):
 		self.length = 0
 		self.duration = 0
 		self.fake = False
+		self.arc_ijk = False # IJK rather than R form arcs
 
 	def round(self, *args, **kw) -> str:
 		"""
@@ -284,6 +971,187 @@ class CodeGen(object):
 		return res
 
 
+	def polyline_to(self, points, rapid=False, feed=None, e=None, out=None):
+		"""
+		Generate opcodes for successive lines, as many calls to
+		`line_to(x, y, z, rapid=rapid, feed=feed, e=e)` would
+
+		:param points: (n, 3) array of XYZ, or (n, 2) of XY
+		:param feed: scalar or array
+		:param e: scalar or array, or None
+		:param out: file (text or binary) to write the G-code to
+		:return: list of G-code lines, or their number if written to out
+		"""
+		points = np.asarray(points, dtype=np.float64)
+		if points.ndim == 2 and points.shape[1] == 2:
+			points = np.column_stack((points, np.full(len(points), self.curz)))
+		return self.toolpath_to(Toolpath(points, f=feed, e=e, rapid=rapid), out=out)
+
+	def toolpath_to(self, toolpath, out=None, chunk=1<<16):
+		"""
+		Generate opcodes for a `Toolpath`, as `polyline_to()`
+		"""
+		n = len(toolpath)
+		x, y, z = toolpath.x, toolpath.y, toolpath.z
+		f, e, rapid = toolpath.f, toolpath.e, toolpath.rapid
+		acc = self.accuracy
+
+		if e is not None and rapid.any():
+			raise AssertionError("Rapid moves cannot extrude")
+
+		big = 10.0**(17 - acc)
+		fields = [x, y, z] + ([] if e is None else [e])
+		if not all(np.all(np.abs(v) < big) for v in fields) \
+		 or not np.all(np.isnan(f) | (np.abs(f) < big)):
+			# Non-finite or huge values are not formatted by the fast path
+			return self._toolpath_to_slow(toolpath, out)
+
+		if e is not None and n:
+			self.cure = float(e[-1])
+
+		qx, qy, qz = _scaled(x, acc), _scaled(y, acc), _scaled(z, acc)
+		scale = 10.0**acc
+		rx, ry, rz = qx / scale, qy / scale, qz / scale
+		eps = [10**(-self.accuracies[g]) for g in "XYZ"]
+
+		if e is None:
+			keep = self._kept_moves(x, y, z, rx, ry, rz, eps)
+			idx = np.flatnonzero(keep)
+			if len(idx) == 0:
+				return 0 if out is not None else []
+			x, y, z, f, rapid = x[idx], y[idx], z[idx], f[idx], rapid[idx]
+			qx, qy, qz, rx, ry, rz = qx[idx], qy[idx], qz[idx], rx[idx], ry[idx], rz[idx]
+		elif n == 0:
+			return 0 if out is not None else []
+
+		# Moves are relative to the (rounded) previous position
+		dx = x - np.concatenate(((self.curx,), rx[:-1]))
+		dy = y - np.concatenate(((self.cury,), ry[:-1]))
+		dz = z - np.concatenate(((self.curz,), rz[:-1]))
+		nodx = np.abs(dx) < eps[0]
+		nody = np.abs(dy) < eps[1]
+		nodz = np.abs(dz) < eps[2]
+
+		known = (dx == dx) & (dy == dy) & (dz == dz)
+		ds = np.sqrt(dx*dx + dy*dy + dz*dz)
+		self.length = float(np.add.accumulate(np.concatenate(((self.length,), ds[known])))[-1])
+
+		feed = np.where(np.isnan(f), float(self.G0_speed), f)
+		cut = ~rapid
+		if cut.any():
+			autofeed = self._autofeed(dx[cut], dy[cut], dz[cut])
+			fc = f[cut]
+			too_high = fc > autofeed
+			if too_high.any():
+				logger.warning("Warning: feed too high in %d of %d moves", too_high.sum(), len(fc))
+			fc = np.where(np.isnan(fc) | (fc == 0), autofeed, fc)
+			feed[cut] = np.rint(fc)
+
+		self.duration = float(np.add.accumulate(np.concatenate(((self.duration,),
+		 (ds / (feed / 60))[known])))[-1])
+
+		show_f = feed != np.concatenate(((self.curf,), feed[:-1]))
+
+		if not self.fake:
+			opcode = "G0" if self.use_G0 else "G1"
+			qf = np.trunc(feed).astype(np.int64)
+			qe = None if e is None else _scaled(e, self.accuracies["E"])
+			buf = list()
+			for a in range(0, len(x), chunk):
+				b = a + chunk
+				sl = slice(a, b)
+				m = len(x[sl])
+				g0 = rapid[sl]
+				blocks = [
+				 _ascii_const(opcode, g0) + _ascii_const("G1", ~g0),
+				]
+				for name, q, no in (("X", qx, nodx), ("Y", qy, nody), ("Z", qz, nodz)):
+					show = ~no[sl]
+					blocks.append(_ascii_const(" " + name, show))
+					blocks.append(_ascii_number(q[sl], acc) * show[:,None].astype(np.uint8))
+				show = show_f[sl]
+				blocks.append(_ascii_const(" F", show))
+				blocks.append(_ascii_number(qf[sl], 0) * show[:,None].astype(np.uint8))
+				if qe is not None:
+					blocks.append(_ascii_const(" E", np.ones(m, dtype=bool)))
+					blocks.append(_ascii_number(qe[sl], self.accuracies["E"]))
+				blocks.append(_ascii_const("\n", np.ones(m, dtype=bool)))
+				text = np.concatenate(blocks, axis=1)
+				text = text[text != 0].tobytes()
+				if out is None:
+					buf.append(text)
+				elif isinstance(out, io.TextIOBase):
+					out.write(text.decode("ascii"))
+				else:
+					out.write(text)
+
+		self.curx = float(rx[-1])
+		self.cury = float(ry[-1])
+		self.curz = float(rz[-1])
+		self.curf = feed[-1].item()
+
+		if out is not None:
+			return 0 if self.fake else len(x)
+		if self.fake:
+			return []
+		return b"".join(buf).decode("ascii").splitlines()
+
+	def _kept_moves(self, x, y, z, rx, ry, rz, eps):
+		"""
+		:return: mask of the moves which are not skipped for being too short
+		"""
+		n = len(x)
+		keep = np.ones(n, dtype=bool)
+		ex, ey, ez = eps
+		# Assuming the previous move was output
+		short = (np.abs(x - np.concatenate(((self.curx,), rx[:-1]))) < ex) \
+		 & (np.abs(y - np.concatenate(((self.cury,), ry[:-1]))) < ey) \
+		 & (np.abs(z - np.concatenate(((self.curz,), rz[:-1]))) < ez)
+		pos = 0
+		for i in np.flatnonzero(short).tolist():
+			if i < pos:
+				continue
+			# The previous move was output, so this one is skipped,
+			# as the following ones are while close to the same position
+			if i == 0:
+				cx, cy, cz = self.curx, self.cury, self.curz
+			else:
+				cx, cy, cz = rx[i-1], ry[i-1], rz[i-1]
+			keep[i] = False
+			j = i + 1
+			while j < n and abs(x[j] - cx) < ex and abs(y[j] - cy) < ey and abs(z[j] - cz) < ez:
+				keep[j] = False
+				j += 1
+			pos = j + 1
+		return keep
+
+	def _autofeed(self, dx, dy, dz):
+		try:
+			res = np.asarray(compute_feed_basic(self, dx, dy, dz), dtype=np.float64)
+			if res.shape in (dx.shape, ()):
+				return np.broadcast_to(res, dx.shape)
+		except (TypeError, ValueError):
+			pass
+		return np.array([compute_feed_basic(self, a, b, c)
+		 for a, b, c in zip(dx.tolist(), dy.tolist(), dz.tolist())], dtype=np.float64)
+
+	def _toolpath_to_slow(self, toolpath, out):
+		res = list()
+		e = toolpath.e
+		for idx in range(len(toolpath)):
+			f = toolpath.f[idx]
+			res += self.line_to(
+			 x=float(toolpath.x[idx]),
+			 y=float(toolpath.y[idx]),
+			 z=float(toolpath.z[idx]),
+			 rapid=bool(toolpath.rapid[idx]),
+			 feed=None if f != f else float(f),
+			 e=None if e is None else float(e[idx]),
+			)
+		if out is None:
+			return res
+		return _write_lines(out, res)
+
 	def rapid_to(self, x=None, y=None, z=None, feed=None):
 		return self.line_to(x=x, y=y, z=z, feed=feed, rapid=True)
 
@@ -294,19 +1162,85 @@ class CodeGen(object):
 		return self.line_to(x=x, y=y, feed=feed)
 
 	# (endpoint, radius, center, cw?)
-	def xy_arc_to(self, x, y, r, cx, cy, cw):
+	def xy_arc_to(self, x, y, r, cx, cy, cw, feed=None):
+		"""
+		Generate opcodes for an arc in the XY plane, from the current position
+
+		Uses the R form, or the IJK form if `arc_ijk` is set.
+		"""
 		sx, sy, sr = self.round(x, y, r)
-		res = list()
-		if (cw):
-			res.append("G2 X%s Y%s R%s" % (sx, sy, sr))
+
+		a0 = math.atan2(self.cury - cy, self.curx - cx)
+		a1 = math.atan2(y - cy, x - cx)
+		if cw:
+			sweep = (a0 - a1) % (2 * math.pi)
+		else:
+			sweep = (a1 - a0) % (2 * math.pi)
+
+		s_f = ""
+		if feed is not None:
+			feed = int(round(feed))
+			if feed != self.curf:
+				s_f = " F%d" % feed
+			self.curf = feed
+		feed = self.curf
+
+		if sweep == sweep:
+			ds = abs(r) * sweep
+			self.length += ds
+			if feed == feed:
+				self.duration += ds / (feed / 60)
+
+		opcode = "G2" if cw else "G3"
+		if self.arc_ijk:
+			si, sj = self.round(cx - self.curx, cy - self.cury)
+			line = "%s X%s Y%s I%s J%s" % (opcode, sx, sy, si, sj)
 		else:
-			res.append("G3 X%s Y%s R%s" % (sx, sy, sr))
-		# FIXME: optional IJK format arcs
-		self.curx = x
-		self.cury = y
+			if sweep > math.pi:
+				# The longer of the two arcs
+				sr = self.round(-abs(r))
+			line = "%s X%s Y%s R%s" % (opcode, sx, sy, sr)
+		res = [line + s_f]
+		self.curx = float(sx)
+		self.cury = float(sy)
 		if self.fake:
 			res = []
-		# TODO compute length
+		return res
+
+	def fit_polyline_to(self, points, tolerance=0.01, feed=None, out=None, **kw):
+		"""
+		Generate opcodes for successive lines, as `polyline_to()`,
+		replacing runs of points fitting arcs within tolerance
+		by arcs (see `ArcFitter`)
+
+		:param kw: other `ArcFitter` parameters
+		:return: list of G-code lines, or their number if written to out
+		"""
+		points = np.asarray(points, dtype=np.float64)
+		if points.ndim == 2 and points.shape[1] == 2:
+			points = np.column_stack((points, np.full(len(points), self.curz)))
+
+		res = list() if out is None else 0
+
+		cur = (self.curx, self.cury, self.curz)
+		if not np.all(np.isfinite(cur)):
+			# No known starting point, the first move is a line
+			res += self.polyline_to(points[:1], feed=feed, out=out)
+			cur = points[0]
+			points = points[1:]
+
+		fitter = ArcFitter(tolerance=tolerance, **kw)
+		moves = fitter.push(np.asarray(cur).reshape(1, 3))
+		moves += fitter.push(points)
+		moves += fitter.flush()
+		for move in moves:
+			if move[0] == "lines":
+				res += self.polyline_to(move[1], feed=feed, out=out)
+				continue
+			kind, end, center, r, cw = move
+			lines = self.xy_arc_to(end[0], end[1], r, center[0], center[1], cw, feed=feed)
+			res += lines if out is None else _write_lines(out, lines)
+		fitter.report()
 		return res
 
 	def xy_rapid_to(self, x,y):
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# Probed height maps
+# Legal: see LICENSE file.
+
+"""
+Height map of a (warped) surface, from probed XYZ points, giving the
+Z offsets to apply to the toolpaths over it.
+
+Points on a regular grid are used as they are, with bilinear
+interpolation; irregular points are resampled on a regular grid first,
+linearly over their Delaunay triangulation if scipy is available,
+by inverse distance weighting otherwise.
+Outside of the grid, the offsets of its border are used.
+"""
+
+import io
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+def _resample(points, xs, ys):
+	"""
+	:return: Z (len(ys), len(xs)) of the irregular points at the grid nodes
+	"""
+	gx, gy = np.meshgrid(xs, ys)
+	nodes = np.column_stack((gx.ravel(), gy.ravel()))
+	try:
+		from scipy.interpolate import griddata
+	except ImportError:
+		griddata = None
+
+	if griddata is not None:
+		z = griddata(points[:,:2], points[:,2], nodes, method="linear")
+		outside = np.isnan(z)
+		if outside.any():
+			z[outside] = griddata(points[:,:2], points[:,2], nodes[outside], method="nearest")
+	else:
+		z = np.empty(len(nodes))
+		for a in range(0, len(nodes), 4096):
+			d2 = ((nodes[a:a+4096,None,:] - points[None,:,:2])**2).sum(axis=2)
+			w = 1 / np.maximum(d2, 1e-12)
+			z[a:a+4096] = (w * points[:,2]).sum(axis=1) / w.sum(axis=1)
+	return z.reshape(len(ys), len(xs))
+
+
+class HeightMap(object):
+	"""
+	Z offsets over XY
+
+	:param points: (n, 3) probed XYZ
+	:param step: grid step for irregular points, by default about their spacing
+	"""
+	def __init__(self, points, step=None):
+		points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+		if len(points) < 3:
+			raise ValueError("A height map needs at least 3 points")
+		xy = np.round(points[:,:2], 6)
+		xs = np.unique(xy[:,0])
+		ys = np.unique(xy[:,1])
+		if len(xs) >= 2 and len(ys) >= 2 and len(xs) * len(ys) == len(points) \
+		 and len(np.unique(xy, axis=0)) == len(points):
+			order = np.lexsort((xy[:,0], xy[:,1]))
+			self.regular = True
+			self.xs, self.ys = xs, ys
+			self.z = points[order,2].reshape(len(ys), len(xs))
+		else:
+			lo, hi = points[:,:2].min(axis=0), points[:,:2].max(axis=0)
+			if step is None:
+				step = np.sqrt(np.prod(np.maximum(hi - lo, 1e-9)) / len(points))
+			nx, ny = (np.ceil((hi - lo) / step).astype(int) + 1).tolist()
+			self.regular = False
+			self.xs = np.linspace(lo[0], hi[0], max(nx, 2))
+			self.ys = np.linspace(lo[1], hi[1], max(ny, 2))
+			self.z = _resample(points, self.xs, self.ys)
+
+	@classmethod
+	def load(cls, path, **kw):
+		"""
+		Load a text file of X Y Z lines, separated by spaces or commas,
+		ignoring lines starting with #
+		"""
+		with io.open(path, "r") as f:
+			text = f.read().replace(",", " ")
+		return cls(np.loadtxt(io.StringIO(text), ndmin=2)[:,:3], **kw)
+
+	def offsets(self, x, y):
+		"""
+		:return: bilinear interpolation of the heights at x, y (arrays)
+		"""
+		xs, ys, z = self.xs, self.ys, self.z
+		x = np.clip(x, xs[0], xs[-1])
+		y = np.clip(y, ys[0], ys[-1])
+		i = np.clip(np.searchsorted(xs, x, side="right") - 1, 0, len(xs) - 2)
+		j = np.clip(np.searchsorted(ys, y, side="right") - 1, 0, len(ys) - 2)
+		u = (x - xs[i]) / (xs[i+1] - xs[i])
+		v = (y - ys[j]) / (ys[j+1] - ys[j])
+		return (z[j,i] * (1 - u) + z[j,i+1] * u) * (1 - v) \
+		 + (z[j+1,i] * (1 - u) + z[j+1,i+1] * u) * v
+
+	def _crossings(self, lines, a, b):
+		"""
+		:return: segment indices and parameters of the crossings
+		 of segments a-b (1D) with lines
+		"""
+		lo = np.minimum(a, b)
+		hi = np.maximum(a, b)
+		i0 = np.searchsorted(lines, lo, side="right")
+		count = np.maximum(np.searchsorted(lines, hi, side="left") - i0, 0)
+		seg = np.repeat(np.arange(len(a)), count)
+		k = np.repeat(i0 - np.cumsum(count) + count, count) + np.arange(count.sum())
+		return seg, (lines[k] - a[seg]) / (b[seg] - a[seg])
+
+	def subdivide(self, start, end):
+		"""
+		Split segments where they cross the lines of the grid
+
+		:param start: (n, 3) start points
+		:param end: (n, 3) end points
+		:return: (m, 3) points, ending each segment (in order), and
+		 (m,) indices of the segments they belong to
+		"""
+		n = len(start)
+		sx, tx = self._crossings(self.xs, start[:,0], end[:,0])
+		sy, ty = self._crossings(self.ys, start[:,1], end[:,1])
+		seg = np.concatenate((sx, sy, np.arange(n)))
+		t = np.concatenate((tx, ty, np.ones(n)))
+		order = np.lexsort((t, seg))
+		seg, t = seg[order], t[order]
+		# Crossings at grid nodes appear twice, or can be at the end
+		dup = np.zeros(len(seg), dtype=bool)
+		dup[:-1] = (seg[1:] == seg[:-1]) & (t[1:] - t[:-1] < 1e-9)
+		seg, t = seg[~dup], t[~dup]
+		points = start[seg] + t[:,None] * (end[seg] - start[seg])
+		# Exact end points
+		last = np.flatnonzero(t == 1)
+		points[last] = end[seg[last]]
+		return points, seg
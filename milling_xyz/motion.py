@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# PYTHON_ARGCOMPLETE_OK
+# Motion planner model, for time estimates
+# Legal: see LICENSE file.
+
+"""
+Estimation of the execution time of toolpaths and G-code programs,
+with a model of the motion planner of Grbl-like controllers:
+
+- moves are linear segments, arcs being split in chords within
+  an arc tolerance;
+- each segment has a trapezoidal speed profile, at the acceleration
+  allowed by the axes along its direction, up to its feed rate or the
+  maximum rates of the axes;
+- the speed at the junction of two segments is limited by the junction
+  deviation, and the machine stops where the planner is synchronized
+  (M words, dwells...) and at the end.
+
+The forward and backward passes of the planner are linear recurrences
+in the (min, +) algebra over the squared junction speeds, which are
+solved with cumulative minimums rather than segment by segment.
+"""
+
+import sys, io
+import logging
+
+import numpy as np
+
+from .program import arc_geometry
+
+
+logger = logging.getLogger(__name__)
+
+
+def _limit(values, u):
+	"""
+	:return: largest magnitude of a vector along unit vectors u (n, 3)
+	 for which no axis exceeds values (3,)
+	"""
+	with np.errstate(divide="ignore"):
+		return (values / np.abs(u)).min(axis=1)
+
+
+def _profile_times(length, v0, v1, vmax, accel):
+	"""
+	:return: durations of trapezoidal (or triangular) speed profiles
+	"""
+	with np.errstate(divide="ignore", invalid="ignore"):
+		vpeak = np.minimum(vmax, np.sqrt(np.maximum(accel * length + (v0*v0 + v1*v1) / 2, 0)))
+		d_ramps = (2 * vpeak*vpeak - v0*v0 - v1*v1) / (2 * accel)
+		t = (2 * vpeak - v0 - v1) / accel + np.maximum(length - d_ramps, 0) / vpeak
+	return np.where(length > 0, t, 0.0)
+
+
+def _arc_chords(start, end, offset, radius, cw, plane, tolerance):
+	"""
+	Split arcs in chords, as Grbl does
+
+	:param start: (n, 3) start points
+	:param end: (n, 3) end points
+	:param offset: (n, 3) center offsets from the start (IJK), or NaN
+	:param radius: (n,) radii (R form, used where offsets are NaN)
+	:param cw: (n,) whether arcs are clockwise
+	:param plane: (n,) 0, 1, 2 for XY, ZX, YZ
+	:return: (m, 3) end points of the chords, and (m,) index of their arc
+	"""
+	n = len(start)
+	axes, p0, p1, center, r, theta0, angle = arc_geometry(start, end, offset, radius, cw, plane)
+	with np.errstate(invalid="ignore"):
+		count = np.floor(np.abs(0.5 * angle * r) / np.sqrt(tolerance * (2 * r - tolerance)))
+	count = np.where(np.isfinite(count) & (count >= 1), count, 1).astype(np.int64)
+
+	arc = np.repeat(np.arange(n), count)
+	first = np.cumsum(count) - count
+	t = (np.arange(len(arc)) - first[arc] + 1) / count[arc]
+	theta = theta0[arc] + angle[arc] * t
+	q = np.empty((len(arc), 3))
+	q[:,0] = center[arc,0] + r[arc] * np.cos(theta)
+	q[:,1] = center[arc,1] + r[arc] * np.sin(theta)
+	q[:,2] = p0[arc,2] + (p1[arc,2] - p0[arc,2]) * t
+	points = np.empty_like(q)
+	points[np.arange(len(arc))[:,None], axes[arc]] = q
+	points[first + count - 1] = end
+	return points, arc
+
+
+class Planner(object):
+	"""
+	Motion planner model of a Grbl-like controller
+
+	:param max_rate: maximum rates of the XYZ axes (mm/min)
+	:param max_accel: accelerations of the XYZ axes (mm/s²)
+	:param junction_deviation: (mm)
+	:param arc_tolerance: maximum distance of the chords to the arcs (mm)
+	"""
+	def __init__(self, max_rate=(5000, 5000, 1000), max_accel=(250, 250, 50),
+	 junction_deviation=0.01, arc_tolerance=0.002):
+		self.max_rate = np.asarray(max_rate, dtype=np.float64)
+		self.max_accel = np.asarray(max_accel, dtype=np.float64)
+		self.junction_deviation = junction_deviation
+		self.arc_tolerance = arc_tolerance
+
+	def segment_times(self, start, end, feed, stop=None):
+		"""
+		Durations of successive linear segments
+
+		:param start: (n, 3) start points
+		:param end: (n, 3) end points
+		:param feed: (n,) requested rates (mm/min), NaN or inf for the maximum
+		:param stop: (n,) whether the machine stops before each segment
+		:return: (n,) durations (s)
+		"""
+		n = len(start)
+		res = np.zeros(n)
+		d = end - start
+		length = np.sqrt((d*d).sum(axis=1))
+		kept = np.flatnonzero(length > 0)
+		if len(kept) == 0:
+			return res
+
+		# Stops before removed null segments apply to the next ones
+		if stop is None:
+			stop = np.zeros(n, dtype=bool)
+		stops = np.cumsum(stop)[kept]
+		stop = np.ones(len(kept), dtype=bool)
+		stop[1:] = stops[1:] != stops[:-1]
+
+		length = length[kept]
+		u = d[kept] / length[:,None]
+		feed = np.where(np.isnan(feed[kept]), np.inf, feed[kept])
+		vmax = np.minimum(feed, _limit(self.max_rate, u)) / 60
+		accel = _limit(self.max_accel, u)
+
+		# Squared junction speeds, from the junction deviation
+		cos = -(u[1:] * u[:-1]).sum(axis=1)
+		junction = u[1:] - u[:-1]
+		norm = np.sqrt((junction * junction).sum(axis=1))
+		with np.errstate(divide="ignore", invalid="ignore"):
+			a_junction = np.where(norm > 0, _limit(self.max_accel, junction / norm[:,None]),
+			 np.minimum(accel[1:], accel[:-1]))
+		sin_half = np.sqrt(0.5 * (1 - np.clip(cos, -0.999999, 1)))
+		vj2 = a_junction * self.junction_deviation * sin_half / (1 - sin_half)
+		vj2 = np.where(cos > 0.999999, 0.0, vj2)
+		bound = np.zeros(len(kept) + 1)
+		bound[1:-1] = np.minimum(vj2, np.minimum(vmax[1:], vmax[:-1])**2)
+		bound[:-1][stop] = 0
+
+		# Backward pass: w[i] = min(bound[i], w[i+1] + c[i]), w[n] = 0
+		c = 2 * accel * length
+		s = np.concatenate(((0.0,), np.cumsum(c)))
+		w = np.minimum.accumulate((bound + s)[::-1])[::-1] - s
+		# Forward pass: v[i+1] = min(w[i+1], v[i] + c[i])
+		v2 = s + np.minimum.accumulate(w - s)
+		v2 = np.maximum(np.minimum(v2, w), 0)
+		v = np.sqrt(v2)
+
+		res[kept] = _profile_times(length, v[:-1], v[1:], vmax, accel)
+		return res
+
+	def toolpath_times(self, toolpath, start=None):
+		"""
+		:param toolpath: `Toolpath`
+		:param start: XYZ the toolpath starts from, or None to start at its first point
+		:return: durations (s) of the moves to each point
+		"""
+		p = toolpath.points
+		if start is None:
+			start = p[:1]
+		a = np.concatenate((np.asarray(start, dtype=np.float64).reshape(1, 3), p[:-1]))
+		feed = np.where(toolpath.rapid, np.inf, toolpath.f)
+		return self.segment_times(a, p, feed)
+
+	def line_times(self, program):
+		"""
+		:param program: `Program`
+		:return: durations (s) of each line
+		"""
+		n = len(program)
+		end = np.stack((program.x, program.y, program.z), axis=1)
+		start = np.empty_like(end)
+		start[:1] = np.nan
+		start[1:] = end[:-1]
+		motion = program.motion
+		move = (motion >= 0) & np.isfinite(start).all(axis=1) & np.isfinite(end).all(axis=1)
+
+		lines = np.flatnonzero(move & (motion <= 1))
+		arcs = np.flatnonzero(move & (motion >= 2))
+		if len(arcs):
+			points, arc = _arc_chords(start[arcs], end[arcs], program.arc_offsets(arcs), program.r[arcs],
+			 motion[arcs] == 2, program.plane[arcs], self.arc_tolerance)
+			owner = np.concatenate((lines, arcs[arc]))
+			seg_end = np.concatenate((end[lines], points))
+			order = np.argsort(owner, kind="stable")
+			owner, seg_end = owner[order], seg_end[order]
+			seg_start = np.empty_like(seg_end)
+			seg_start[1:] = seg_end[:-1]
+			first = np.ones(len(owner), dtype=bool)
+			first[1:] = owner[1:] != owner[:-1]
+			seg_start[first] = start[owner[first]]
+		else:
+			owner, seg_start, seg_end = lines, start[lines], end[lines]
+
+		feed = np.where(motion[owner] == 0, np.inf, program.feed[owner])
+		inverse = program.inverse_time[owner] & (motion[owner] != 0)
+		if inverse.any():
+			# F is the inverse of the duration (min) of the line
+			d = seg_end - seg_start
+			line_length = np.bincount(owner, weights=np.sqrt((d*d).sum(axis=1)), minlength=n)
+			feed = np.where(inverse, line_length[owner] * program.feed[owner], feed)
+
+		# Stops at the lines which synchronize the planner, or lose the position
+		barrier = program.sync | ((motion >= 0) & ~move)
+		count = np.cumsum(barrier)
+		stop = np.ones(len(owner), dtype=bool)
+		stop[1:] = (count[owner[1:]] != count[owner[:-1]]) & (owner[1:] != owner[:-1])
+
+		t = self.segment_times(seg_start, seg_end, feed, stop)
+		return np.bincount(owner, weights=t, minlength=n) + program.dwell
+
+	def timestamps(self, program):
+		"""
+		:return: time (s) at the end of each line of the program
+		"""
+		return np.cumsum(self.line_times(program))
+
+
+def nominal_times(program):
+	"""
+	:return: durations (s) of the lines at their feed rates, without
+	 accelerations (as CodeGen.duration, with arcs as straight lines),
+	 for comparison
+	"""
+	end = np.stack((program.x, program.y, program.z), axis=1)
+	d = np.diff(end, axis=0, prepend=np.nan)
+	length = np.sqrt((d*d).sum(axis=1))
+	ok = (program.motion >= 1) & np.isfinite(length) & (program.feed > 0) & ~program.inverse_time
+	with np.errstate(divide="ignore", invalid="ignore"):
+		return np.where(ok, length / (program.feed / 60), 0.0) + program.dwell
+
+
+def _duration(seconds):
+	seconds = int(round(seconds))
+	return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def main(args=None):
+
+	if args is None:
+		args = sys.argv[1:]
+
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	 description="G-code execution time estimate",
+	)
+
+	parser.add_argument("--log-level",
+	 default="INFO",
+	 help="Logging level (eg. INFO, see Python logging docs)",
+	)
+
+	parser.add_argument("--max-rate",
+	 help="maximum rates of the XYZ axes (mm/min)",
+	 type=float,
+	 nargs=3,
+	 default=(5000, 5000, 1000),
+	)
+
+	parser.add_argument("--max-accel",
+	 help="accelerations of the XYZ axes (mm/s²)",
+	 type=float,
+	 nargs=3,
+	 default=(250, 250, 50),
+	)
+
+	parser.add_argument("--junction-deviation",
+	 help="junction deviation (mm)",
+	 type=float,
+	 default=0.01,
+	)
+
+	parser.add_argument("--arc-tolerance",
+	 help="arc tolerance (mm)",
+	 type=float,
+	 default=0.002,
+	)
+
+	parser.add_argument("--timestamps",
+	 help="text file where the time at the end of each line is written",
+	)
+
+	parser.add_argument("filename",
+	 help="G-code file",
+	)
+
+	try:
+		import argcomplete
+		argcomplete.autocomplete(parser)
+	except:
+		pass
+
+	args = parser.parse_args(args)
+
+	logging.basicConfig(
+	 datefmt="%Y%m%dT%H%M%S",
+	 level=getattr(logging, args.log_level),
+	 format="%(asctime)-15s %(name)s %(levelname)s %(message)s"
+	)
+
+	from .program import Program
+
+	planner = Planner(
+	 max_rate=args.max_rate,
+	 max_accel=args.max_accel,
+	 junction_deviation=args.junction_deviation,
+	 arc_tolerance=args.arc_tolerance,
+	)
+
+	program = Program.load(args.filename)
+	timestamps = planner.timestamps(program)
+	total = float(timestamps[-1]) if len(timestamps) else 0.0
+	nominal = float(nominal_times(program).sum())
+	print("%s (%.1f s), %s at the nominal feed rates, %d lines" \
+	 % (_duration(total), total, _duration(nominal), len(program)))
+
+	if args.timestamps is not None:
+		with io.open(args.timestamps, "w") as f:
+			np.savetxt(f, timestamps, fmt="%.3f")
+
+
+if __name__ == "__main__":
+	ret = main()
+	raise SystemExit(ret)
@@ -0,0 +1,732 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# PYTHON_ARGCOMPLETE_OK
+# File to file G-code post-processing
+# Legal: see LICENSE file.
+
+"""
+Batch version of PostprocFormatter, working on blocks of lines
+with numpy and bytes operations instead of per-line and per-character
+Python code, with the same output.
+
+Lines with comments (or M117 messages) are left to PostprocFormatter.
+"""
+
+import sys, io, os, re, mmap
+import collections
+import time
+import logging
+
+import numpy as np
+
+from .gcode import PostprocFormatter, PostprocFormatterStateful, PostprocLevel, SegmentInserter
+from .heightmap import HeightMap
+
+
+logger = logging.getLogger(__name__)
+
+
+def _table(chars):
+	res = np.zeros(256, dtype=bool)
+	res[np.frombuffer(chars, dtype=np.uint8)] = True
+	return res
+
+
+_letter = _table(bytes(range(ord("A"), ord("Z")+1)) + bytes(range(ord("a"), ord("z")+1)))
+_blank = _table(b" \t")
+# What str.isspace() is true for, in ASCII (minus the newline)
+_space = _table(b"\t\x0b\x0c\r\x1c\x1d\x1e\x1f ")
+_before_space = _table(b"0123456789.")
+_after_space = _table(b"EFGIJKMXYZS*")
+
+_re_trailing_space = re.compile(rb"[\t\x0b\x0c\r\x1c-\x1f ]+(?=\n)")
+
+
+def _checksum_table(fmt):
+	"""
+	:return: checksum suffixes (257, 5) padded with NULs, and their lengths;
+	 the last one is empty, for lines already having a checksum
+	"""
+	suffixes = [fmt % i for i in range(256)] + [b""]
+	res = np.zeros((len(suffixes), 5), dtype=np.uint8)
+	for idx, suffix in enumerate(suffixes):
+		res[idx,:len(suffix)] = np.frombuffer(suffix, dtype=np.uint8)
+	return res, np.array([len(x) for x in suffixes])
+
+
+_checksums = (_checksum_table(b"*%d"), _checksum_table(b" *%d"))
+
+
+def _ranges(starts, lengths):
+	"""
+	:return: indices of the ranges [starts, starts + lengths)
+	"""
+	ends = np.cumsum(lengths)
+	return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def _insert(buf, pos, values):
+	"""
+	:param pos: sorted positions of the insertions (before the element at pos)
+	:return: bytes of buf with values inserted
+	"""
+	res = np.empty(len(buf) + len(pos), dtype=np.uint8)
+	inserted = np.zeros(len(res), dtype=bool)
+	inserted[pos + np.arange(len(pos))] = True
+	res[inserted] = values
+	res[~inserted] = buf
+	return res.tobytes()
+
+
+def _strip_trailing_zeros(data):
+	"""
+	Vectorized gcode._strip_trailing_zeros(), for lines without comments
+	"""
+	buf = np.frombuffer(data, dtype=np.uint8)
+	if not b"." in data:
+		return data
+
+	# Numbers are between non-digits
+	nondigits = np.flatnonzero((buf - np.uint8(ord("0"))) > 9)
+	i = np.flatnonzero(buf[nondigits] == ord("."))
+	dots = nondigits[i]
+	nondigits = np.concatenate(([-1], nondigits, [len(buf)]))
+	int_start = nondigits[i] + 1
+	frac_end = nondigits[i+2]
+
+	# The number must follow a letter, optionally with blanks and a sign
+	pad = np.concatenate((np.zeros(1, dtype=np.uint8), buf))
+	c = pad[int_start]
+	sign = ((c == ord("+")) | (c == ord("-"))).astype(np.int64)
+	k = int_start - sign
+	while True:
+		blank = _blank[pad[k]]
+		if not blank.any():
+			break
+		k -= blank
+	valid = np.flatnonzero(_letter[pad[k]])
+	dots, int_start, frac_end, sign = dots[valid], int_start[valid], frac_end[valid], sign[valid]
+
+	# Trailing zeros, and leading zeros when there's nothing else
+	end = frac_end.copy()
+	idx = np.arange(len(dots))
+	while len(idx):
+		idx = idx[(end[idx] - 1 > dots[idx]) & (buf[end[idx] - 1] == ord("0"))]
+		end[idx] -= 1
+	whole = end == dots + 1
+	start = int_start.copy()
+	idx = np.flatnonzero(whole)
+	while len(idx):
+		idx = idx[(start[idx] < dots[idx]) & (buf[start[idx]] == ord("0"))]
+		start[idx] += 1
+	zero = whole & (start == dots)
+	whole &= ~zero
+	part = ~whole & ~zero
+
+	ranges = [
+	 _ranges(end[part], frac_end[part] - end[part]),
+	 _ranges(dots[whole], frac_end[whole] - dots[whole]),
+	]
+	if zero.any():
+		# Down to a plain 0, which the dot becomes
+		a = (int_start - sign)[zero]
+		ranges.append(_ranges(a, dots[zero] - a))
+		ranges.append(_ranges(dots[zero] + 1, frac_end[zero] - dots[zero] - 1))
+		buf = buf.copy()
+		buf[dots[zero]] = ord("0")
+	ranges = np.concatenate(ranges)
+	keep = np.ones(len(buf), dtype=bool)
+	keep[ranges] = False
+	return buf[keep].tobytes()
+
+
+def _add_spaces(data):
+	buf = np.frombuffer(data, dtype=np.uint8)
+	pos = np.flatnonzero((buf[1:] >= ord("E")) | (buf[1:] == ord("*"))) + 1
+	pos = pos[_after_space[buf[pos]] & _before_space[buf[pos-1]]]
+	return _insert(buf, pos, ord(" "))
+
+
+def _add_checksums(data, spaced):
+	"""
+	Append checksums to the lines not having one
+	"""
+	buf = np.frombuffer(data, dtype=np.uint8)
+	nl = np.flatnonzero(buf == ord("\n"))
+	starts = np.concatenate(([0], nl[:-1] + 1))
+	# Each line is followed by its newline, which is taken back out
+	cs = (np.bitwise_xor.reduceat(buf, starts) ^ ord("\n")).astype(np.int64)
+	if b"*" in data:
+		stars = np.flatnonzero(buf == ord("*"))
+		cs[np.searchsorted(nl, stars)] = 256
+	tbl, lengths = _checksums[spaced]
+	lengths = lengths[cs]
+	values = tbl[cs][np.arange(tbl.shape[1]) < lengths[:,None]]
+	return _insert(buf, np.repeat(nl, lengths), values)
+
+
+def _format_slow(data, flags):
+	"""
+	Format lines with PostprocFormatter
+	"""
+	res = list()
+	formatter = PostprocFormatter(println=res.append, flags=flags)
+	formatter.emit(data.decode("utf-8", "surrogateescape").split("\n")[:-1])
+	return b"".join(x + b"\n" for x in res)
+
+
+def _format(data, flags):
+	"""
+	Format whole lines, without comments nor M117
+	"""
+	F = PostprocFormatter
+
+	if (flags & F.STRIP_COMMENTS) != 0:
+		# Lines are right-stripped
+		buf = np.frombuffer(data, dtype=np.uint8)
+		nl = np.flatnonzero(buf == ord("\n"))
+		nl = nl[nl > 0]
+		if _space[buf[nl - 1]].any():
+			data = _re_trailing_space.sub(b"", data)
+
+	if (flags & F.STRIP_TRAILING_ZEROS) != 0:
+		data = _strip_trailing_zeros(data)
+
+	if (flags & F.STRIP_SPACES) != 0:
+		data = data.translate(None, b" ")
+
+	if (flags & F.ADD_SPACES) != 0:
+		data = _add_spaces(data)
+
+	if (flags & F.ADD_CHECKSUM) != 0:
+		spaced = (flags & F.STRIP_SPACES) == 0 or (flags & F.ADD_SPACES) != 0
+		data = _add_checksums(data, spaced)
+
+	return data
+
+
+def format_block(data, flags):
+	"""
+	Format lines as PostprocFormatter would
+
+	:param data: bytes of whole lines, each ending with a newline
+	:return: bytes of the formatted lines
+	"""
+	if not data or (flags & ~PostprocFormatter.CHECK_COMMENTS) == 0:
+		return data
+
+	buf = np.frombuffer(data, dtype=np.uint8)
+	if b";" in data or b"(" in data or b")" in data:
+		special = np.flatnonzero((buf == ord(";")) | (buf == ord("(")) | (buf == ord(")")))
+	else:
+		special = np.empty(0, dtype=np.int64)
+	pos = data.find(b"M117")
+	if pos >= 0:
+		m117 = list()
+		while pos >= 0:
+			if pos == 0 or data[pos-1] == ord("\n"):
+				m117.append(pos)
+			pos = data.find(b"M117", pos + 4)
+		special = np.concatenate((special, m117)).astype(np.int64)
+	if len(special) == 0:
+		return _format(data, flags)
+
+	nl = np.flatnonzero(buf == ord("\n"))
+	lines = np.unique(np.searchsorted(nl, special))
+	# Runs of consecutive lines with comments
+	breaks = np.flatnonzero(np.diff(lines) != 1) + 1
+	firsts = lines[np.concatenate(([0], breaks))]
+	lasts = lines[np.concatenate((breaks - 1, [len(lines) - 1]))]
+	res = list()
+	pos = 0
+	for first, last in zip(firsts.tolist(), lasts.tolist()):
+		a = int(nl[first-1]) + 1 if first > 0 else 0
+		b = int(nl[last]) + 1
+		if a > pos:
+			res.append(_format(data[pos:a], flags))
+		res.append(_format_slow(data[a:b], flags))
+		pos = b
+	if pos < len(data):
+		res.append(_format(data[pos:], flags))
+	return b"".join(res)
+
+
+class Compactor(object):
+	"""
+	PostprocFormatterStateful over blocks of lines
+	"""
+	def __init__(self, flags):
+		self._res = list()
+		self.stage = PostprocFormatterStateful(println=self._res.append, flags=flags)
+
+	def __call__(self, data):
+		self.stage.emit(data.decode("utf-8", "surrogateescape").split("\n")[:-1])
+		res = "".join(x + "\n" for x in self._res).encode("utf-8", "surrogateescape")
+		self._res.clear()
+		return res
+
+
+_re_special_line = re.compile(rb"^(?!(?:[ \t\r]*(?:[Gg][ \t\r]*0*[0-3](?:\.0*)?(?!\d)" \
+ rb"|[NnXxYyZzAaBbCcUuVvWwFfEeSsIiJjKkRr][ \t\r]*[-+]?(?:\d+\.?\d*|\.\d+)))*[ \t\r]*$)[^\n]*", re.M)
+_re_number = re.compile(rb"[ \t\r]*([-+]?(?:\d+\.?\d*|\.\d+))")
+
+
+def _last_value(data, letter, a, b):
+	"""
+	:return: the value of the last word of a letter in data[a:b], or None
+	"""
+	pos = max(data.rfind(letter.upper(), a, b), data.rfind(letter.lower(), a, b))
+	if pos < 0:
+		return None
+	return _re_number.match(data, pos + 1).group(1)
+
+
+def _advance_moves(stage, data, a, b):
+	"""
+	Update the state of a PostprocFormatterStateful over lines data[a:b]
+	having only moves (motion G-words, axes, feed, and words not changing the state)
+	"""
+	while True:
+		modal, pos, last_f = stage.get_state()
+		if modal.get("motion") in ("0", "1", "2", "3") and modal.get("distance") in ("90", "91"):
+			break
+		# Line by line until the moves are understood
+		end = data.find(b"\n", a, b)
+		if end < 0:
+			end = b
+		stage.compact(data[a:end].decode("utf-8", "surrogateescape"))
+		a = end + 1
+		if a > b:
+			return
+
+	g = _last_value(data, b"G", a, b)
+	if g is not None:
+		modal["motion"] = "%g" % float(g)
+
+	f = _last_value(data, b"F", a, b)
+	if f is not None:
+		last_f = None if modal.get("feed_mode") == "93" else float(f)
+
+	for letter in PostprocFormatterStateful.AXES:
+		letter = letter.encode()
+		if modal["distance"] == "90":
+			v = _last_value(data, letter, a, b)
+			if v is not None:
+				pos[letter.decode()] = float(v)
+		elif letter.decode() in pos:
+			r = re.compile(b"[" + letter + letter.lower() + b"]" + _re_number.pattern)
+			v = pos[letter.decode()]
+			for m in r.finditer(data, a, b):
+				v += float(m.group(1))
+			pos[letter.decode()] = v
+
+	stage.set_state((modal, pos, last_f))
+
+
+def advance(stage, data):
+	"""
+	Update the state of a PostprocFormatterStateful over lines, as emit() would,
+	mostly without looking at each line
+	"""
+	pos = 0
+	for m in _re_special_line.finditer(data):
+		if m.start() > pos:
+			_advance_moves(stage, data, pos, m.start() - 1)
+		stage.compact(m.group(0).decode("utf-8", "surrogateescape"))
+		pos = m.end() + 1
+	if pos < len(data):
+		_advance_moves(stage, data, pos, len(data) - 1)
+
+
+class Rewriter(object):
+	"""
+	PostprocLevel or SegmentInserter over blocks of lines
+	"""
+	def __init__(self, cls, **kw):
+		self._res = list()
+		self.stage = cls(println=self._res.append, **kw)
+
+	def __call__(self, data, final=False):
+		self.stage.emit(data.decode("utf-8", "surrogateescape").split("\n")[:-1])
+		if final:
+			self.stage.flush()
+		res = "\n".join(self._res).encode("utf-8", "surrogateescape") + b"\n" if self._res else b""
+		self._res.clear()
+		return res
+
+
+def blocks(f, block_size=1<<24):
+	"""
+	Read a file by blocks of whole lines
+
+	:return: generator of bytes, each ending with a newline
+	"""
+	rest = b""
+	while True:
+		data = f.read(block_size)
+		if not data:
+			break
+		data = rest + data
+		end = data.rfind(b"\n") + 1
+		if end == 0:
+			rest = data
+			continue
+		rest = data[end:]
+		yield data[:end]
+	if rest:
+		yield rest + b"\n"
+
+
+def postprocess(src, dst, flags, compact=0, block_size=1<<24, heightmap=None, segments=None):
+	"""
+	Post-process a G-code file into another
+
+	:param src: input binary file
+	:param dst: output binary file
+	:param flags: PostprocFormatter flags
+	:param compact: PostprocFormatterStateful flags, 0 for no compaction
+	:param heightmap: HeightMap to level the moves with
+	:param segments: SegmentInserter arguments (max_time, max_length),
+	 to split the moves with first
+	:return: number of bytes read and written
+	"""
+	compactor = Compactor(compact) if compact else None
+	rewriters = list()
+	if segments is not None:
+		max_time, max_length = segments
+		rewriters.append(Rewriter(SegmentInserter, max_time=max_time, max_length=max_length))
+	if heightmap is not None:
+		rewriters.append(Rewriter(PostprocLevel, heightmap=heightmap))
+	nb_in = 0
+	nb_out = 0
+
+	def process(data, final=False):
+		for rewriter in rewriters:
+			data = rewriter(data, final)
+		if compactor is not None:
+			data = compactor(data)
+		return format_block(data, flags)
+
+	for data in blocks(src, block_size):
+		nb_in += len(data)
+		data = process(data)
+		nb_out += len(data)
+		dst.write(data)
+	if rewriters:
+		data = process(b"", final=True)
+		nb_out += len(data)
+		dst.write(data)
+	for rewriter in rewriters:
+		rewriter.stage.report()
+	if compactor is not None:
+		compactor.stage.report()
+	return nb_in, nb_out
+
+
+_mm = None
+
+
+def _open_mmap(path):
+	global _mm
+	with io.open(path, "rb") as f:
+		_mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _process_chunk(task):
+	start, end, flags, compact, state = task
+	data = _mm[start:end]
+	if not data.endswith(b"\n"):
+		data += b"\n"
+	counters = None
+	if compact:
+		compactor = Compactor(compact)
+		compactor.stage.set_state(state)
+		data = compactor(data)
+		stage = compactor.stage
+		counters = (stage.lines_in, stage.lines_out, stage.bytes_in, stage.bytes_out)
+	return format_block(data, flags), counters
+
+
+def chunks(mm, chunk_size=1<<24):
+	"""
+	:return: list of (start, end) of chunks of whole lines
+	"""
+	res = list()
+	start = 0
+	while start < len(mm):
+		end = mm.find(b"\n", start + chunk_size - 1) + 1
+		if end == 0:
+			end = len(mm)
+		res.append((start, end))
+		start = end
+	return res
+
+
+def postprocess_parallel(path, dst, flags, compact=0, jobs=None, chunk_size=1<<24):
+	"""
+	Post-process a G-code file into another, using a pool of processes,
+	with the same output as `postprocess()`
+
+	The input is memory-mapped by the workers, which are given chunks of it;
+	for compaction, the state at the start of each chunk is computed first.
+
+	:param path: input file name
+	:param dst: output binary file
+	:param jobs: number of processes, None for all the CPUs
+	:return: number of bytes read and written
+	"""
+	import concurrent.futures
+
+	nb_in = os.path.getsize(path)
+	if nb_in == 0:
+		return 0, 0
+
+	with io.open(path, "rb") as f, \
+	 mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+		parts = chunks(mm, chunk_size)
+		states = [None] * len(parts)
+		if compact:
+			stage = PostprocFormatterStateful(println=None, flags=compact)
+			for idx, (start, end) in enumerate(parts):
+				states[idx] = stage.get_state()
+				data = mm[start:end]
+				if not data.endswith(b"\n"):
+					data += b"\n"
+				advance(stage, data)
+
+	if jobs is None:
+		jobs = os.cpu_count()
+
+	nb_out = 0
+	total = PostprocFormatterStateful(println=None, flags=compact)
+	with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+	 initializer=_open_mmap, initargs=(path,)) as executor:
+		pending = collections.deque()
+		tasks = iter(zip(parts, states))
+		while True:
+			# Bounded read-ahead, the results are written in order
+			for (start, end), state in tasks:
+				pending.append(executor.submit(_process_chunk, (start, end, flags, compact, state)))
+				if len(pending) >= 2 * jobs:
+					break
+			if not pending:
+				break
+			data, counters = pending.popleft().result()
+			nb_out += len(data)
+			dst.write(data)
+			if counters is not None:
+				total.lines_in += counters[0]
+				total.lines_out += counters[1]
+				total.bytes_in += counters[2]
+				total.bytes_out += counters[3]
+	if compact:
+		total.report()
+	return nb_in, nb_out
+
+
+def benchmark(path, block_size=1<<24):
+	"""
+	Measure the throughput of flag combinations over a file
+
+	:return: list of (description, MB/s, output size)
+	"""
+	F = PostprocFormatter
+	S = PostprocFormatterStateful
+	combinations = [
+	 ("copy", 0, 0),
+	 ("strip-comments", F.STRIP_COMMENTS, 0),
+	 ("strip-spaces", F.STRIP_SPACES, 0),
+	 ("strip-trailing-zeros", F.STRIP_TRAILING_ZEROS, 0),
+	 ("add-spaces", F.ADD_SPACES, 0),
+	 ("add-checksum", F.ADD_CHECKSUM, 0),
+	 ("strip-comments,strip-spaces,add-checksum", F.STRIP_COMMENTS | F.STRIP_SPACES | F.ADD_CHECKSUM, 0),
+	 ("all-strip,add-spaces,add-checksum", F.STRIP_COMMENTS | F.STRIP_SPACES | F.STRIP_TRAILING_ZEROS \
+	  | F.ADD_SPACES | F.ADD_CHECKSUM, 0),
+	 ("compact", 0, S.STRIP_REDUNDANT_WORDS | S.STRIP_REDUNDANT_COORDS),
+	]
+	res = list()
+	for name, flags, compact in combinations:
+		with io.open(path, "rb") as src, io.open(os.devnull, "wb") as dst:
+			t0 = time.perf_counter()
+			nb_in, nb_out = postprocess(src, dst, flags, compact, block_size)
+			dt = time.perf_counter() - t0
+		res.append((name, nb_in / dt / 1e6, nb_out))
+	return res
+
+
+def main(args=None):
+
+	if args is None:
+		args = sys.argv[1:]
+
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	 description="G-code post-processor",
+	)
+
+	parser.add_argument("--log-level",
+	 default="WARNING",
+	 help="Logging level (eg. INFO, see Python logging docs)",
+	)
+
+	parser.add_argument("input",
+	 help="input G-code file (- for stdin)",
+	)
+
+	parser.add_argument("output",
+	 nargs="?",
+	 help="output G-code file (- for stdout)",
+	)
+
+	parser.add_argument("--strip-comments",
+	 action="store_true",
+	)
+
+	parser.add_argument("--check-comments",
+	 action="store_true",
+	 help="fail on unbalanced parenthesis comments, when stripping comments",
+	)
+
+	parser.add_argument("--strip-spaces",
+	 action="store_true",
+	)
+
+	parser.add_argument("--strip-trailing-zeros",
+	 action="store_true",
+	)
+
+	parser.add_argument("--add-spaces",
+	 action="store_true",
+	)
+
+	parser.add_argument("--add-checksum",
+	 action="store_true",
+	)
+
+	parser.add_argument("--compact",
+	 action="store_true",
+	 help="drop redundant words and coordinates (slower, stateful)",
+	)
+
+	parser.add_argument("--compact-motion",
+	 action="store_true",
+	 help="also drop repeated motion words, for controllers with modal motion",
+	)
+
+	parser.add_argument("--level",
+	 metavar="HEIGHTMAP",
+	 help="level the moves with a height map (file of X Y Z probed points)",
+	)
+
+	parser.add_argument("--max-segment-time",
+	 metavar="SECONDS",
+	 help="split the G1 moves in segments lasting at most this, at their feed rate",
+	 type=float,
+	)
+
+	parser.add_argument("--max-segment-length",
+	 help="split the G1 moves in segments at most this long",
+	 type=float,
+	)
+
+	parser.add_argument("--block-size",
+	 help="size of the reads (MiB)",
+	 type=int,
+	 default=16,
+	)
+
+	parser.add_argument("--jobs",
+	 help="number of processes, 0 for all the CPUs",
+	 type=int,
+	 default=1,
+	)
+
+	parser.add_argument("--benchmark",
+	 action="store_true",
+	 help="measure the throughput of flag combinations over the input",
+	)
+
+	try:
+		import argcomplete
+		argcomplete.autocomplete(parser)
+	except:
+		pass
+
+	args = parser.parse_args(args)
+
+	logging.basicConfig(
+	 datefmt="%Y%m%dT%H%M%S",
+	 level=getattr(logging, args.log_level),
+	 format="%(asctime)-15s %(name)s %(levelname)s %(message)s"
+	)
+
+	block_size = args.block_size << 20
+
+	if args.benchmark:
+		for name, speed, size in benchmark(args.input, block_size):
+			print("%-45s %8.1f MB/s %12d bytes" % (name, speed, size))
+		return
+
+	if args.output is None:
+		parser.error("the output file is required")
+
+	F = PostprocFormatter
+	flags = 0
+	if args.strip_comments:
+		flags |= F.STRIP_COMMENTS
+	if args.check_comments:
+		flags |= F.CHECK_COMMENTS
+	if args.strip_spaces:
+		flags |= F.STRIP_SPACES
+	if args.strip_trailing_zeros:
+		flags |= F.STRIP_TRAILING_ZEROS
+	if args.add_spaces:
+		flags |= F.ADD_SPACES
+	if args.add_checksum:
+		flags |= F.ADD_CHECKSUM
+
+	S = PostprocFormatterStateful
+	compact = 0
+	if args.compact or args.compact_motion:
+		compact = S.STRIP_REDUNDANT_WORDS | S.STRIP_REDUNDANT_COORDS
+	if args.compact_motion:
+		compact |= S.STRIP_REDUNDANT_MOTION
+
+	if args.output == "-":
+		dst = sys.stdout.buffer
+	else:
+		dst = io.open(args.output, "wb", buffering=block_size)
+
+	heightmap = None
+	if args.level is not None:
+		heightmap = HeightMap.load(args.level)
+
+	segments = None
+	if args.max_segment_time or args.max_segment_length:
+		segments = (args.max_segment_time, args.max_segment_length)
+
+	t0 = time.perf_counter()
+	if args.jobs != 1:
+		if args.input == "-":
+			parser.error("parallel processing needs an input file")
+		if heightmap is not None or segments is not None:
+			parser.error("leveling and segment insertion are done in a single process")
+		with dst:
+			nb_in, nb_out = postprocess_parallel(args.input, dst, flags, compact,
+			 jobs=args.jobs or None, chunk_size=block_size)
+	else:
+		if args.input == "-":
+			src = sys.stdin.buffer
+		else:
+			src = io.open(args.input, "rb", buffering=block_size)
+		with src, dst:
+			nb_in, nb_out = postprocess(src, dst, flags, compact, block_size, heightmap, segments)
+	dt = time.perf_counter() - t0
+	logger.info("%d bytes -> %d in %.3f s (%.1f MB/s)",
+	 nb_in, nb_out, dt, nb_in / dt / 1e6 if dt else 0.0)
+
+
+if __name__ == "__main__":
+	ret = main()
+	raise SystemExit(ret)
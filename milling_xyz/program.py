@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# PYTHON_ARGCOMPLETE_OK
+# G-code programs as arrays
+# Legal: see LICENSE file.
+
+"""
+Parsing of G-code programs into arrays over their lines
+(structure of arrays), with the modal state resolved.
+
+The text is tokenized with numpy over chunks of lines (words are a
+letter and a number, outside of comments), then the modal groups and
+positions are followed with cumulative operations, carrying the state
+from a chunk to the next.
+
+Positions are in the program coordinates, in mm; they are unknown (NaN)
+until set, and after moves which end at an unknown position
+(homing, probing, machine coordinates, change of work offsets).
+
+Summaries of whole programs (bounds, lengths, feed rates, tools) are
+then computed over these arrays.
+"""
+
+import sys, io
+import mmap
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+_digit = np.zeros(256, dtype=bool)
+_digit[ord("0"):ord("9")+1] = True
+_letter = np.zeros(256, dtype=bool)
+_letter[ord("A"):ord("Z")+1] = True
+_letter[ord("a"):ord("z")+1] = True
+
+
+def _comments(b, pos, newlines):
+	"""
+	:return: mask of the positions which are in comments
+	 (from a semicolon, or in parentheses, up to the end of line)
+	"""
+	semicolons = np.flatnonzero(b == 59)
+	opening = np.flatnonzero(b == 40)
+	if len(semicolons) == 0 and len(opening) == 0:
+		return np.zeros(len(pos), dtype=bool)
+	closing = np.flatnonzero(b == 41)
+	eol = np.append(newlines, len(b))
+	start = np.concatenate((semicolons, opening))
+	end = eol[np.searchsorted(newlines, start)]
+	closed = np.append(closing, len(b))[np.searchsorted(closing, opening)]
+	end[len(semicolons):] = np.minimum(end[len(semicolons):], closed)
+	order = np.argsort(start, kind="stable")
+	start = start[order]
+	end = np.maximum.accumulate(end[order])
+	k = np.searchsorted(start, pos, side="right") - 1
+	return (k >= 0) & (end[np.maximum(k, 0)] >= pos)
+
+
+def _words(b):
+	"""
+	Tokenize whole lines
+
+	:param b: uint8 array of lines
+	:return: line starts, and position, letter (uppercase),
+	 line index and value of each word
+	"""
+	n = len(b)
+	newlines = np.flatnonzero(b == 10)
+	starts = np.concatenate(((0,), newlines + 1))
+	if starts[-1] == n:
+		starts = starts[:-1]
+
+	pos = np.flatnonzero(_letter[b])
+	pos = pos[~_comments(b, pos, newlines)]
+
+	# Numbers, scanned a character at a time over all the words
+	padded = np.empty(n + 1, dtype=np.uint8)
+	padded[:n] = b
+	padded[n] = 10
+	q = pos + 1
+	while True:
+		c = padded[q]
+		blank = (c == 32) | (c == 9)
+		if not blank.any():
+			break
+		q[blank] += 1
+	negative = c == 45
+	q += negative | (c == 43)
+
+	nb = len(q)
+	mantissa = np.zeros(nb, dtype=np.int64)
+	end = np.zeros(nb, dtype=np.int64)
+	dot = np.full(nb, -1, dtype=np.int64)
+	idx = np.arange(nb)
+	qa, ma, da = q.copy(), mantissa.copy(), dot.copy()
+	while len(idx):
+		c = padded[qa]
+		digit = _digit[c]
+		is_dot = (c == 46) & (da < 0)
+		ma = np.where(digit, ma * 10 + (c - 48), ma)
+		da = np.where(is_dot, qa, da)
+		more = digit | is_dot
+		done = ~more
+		i = idx[done]
+		mantissa[i], end[i], dot[i] = ma[done], qa[done], da[done]
+		idx, qa, ma, da = idx[more], qa[more] + 1, ma[more], da[more]
+
+	has_dot = dot >= 0
+	valid = end - q - has_dot > 0
+	decimals = np.where(has_dot, end - dot - 1, 0)[valid]
+	value = mantissa[valid] / 10.0**decimals
+	value[negative[valid]] *= -1
+	pos = pos[valid]
+	letter = b[pos] & 0xdf
+	line = np.searchsorted(newlines, pos)
+
+	# Messages (M117, M118) are text up to the end of line
+	m = (letter == 77) & ((value == 117) | (value == 118))
+	if m.any():
+		message = np.full(len(starts), n)
+		message[line[m][::-1]] = pos[m][::-1]
+		keep = pos <= message[line]
+		pos, letter, line, value = pos[keep], letter[keep], line[keep], value[keep]
+
+	return starts, pos, letter, line, value
+
+
+def _filled(present, values, first):
+	"""
+	:return: last given value on each line, or first before any
+	"""
+	last = np.maximum.accumulate(np.where(present, np.arange(len(present)), -1))
+	return np.where(last >= 0, values[np.maximum(last, 0)], first)
+
+
+# G codes (times 10) of the modal groups
+_MOTION = (0, 10, 20, 30)
+_CYCLES = (730, 760, 800, 810, 820, 830, 840, 850, 860, 870, 880, 890)
+_PROBE = (382, 383, 384, 385)
+_WCS = (540, 550, 560, 570, 580, 590, 591, 592, 593)
+# Non-modal, and moves ending at unknown positions
+_LOST = (280, 300, 530, 921, 922, 923, 430, 431, 490) + _PROBE + _WCS
+
+
+def arc_geometry(start, end, offset, radius, cw, plane):
+	"""
+	Centers and angles of arcs
+
+	:param start: (n, 3) start points
+	:param end: (n, 3) end points
+	:param offset: (n, 3) center offsets from the start (IJK), or NaN
+	:param radius: (n,) radii (R form, used where offsets are NaN)
+	:param cw: (n,) whether arcs are clockwise
+	:param plane: (n,) 0, 1, 2 for XY, ZX, YZ
+	:return: axes (n, 3) of the plane then its normal, start and end
+	 points (n, 3) along them, center (n, 2) in the plane, radius,
+	 start angle and (signed) sweep angle
+	"""
+	n = len(start)
+	axes = np.array([(0, 1, 2), (2, 0, 1), (1, 2, 0)])[plane]
+	rows = np.arange(n)[:,None]
+	p0 = start[rows, axes]
+	p1 = end[rows, axes]
+	off = offset[rows, axes]
+
+	# R form: center on the bisector of the chord
+	r = radius.copy()
+	use_r = np.isnan(off[:,0]) | np.isnan(off[:,1])
+	if use_r.any():
+		d = p1[:,:2] - p0[:,:2]
+		with np.errstate(invalid="ignore", divide="ignore"):
+			h = -np.sqrt(np.maximum(4 * r*r - (d*d).sum(axis=1), 0)) / np.hypot(d[:,0], d[:,1])
+		h = np.where(cw, h, -h)
+		h = np.where(r < 0, -h, h)
+		off_r = np.stack((0.5 * (d[:,0] - d[:,1] * h), 0.5 * (d[:,1] + d[:,0] * h)), axis=1)
+		off[:,:2] = np.where(use_r[:,None], off_r, off[:,:2])
+	r = np.hypot(off[:,0], off[:,1])
+
+	center = p0[:,:2] + off[:,:2]
+	r0 = -off[:,:2]
+	r1 = p1[:,:2] - center
+	angle = np.arctan2(r0[:,0] * r1[:,1] - r0[:,1] * r1[:,0], (r0 * r1).sum(axis=1))
+	angle = np.where(cw & (angle >= -1e-6), angle - 2 * np.pi, angle)
+	angle = np.where(~cw & (angle <= 1e-6), angle + 2 * np.pi, angle)
+	return axes, p0, p1, center, r, np.arctan2(r0[:,1], r0[:,0]), angle
+
+
+class Program(object):
+	"""
+	G-code program, as arrays over its lines
+
+	Attributes, per line:
+
+	- `offsets`: byte offset of each line in the source (and of its end)
+	- `motion`: 0, 1, 2, 3 for G0/G1/G2/G3 moves, -1 for other lines
+	- `x`, `y`, `z`: position after the line (mm), NaN when unknown
+	- `feed`: feed rate in effect (mm/min, or 1/min under G93), NaN when unknown
+	- `inverse_time`: whether G93 is in effect
+	- `i`, `j`, `k`, `r`: arc words (mm), NaN when not given
+	- `plane`: 0, 1, 2 for G17/G18/G19
+	- `dwell`: G4 duration (s)
+	- `sync`: whether the line makes the planner stop (M words, dwells,
+	  non-modal G words, moves to unknown positions)
+	- `e`: extruder position after the line (M82/M83, G92 E)
+	- `speed`: spindle speed (S) in effect, NaN until given
+	- `tool`: tool number (T) last selected, -1 before any
+
+	and `state`, the modal state at the end of the program (dict of
+	the position, modes, feed rate, extruder position, spindle speed,
+	tool, work offsets (G code times 10), spindle (3, 4, 5 for M3/M4/M5),
+	coolant (1 for mist, 2 for flood), and whether the extruder was used
+	(E words, M82/M83)).
+
+	:param data: bytes-like G-code
+	:param chunk_size: number of bytes tokenized at once
+	:param state: modal state at the start, as a `state` of the program
+	 preceding data, by default the power-on state
+	"""
+	def __init__(self, data, chunk_size=1<<22, state=None):
+		self._data = data
+		self.state = dict(
+		 pos=[np.nan] * 3,
+		 motion=-1,
+		 absolute=True,
+		 inch=False,
+		 plane=0,
+		 feed=np.nan,
+		 inverse_time=False,
+		 e_absolute=True,
+		 e=0.0,
+		 speed=np.nan,
+		 tool=-1,
+		 wcs=540,
+		 spindle=5,
+		 coolant=0,
+		 extruder=False,
+		)
+		if state is not None:
+			self.state.update(state)
+		columns = list()
+		offsets = list()
+		n = len(data)
+		a = 0
+		while a < n:
+			b = min(a + chunk_size, n)
+			if b < n:
+				end = data.rfind(b"\n", a, b)
+				if end < 0:
+					end = data.find(b"\n", b)
+				b = n if end < 0 else end + 1
+			chunk = np.frombuffer(data, dtype=np.uint8, count=b-a, offset=a)
+			starts, pos, letter, line, value = _words(chunk)
+			offsets.append(starts + a)
+			columns.append(self._resolve(len(starts), letter, line, value))
+			a = b
+		offsets.append(np.array([n]))
+		self.offsets = np.concatenate(offsets)
+		names = ("motion", "x", "y", "z", "feed", "inverse_time", "i", "j", "k", "r", "plane",
+		 "dwell", "sync", "e", "speed", "tool")
+		for idx, name in enumerate(names):
+			setattr(self, name, np.concatenate([c[idx] for c in columns]) if columns \
+			 else np.empty(0))
+
+	@classmethod
+	def load(cls, path, **kw):
+		"""
+		Parse a file, memory-mapped
+		"""
+		with io.open(path, "rb") as f:
+			if f.seek(0, io.SEEK_END) == 0:
+				return cls(b"", **kw)
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		return cls(mm, **kw)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def line(self, idx):
+		"""
+		:return: source text of a line (0-based index)
+		"""
+		a, b = self.offsets[idx], self.offsets[idx+1]
+		return bytes(self._data[a:b]).decode("utf-8", "replace").rstrip("\r\n")
+
+	def arc_offsets(self, idx):
+		"""
+		:return: center offsets (IJK, mm) of arc lines, missing words
+		 being 0, or NaN for arcs in the R form
+		"""
+		offset = np.stack((self.i[idx], self.j[idx], self.k[idx]), axis=1)
+		return np.where(np.isnan(offset) & ~np.isnan(self.r[idx])[:,None], np.nan,
+		 np.nan_to_num(offset))
+
+	def stats(self, feed_bins=None):
+		"""
+		Summary of the moves of the program
+
+		:param feed_bins: number of bins of the feed rate histogram,
+		 by default one per feed rate used
+		:return: dict with the numbers of lines, rapid, cut (and arc) moves,
+		 bounds (min and max XYZ) of the moves and of the cuts, rapid and
+		 cut lengths (mm), extruded length, feed rates histogram
+		 (bin edges or feed rates, cut lengths and counts of moves), and
+		 the rapid, cut and extruded lengths per tool
+		"""
+		n = len(self)
+		motion = self.motion
+		end = np.stack((self.x, self.y, self.z), axis=1)
+		start = np.empty_like(end)
+		start[:1] = np.nan
+		start[1:] = end[:-1]
+		move = (motion >= 0) & np.isfinite(start).all(axis=1) & np.isfinite(end).all(axis=1)
+
+		d = end - start
+		length = np.where(move, np.sqrt((d*d).sum(axis=1)), 0.0)
+		arcs = np.flatnonzero(move & (motion >= 2))
+		extremes = np.empty((0, 3))
+		arc_ext = np.empty(0, dtype=np.int64)
+		if len(arcs):
+			axes, p0, p1, center, r, theta0, angle = arc_geometry(start[arcs], end[arcs],
+			 self.arc_offsets(arcs), self.r[arcs], motion[arcs] == 2, self.plane[arcs])
+			length[arcs] = np.hypot(angle * r, p1[:,2] - p0[:,2])
+			# Quadrant points crossed by the arcs, for their bounds
+			k = np.arange(4) * (np.pi / 2)
+			swept = np.mod((k[None,:] - theta0[:,None]) * np.sign(angle)[:,None], 2 * np.pi)
+			a, q = np.nonzero(swept <= np.abs(angle)[:,None])
+			e = np.empty((len(a), 3))
+			e[:,0] = center[a,0] + r[a] * np.cos(k[q])
+			e[:,1] = center[a,1] + r[a] * np.sin(k[q])
+			e[:,2] = p0[a,2]
+			extremes = np.empty_like(e)
+			extremes[np.arange(len(a))[:,None], axes[a]] = e
+			arc_ext = arcs[a]
+
+		rapid = move & (motion == 0)
+		cut = move & (motion >= 1)
+		# G92 E (which is synchronizing) is not an extrusion
+		extruded = np.where(self.sync, 0.0, np.diff(self.e, prepend=0.0))
+
+		def bounds(m):
+			points = np.concatenate((start[m], end[m], extremes[m[arc_ext]]))
+			if len(points) == 0:
+				return None
+			return points.min(axis=0), points.max(axis=0)
+
+		f = cut & ~self.inverse_time & np.isfinite(self.feed)
+		if feed_bins is None:
+			values, inverse = np.unique(self.feed[f], return_inverse=True)
+			feeds = (values,
+			 np.bincount(inverse, weights=length[f], minlength=len(values)),
+			 np.bincount(inverse, minlength=len(values)))
+		else:
+			counts, edges = np.histogram(self.feed[f], bins=feed_bins)
+			lengths, edges = np.histogram(self.feed[f], bins=edges, weights=length[f])
+			feeds = (edges, lengths, counts)
+
+		used = move | (extruded != 0)
+		tools, inverse = np.unique(self.tool[used], return_inverse=True)
+		per_tool = np.stack([
+		 np.bincount(inverse, weights=w[used], minlength=len(tools))
+		 for w in (length * rapid, length * cut, extruded)], axis=1)
+
+		return dict(
+		 lines=n,
+		 rapid_moves=int(rapid.sum()),
+		 cut_moves=int(cut.sum()),
+		 arcs=len(arcs),
+		 bounds=bounds(move),
+		 cut_bounds=bounds(cut),
+		 rapid_length=float(length[rapid].sum()),
+		 cut_length=float(length[cut].sum()),
+		 extruded=float(extruded.sum()),
+		 feeds=feeds,
+		 tools=dict(zip(tools.tolist(), per_tool.tolist())),
+		)
+
+	def _resolve(self, nb_lines, letter, line, value):
+		"""
+		Follow the modal state over the words of a chunk of lines
+
+		:return: columns of the lines
+		"""
+		state = self.state
+		nan = np.nan
+
+		def column(c, mask=None):
+			m = letter == ord(c)
+			if mask is not None:
+				m &= mask
+			res = np.full(nb_lines, nan)
+			res[line[m]] = value[m]
+			return res
+
+		def has(m):
+			res = np.zeros(nb_lines, dtype=bool)
+			res[line[m]] = True
+			return res
+
+		is_g = letter == ord("G")
+		code = np.where(is_g, np.rint(value * 10), -1).astype(np.int64)
+		is_m = letter == ord("M")
+		m_code = np.where(is_m, np.rint(value), -1).astype(np.int64)
+
+		def group(codes):
+			m = np.isin(code, codes)
+			res = np.full(nb_lines, -1, dtype=np.int64)
+			res[line[m]] = code[m]
+			return res
+
+		motion_word = group(_MOTION + _CYCLES)
+		distance = group((900, 910))
+		units = group((200, 210))
+		plane_word = group((170, 180, 190))
+		feed_mode = group((930, 940))
+		e_word = np.full(nb_lines, -1, dtype=np.int64)
+		m = np.isin(m_code, (82, 83))
+		e_word[line[m]] = m_code[m]
+		dwell = has(code == 40)
+		g92 = has(code == 920)
+		data = has(np.isin(code, (100, 281, 301)))
+		lost = has(np.isin(code, _LOST))
+		sync = has(is_m) | dwell | g92 | data | lost | has(np.isin(code, _CYCLES))
+
+		# G80 cancels the motion mode
+		motion = _filled(motion_word >= 0, np.where(motion_word == 800, -1, motion_word // 10),
+		 state["motion"])
+		absolute = _filled(distance >= 0, distance == 900, state["absolute"])
+		inch = _filled(units >= 0, units == 200, state["inch"])
+		plane = _filled(plane_word >= 0, (plane_word - 170) // 10, state["plane"])
+		inverse_time = _filled(feed_mode >= 0, feed_mode == 930, state["inverse_time"])
+		# M82/M83 set the extruder mode, as does G90/G91 (unless on the same line)
+		e_word = np.where(e_word >= 0, e_word == 82, np.where(distance >= 0, distance == 900, -1))
+		e_absolute = _filled(e_word >= 0, e_word == 1, state["e_absolute"])
+		scale = np.where(inch, 25.4, 1.0)
+
+		axes = [column(c) * scale for c in "XYZ"]
+		given = ~np.isnan(axes[0]) | ~np.isnan(axes[1]) | ~np.isnan(axes[2])
+		moving = given & ~dwell & ~g92 & ~data & ~lost & (motion >= 0) & (motion <= 3)
+		lost |= given & (motion > 3) & ~data
+		res_motion = np.where(moving, motion, -1).astype(np.int8)
+
+		res_pos = list()
+		for k, v in enumerate(axes):
+			present = ~np.isnan(v)
+			set_abs = present & ((moving & absolute) | g92)
+			inc = np.cumsum(np.where(present & moving & ~absolute, v, 0))
+			setval = np.where(set_abs, v, nan)
+			last = np.maximum.accumulate(np.where(set_abs | lost, np.arange(nb_lines), -1))
+			base = np.where(last >= 0, setval[np.maximum(last, 0)] - inc[np.maximum(last, 0)],
+			 state["pos"][k])
+			res_pos.append(base + inc)
+
+		e = column("E") * scale
+		present = ~np.isnan(e)
+		extruding = present & ~dwell & ~g92 & ~data & ~lost & (motion >= 0) & (motion <= 3)
+		set_abs = present & ((extruding & e_absolute) | g92)
+		inc = np.cumsum(np.where(extruding & ~e_absolute, e, 0))
+		setval = np.where(set_abs, e, nan)
+		last = np.maximum.accumulate(np.where(set_abs, np.arange(nb_lines), -1))
+		res_e = np.where(last >= 0, setval[np.maximum(last, 0)] - inc[np.maximum(last, 0)],
+		 state["e"]) + inc
+
+		# S is the spindle speed, but for dwells and M words such as M104
+		s = column("S")
+		s[dwell | has(is_m & ~np.isin(m_code, (3, 4, 5)))] = nan
+		speed = _filled(~np.isnan(s), s, state["speed"])
+		t = column("T")
+		tool = _filled(~np.isnan(t), t, state["tool"]).astype(np.int64)
+
+		f = column("F")
+		f = np.where(inverse_time, f, f * scale)
+		feed = _filled(~np.isnan(f), f, state["feed"])
+		# The feed rate is to be given again when the feed mode changes
+		changed = inverse_time != np.concatenate(((state["inverse_time"],), inverse_time[:-1]))
+		feed = np.where(changed & np.isnan(f), nan, feed)
+		feed = _filled(changed | ~np.isnan(f), feed, state["feed"])
+
+		if nb_lines:
+			state.update(
+			 pos=[float(p[-1]) for p in res_pos],
+			 motion=int(motion[-1]),
+			 absolute=bool(absolute[-1]),
+			 inch=bool(inch[-1]),
+			 plane=int(plane[-1]),
+			 feed=float(feed[-1]),
+			 inverse_time=bool(inverse_time[-1]),
+			 e_absolute=bool(e_absolute[-1]),
+			 e=float(res_e[-1]),
+			 speed=float(speed[-1]),
+			 tool=int(tool[-1]),
+			)
+
+		if (letter == ord("E")).any() or np.isin(m_code, (82, 83)).any():
+			state["extruder"] = True
+		m = np.isin(code, _WCS)
+		if m.any():
+			state["wcs"] = int(code[m][-1])
+		m = np.isin(m_code, (3, 4, 5))
+		if m.any():
+			state["spindle"] = int(m_code[m][-1])
+		coolant = m_code[np.isin(m_code, (7, 8, 9))]
+		if len(coolant):
+			off = np.flatnonzero(coolant == 9)
+			if len(off):
+				state["coolant"] = 0
+				coolant = coolant[off[-1]+1:]
+			state["coolant"] |= int((coolant == 7).any()) | 2 * int((coolant == 8).any())
+
+		return (
+		 res_motion,
+		 res_pos[0], res_pos[1], res_pos[2],
+		 feed,
+		 inverse_time,
+		 column("I") * scale, column("J") * scale, column("K") * scale, column("R") * scale,
+		 plane.astype(np.int8),
+		 np.where(dwell, np.nan_to_num(column("P")), 0.0),
+		 sync | (given & lost),
+		 res_e,
+		 speed,
+		 tool,
+		)
+
+
+def main(args=None):
+
+	if args is None:
+		args = sys.argv[1:]
+
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	 description="G-code program analysis",
+	)
+
+	parser.add_argument("--log-level",
+	 default="INFO",
+	 help="Logging level (eg. INFO, see Python logging docs)",
+	)
+
+	parser.add_argument("--feed-bins",
+	 help="number of bins of the feed rates histogram (default: one per feed rate)",
+	 type=int,
+	)
+
+	parser.add_argument("filename",
+	 help="G-code file",
+	)
+
+	try:
+		import argcomplete
+		argcomplete.autocomplete(parser)
+	except:
+		pass
+
+	args = parser.parse_args(args)
+
+	logging.basicConfig(
+	 datefmt="%Y%m%dT%H%M%S",
+	 level=getattr(logging, args.log_level),
+	 format="%(asctime)-15s %(name)s %(levelname)s %(message)s"
+	)
+
+	program = Program.load(args.filename)
+	stats = program.stats(feed_bins=args.feed_bins)
+
+	print("%d lines, %d rapid moves, %d cut moves (%d arcs)" \
+	 % (stats["lines"], stats["rapid_moves"], stats["cut_moves"], stats["arcs"]))
+	for name in ("bounds", "cut_bounds"):
+		if stats[name] is not None:
+			lo, hi = stats[name]
+			print("%s: X %.3f..%.3f Y %.3f..%.3f Z %.3f..%.3f" \
+			 % (name.replace("_", " ").capitalize(), lo[0], hi[0], lo[1], hi[1], lo[2], hi[2]))
+	print("Rapid length: %.1f mm, cut length: %.1f mm" \
+	 % (stats["rapid_length"], stats["cut_length"]))
+	if stats["extruded"]:
+		print("Extruded: %.1f mm" % stats["extruded"])
+
+	values, lengths, counts = stats["feeds"]
+	print("Feed rates (mm/min): cut length, moves")
+	for idx in range(len(lengths)):
+		if args.feed_bins is None:
+			name = "%g" % values[idx]
+		else:
+			name = "%g..%g" % (values[idx], values[idx+1])
+		print(" %s: %.1f mm, %d" % (name, lengths[idx], counts[idx]))
+
+	print("Tools: rapid length, cut length, extruded")
+	for tool, (rapid, cut, extruded) in stats["tools"].items():
+		print(" %s: %.1f mm, %.1f mm, %.1f mm" % ("T%d" % tool if tool >= 0 else "-", rapid, cut, extruded))
+
+
+if __name__ == "__main__":
+	ret = main()
+	raise SystemExit(ret)
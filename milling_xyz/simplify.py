@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# Polyline simplification
+# Legal: see LICENSE file.
+
+"""
+Removal of the points of a toolpath which are within a chord
+tolerance of the simplified path (Douglas-Peucker in 3D),
+over a stream of points, with a bounded lookahead.
+
+Points where the move type changes (feed, rapid or not, extruding or
+not) are always kept, as are the points at the end of each window of
+the lookahead.
+"""
+
+import logging
+
+import numpy as np
+
+from .toolpath import Toolpath
+
+
+logger = logging.getLogger(__name__)
+
+
+def _distances(p, a, b):
+	"""
+	:return: distances of points p (n, 3) to the segment a-b
+	"""
+	v = b - a
+	w = p - a
+	vv = v @ v
+	if vv == 0:
+		return np.sqrt(np.einsum("ij,ij->i", w, w))
+	t = np.clip((w @ v) / vv, 0, 1)
+	d = w - t[:,None] * v
+	return np.sqrt(np.einsum("ij,ij->i", d, d))
+
+
+def douglas_peucker(p, tolerance, a=0, b=None):
+	"""
+	:return: sorted indices of the points of p kept between a and b,
+	 excluding a, including b
+	"""
+	if b is None:
+		b = len(p) - 1
+	keep = [b]
+	stack = [(a, b)]
+	while stack:
+		i, j = stack.pop()
+		if j - i < 2:
+			continue
+		d = _distances(p[i+1:j], p[i], p[j])
+		k = int(np.argmax(d))
+		if d[k] > tolerance:
+			k += i + 1
+			keep.append(k)
+			stack.append((i, k))
+			stack.append((k, j))
+	keep.sort()
+	return keep
+
+
+class Simplifier(object):
+	"""
+	Streaming toolpath simplifier
+
+	Toolpaths (or points) are given with `push()`, which returns the
+	Toolpath of the points decided to be kept so far; the first point
+	given is always kept.
+
+	:param tolerance: maximum distance of a removed point to the simplified path
+	:param window: lookahead, in points
+	"""
+	def __init__(self, tolerance=0.005, window=4096):
+		self.tolerance = tolerance
+		self.window = max(window, 2)
+		self._buf = None # Toolpath, starting with the last point kept
+		self.nb_in = 0
+		self.nb_out = 0
+
+	def push(self, points, f=None, e=None, rapid=False):
+		"""
+		:param points: Toolpath, or (n, 3) points with the attributes of `Toolpath`
+		:return: Toolpath of the points kept
+		"""
+		if isinstance(points, Toolpath):
+			toolpath = points
+		else:
+			toolpath = Toolpath(points, f=f, e=e, rapid=rapid)
+		self.nb_in += len(toolpath)
+		first = self._buf is None
+		if first:
+			self._buf = toolpath
+		else:
+			buf = self._buf
+			if (buf.e is None) != (toolpath.e is None):
+				raise ValueError("Extruder positions must be given for all points, or none")
+			self._buf = Toolpath(np.concatenate((buf.points, toolpath.points)),
+			 f=np.concatenate((buf.f, toolpath.f)),
+			 e=None if buf.e is None else np.concatenate((buf.e, toolpath.e)),
+			 rapid=np.concatenate((buf.rapid, toolpath.rapid)),
+			)
+		return self._process(final=False, first=first)
+
+	def flush(self):
+		"""
+		:return: Toolpath of the remaining points kept
+		"""
+		return self._process(final=True)
+
+	def _breaks(self, buf):
+		"""
+		:return: mask of the points which must be kept, because
+		 the next move is of another type
+		"""
+		f, rapid = buf.f, buf.rapid
+		same_f = (f[1:] == f[:-1]) | (np.isnan(f[1:]) & np.isnan(f[:-1]))
+		change = ~same_f | (rapid[1:] != rapid[:-1])
+		if buf.e is not None:
+			de = np.sign(np.diff(buf.e))
+			change[1:] |= de[1:] != de[:-1]
+		res = np.zeros(len(buf), dtype=bool)
+		res[:-1] = change
+		return res
+
+	def _process(self, final, first=False):
+		buf = self._buf
+		if buf is None:
+			return Toolpath(np.empty((0, 3)))
+		n = len(buf)
+		p = buf.points
+		fixed = np.flatnonzero(self._breaks(buf))
+		keep = [0] if first else []
+		a = 0
+		idx_fixed = 0
+		while True:
+			idx_fixed += np.searchsorted(fixed[idx_fixed:], a, side="right")
+			b = a + self.window
+			if idx_fixed < len(fixed) and fixed[idx_fixed] < b:
+				b = int(fixed[idx_fixed])
+			elif b > n - 1:
+				if not final or a == n - 1:
+					break
+				b = n - 1
+			keep += douglas_peucker(p, self.tolerance, a, b)
+			a = b
+		self._buf = buf.take(slice(a, None))
+		self.nb_out += len(keep)
+		return buf.take(np.array(keep, dtype=np.int64))
+
+	def report(self):
+		"""
+		Log the reduction of the number of points
+		"""
+		logger.info("Simplification: %d points -> %d (%.1f%% fewer)",
+		 self.nb_in, self.nb_out,
+		 100 * (1 - self.nb_out / self.nb_in) if self.nb_in else 0.0)
+
+
+def simplify(chunks, tolerance=0.005, window=4096):
+	"""
+	Simplify a stream of toolpaths (or (n, 3) point arrays)
+
+	:return: generator of the simplified Toolpaths
+	"""
+	simplifier = Simplifier(tolerance=tolerance, window=window)
+	for chunk in chunks:
+		res = simplifier.push(chunk)
+		if len(res):
+			yield res
+	res = simplifier.flush()
+	if len(res):
+		yield res
+	simplifier.report()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# Toolpath as arrays
+# Legal: see LICENSE file.
+
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class Toolpath(object):
+	"""
+	Sequence of moves, held as arrays
+
+	:param points: (n, 3) array-like of XYZ targets
+	:param f: feeds (mm/min), scalar or array, NaN (or None) for automatic
+	:param e: extruder positions, scalar or array, or None
+	:param rapid: whether moves are rapid, scalar or array of booleans
+	"""
+	def __init__(self, points, f=None, e=None, rapid=False):
+		points = np.asarray(points, dtype=np.float64)
+		if points.ndim != 2 or points.shape[1] != 3:
+			raise ValueError("Expecting (n, 3) points, not %s" % (points.shape,))
+		n = len(points)
+		self.x = np.ascontiguousarray(points[:,0])
+		self.y = np.ascontiguousarray(points[:,1])
+		self.z = np.ascontiguousarray(points[:,2])
+		self.f = np.broadcast_to(np.asarray(np.nan if f is None else f, dtype=np.float64), (n,))
+		self.e = None if e is None \
+		 else np.broadcast_to(np.asarray(e, dtype=np.float64), (n,))
+		self.rapid = np.broadcast_to(np.asarray(rapid, dtype=bool), (n,))
+
+	def __len__(self):
+		return len(self.x)
+
+	def take(self, idx):
+		"""
+		:return: Toolpath of the moves at indices (or mask) idx
+		"""
+		return Toolpath(self.points[idx],
+		 f=self.f[idx],
+		 e=None if self.e is None else self.e[idx],
+		 rapid=self.rapid[idx],
+		)
+
+	@property
+	def points(self):
+		return np.stack((self.x, self.y, self.z), axis=1)
+
+	def length(self, start=None):
+		"""
+		:param start: XYZ the toolpath starts from, or None to start at its first point
+		:return: length of the toolpath
+		"""
+		if start is None:
+			p = self.points
+		else:
+			p = np.concatenate((np.asarray(start, dtype=np.float64).reshape(1, 3), self.points))
+		return float(np.linalg.norm(np.diff(p, axis=0), axis=1).sum())
@@ -54,19 +54,20 @@ def main(args=None):
 	model = solid.import_stl(stl_fn)
 
 	try:
-		import camvtk
-		stl = camvtk.STLSurf(stl_fn)
-		polydata = stl.src.GetOutput()
-		model_bounds = polydata.GetBounds()
-		minx, maxx, miny, maxy, minz, maxz = model_bounds
-		spanx = maxx-minx
-		spany = maxy-miny
-		spanz = maxz-minz
-		logger.info("X span: %s (%s-%s)", spanx, minx, maxx)
-		logger.info("Y span: %s (%s-%s)", spany, miny, maxy)
-		logger.info("Z span: %s (%s-%s)", spanz, minz, maxz)
-	except:
-		pass
+		from .stl_mesh import stl_stats
+	except ImportError:
+		# Run as a script
+		from stl_mesh import stl_stats
+	try:
+		stats = stl_stats(stl_fn)
+	except (OSError, ValueError) as e:
+		logger.warning("Could not read the geometry of %s: %s", stl_fn, e)
+	else:
+		if stats["bounds"] is not None:
+			for axis, mini, maxi in zip("XYZ", *stats["bounds"]):
+				logger.info("%s span: %s (%s-%s)", axis, maxi-mini, mini, maxi)
+		logger.info("%d triangles, area: %s, volume: %s%s", stats["triangles"],
+		 stats["area"], stats["volume"], "" if stats["watertight"] else " (not watertight)")
 
 	solid.scad_render_to_file(model, stl_fn + ".scad")
 
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 vi:noet
+# PYTHON_ARGCOMPLETE_OK
+# STL meshes as arrays
+
+"""
+Reading of STL files (binary or ASCII) into arrays of triangles,
+and their geometry: bounds, surface area, volume, and whether they
+look watertight (each edge being shared by two triangles, in opposite
+directions).
+
+Binary files are memory-mapped, their triangle records being viewed
+with a structured dtype; the geometry is computed over chunks of
+triangles, so that large scans are not loaded in memory at once
+(but for the watertightness check).
+
+The geometry of a file is cached next to it (with .xmstl suffix,
+as JSON), keyed by the hash of its content.
+"""
+
+import sys, io, os, re
+import json
+import mmap
+import hashlib
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+VERSION = 1
+SUFFIX = ".xmstl"
+_record = np.dtype([
+ ("normal", "<f4", (3,)),
+ ("vertices", "<f4", (3, 3)),
+ ("attributes", "<u2"),
+])
+_vertex = re.compile(rb"vertex\s+(\S+)\s+(\S+)\s+(\S+)")
+
+
+class Mesh(object):
+	"""
+	Triangle mesh
+
+	:param triangles: (n, 3, 3) vertices of the triangles
+	"""
+	def __init__(self, triangles):
+		self.triangles = triangles
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Read an STL file, memory-mapped when binary
+		"""
+		with io.open(path, "rb") as f:
+			size = f.seek(0, io.SEEK_END)
+			f.seek(0)
+			header = f.read(84)
+			if len(header) == 84 \
+			 and size == 84 + _record.itemsize * int.from_bytes(header[80:84], "little"):
+				if size == 84:
+					return cls(np.empty((0, 3, 3), dtype=np.float32))
+				mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				records = np.frombuffer(mm, dtype=_record, offset=84)
+				return cls(records["vertices"])
+			if not header.lstrip().startswith(b"solid"):
+				raise ValueError("Not an STL file: %s" % path)
+			f.seek(0)
+			vertices = _vertex.findall(f.read())
+		vertices = np.array(vertices, dtype=bytes).astype(np.float64)
+		if len(vertices) % 3:
+			raise ValueError("Incomplete facet in %s" % path)
+		return cls(vertices.reshape(-1, 3, 3))
+
+	def __len__(self):
+		return len(self.triangles)
+
+	def geometry(self, chunk=1<<13):
+		"""
+		Bounds, area and volume, in a pass over chunks of triangles
+
+		:return: min and max XYZ of the vertices (None if empty),
+		 surface area, and enclosed volume (negative if the triangles
+		 are oriented inwards, meaningless if not closed)
+		"""
+		n = len(self)
+		if n == 0:
+			return None, 0.0, 0.0
+		# Volume relative to a vertex, for precision
+		origin = np.asarray(self.triangles[0,0], dtype=np.float64)[:,None]
+		lo = np.full(3, np.inf)
+		hi = np.full(3, -np.inf)
+		area = volume = 0.0
+		for a in range(0, n, chunk):
+			# Coordinates of the vertices as rows: ax ay az bx by bz cx cy cz
+			t = np.asarray(self.triangles[a:a+chunk]).reshape(-1, 9).T.astype(np.float64, order="C")
+			xyz = t.reshape(3, 3, -1)
+			lo = np.minimum(lo, xyz.min(axis=(0, 2)))
+			hi = np.maximum(hi, xyz.max(axis=(0, 2)))
+			u = t[3:6]
+			u -= t[0:3]
+			v = t[6:9]
+			v -= t[0:3]
+			p = t[0:3]
+			p -= origin
+			# Normals (twice the area), and a.(b x c) = a.((b - a) x (c - a))
+			nx = u[1] * v[2] - u[2] * v[1]
+			ny = u[2] * v[0] - u[0] * v[2]
+			nz = u[0] * v[1] - u[1] * v[0]
+			volume += (p[0] * nx + p[1] * ny + p[2] * nz).sum() / 6
+			nx *= nx
+			ny *= ny
+			nz *= nz
+			nx += ny
+			nx += nz
+			area += np.sqrt(nx, out=nx).sum() / 2
+		return (lo, hi), float(area), float(volume)
+
+	def watertight(self, chunk=1<<16):
+		"""
+		:return: whether each edge is shared by exactly two triangles,
+		 going along it in opposite directions (a hint, as vertices
+		 are compared by hash)
+		"""
+		n = len(self)
+		if n == 0:
+			return False
+		# Vertices are identified by a hash of their bits (with -0 as 0),
+		# which is much faster than np.unique() over rows
+		key = np.empty(3 * n, dtype=np.uint64)
+		for a in range(0, n, chunk):
+			t = np.asarray(self.triangles[a:a+chunk], dtype=np.float32).reshape(-1, 3)
+			bits = (t + np.float32(0)).view(np.uint32).astype(np.uint64)
+			key[3*a:3*a+len(bits)] = bits[:,0] * np.uint64(0x9e3779b97f4a7c15) \
+			 ^ bits[:,1] * np.uint64(0xc2b2ae3d27d4eb4f) \
+			 ^ bits[:,2] * np.uint64(0x165667b19e3779f9)
+		_, idx = np.unique(key, return_inverse=True)
+		idx = idx.reshape(n, 3).astype(np.int64)
+		nb = int(idx.max()) + 1
+		a = idx.ravel()
+		b = idx[:,[1, 2, 0]].ravel()
+		if (a == b).any():
+			return False
+		edges = np.sort(a * nb + b)
+		if (edges[1:] == edges[:-1]).any():
+			return False
+		return np.array_equal(edges, np.sort(b * nb + a))
+
+	def stats(self):
+		"""
+		:return: dict of the number of triangles, bounds (min and max
+		 XYZ, as lists), area, volume and watertightness
+		"""
+		bounds, area, volume = self.geometry()
+		return dict(
+		 triangles=len(self),
+		 bounds=None if bounds is None else [bounds[0].tolist(), bounds[1].tolist()],
+		 area=area,
+		 volume=volume,
+		 watertight=bool(self.watertight()),
+		)
+
+
+def _file_hash(path):
+	h = hashlib.sha256()
+	with io.open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1 << 24), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def stl_stats(path, cache=True):
+	"""
+	Geometry of an STL file, as `Mesh.stats()`, cached next to it
+
+	:param cache: whether to use (and write) the cache
+	"""
+	cache_path = path + SUFFIX
+	digest = _file_hash(path)
+	if cache and os.path.exists(cache_path):
+		try:
+			with io.open(cache_path, "r") as f:
+				cached = json.load(f)
+			if cached.get("version") == VERSION and cached.get("hash") == digest:
+				return cached["stats"]
+			logger.debug("Mesh cache %s is outdated", cache_path)
+		except (OSError, ValueError) as e:
+			logger.warning("Could not read mesh cache %s: %s", cache_path, e)
+
+	stats = Mesh.load(path).stats()
+
+	if cache:
+		try:
+			tmp = cache_path + ".tmp"
+			with io.open(tmp, "w") as f:
+				json.dump(dict(version=VERSION, hash=digest, stats=stats), f)
+			os.replace(tmp, cache_path)
+		except OSError as e:
+			logger.warning("Could not cache mesh geometry in %s: %s", cache_path, e)
+	return stats
+
+
+def main(args=None):
+
+	if args is None:
+		args = sys.argv[1:]
+
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	 description="STL mesh geometry",
+	)
+
+	parser.add_argument("--log-level",
+	 default="INFO",
+	 help="Logging level (eg. INFO, see Python logging docs)",
+	)
+
+	parser.add_argument("--no-cache",
+	 action="store_true",
+	 help="do not use nor write the cache next to the file",
+	)
+
+	parser.add_argument("path",
+	 help="STL file",
+	)
+
+	try:
+		import argcomplete
+		argcomplete.autocomplete(parser)
+	except:
+		pass
+
+	args = parser.parse_args(args)
+
+	logging.basicConfig(
+	 datefmt="%Y%m%dT%H%M%S",
+	 level=getattr(logging, args.log_level),
+	 format="%(asctime)-15s %(name)s %(levelname)s %(message)s"
+	)
+
+	stats = stl_stats(args.path, cache=not args.no_cache)
+	print("%d triangles" % stats["triangles"])
+	if stats["bounds"] is not None:
+		lo, hi = stats["bounds"]
+		for axis, a, b in zip("XYZ", lo, hi):
+			print("%s span: %s (%s-%s)" % (axis, b - a, a, b))
+	print("Area: %s, volume: %s%s" % (stats["area"], stats["volume"],
+	 "" if stats["watertight"] else " (not watertight)"))
+
+
+if __name__ == "__main__":
+	ret = main()
+	raise SystemExit(ret)